@@ -4,13 +4,41 @@
 #
 # Copyright 2018 by it's authors.
 
+import itertools
+
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
+from BTrees.IOBTree import IOBTree
 from Products.ATExtensions.ateapi import RecordsField
 from Products.CMFCore.utils import getToolByName
+from bika.lims import api
 from bika.lims.utils import isnumber
 from senaite.reflex import logger
 from senaite.reflex import senaiteMessageFactory as _
 from senaite.reflex.browser.widgets import ReflexTestingRulesWidget
+from senaite.reflex.compiler import to_float
+from senaite.reflex.storage import ReflexRuleRecord  # noqa BBB for pickles
+from senaite.reflex.utils import get_transaction_cache
+
+# Version of the format of the rules stored by ReflexTestingRulesField.
+# Rules without version are stored as they come from the widget, with string
+# values only
+RULES_SCHEMA_VERSION = 2
+
+# Name of the attribute where the records of the rules are stored
+RULES_STORAGE_KEY = "_reflex_rules"
+
+# Name of the attribute where the UID of the service the rules are bound to
+# is stored, once for all the rules of the scenario
+MOTHER_SERVICE_KEY = "_reflex_mother_service_uid"
+
+# Name of the attribute where the local ids of the analyses created by the
+# actions of each rule are stored, keyed by rule number
+LOCAL_IDS_STORAGE_KEY = "_reflex_local_ids"
+
+# Name of the per-transaction cache with the rule numbers of the rules
+# changed, keyed by the UID of the scenario
+CHANGES_CACHE = "rules"
 
 
 class ReflexTestingRulesField(RecordsField):
@@ -127,14 +155,386 @@ class ReflexTestingRulesField(RecordsField):
           'rulenumber': '2',
           'trigger': 'submit'}]
         This list of dictionaries is how the system will store the reflexrule
-        field info. This dictionaries must be in sync with the
+        field info, but normalized with typed values (see normalize_rule).
+        This dictionaries must be in sync with the
         browser/widgets/reflexrulewidget.py/process_form() dictionaries format.
+
+        If window is set, only the rules from the tuple (start, end) of rule
+        numbers were rendered, and the list contains the mother rule and
+        the rules to store in place of them (see set_window).
         """
         for d in rules_list:
-            # Checking if all dictionary items are correct
-            if not _check_set_values(instance, d):
-                RecordsField.set(self, instance, [], **kwargs)
-        RecordsField.set(self, instance, rules_list, **kwargs)
+            # Checking if all dictionary items are correct. Invalid values
+            # are logged, but the rules are stored anyway
+            _check_set_values(instance, d)
+        rules_list = map(normalize_rule, rules_list)
+        # The rules changed are known from now on
+        self._mark_changed(instance)
+        window = kwargs.get('window')
+        if window:
+            self.set_window(instance, rules_list, *window)
+        else:
+            self.set_rules(instance, rules_list)
+
+    def validate(self, value, instance, errors=None, **kwargs):
+        """Validates the rules submitted. Returns an error message if any of
+        the rules cannot be stored, or None otherwise
+        """
+        error = RecordsField.validate(self, value, instance, errors=errors,
+                                      **kwargs)
+        if error:
+            return error
+        rules = value or []
+        errors_found = filter(None, map(validate_rule, rules))
+        error = errors_found and errors_found[0] or \
+            validate_rulenumbers(rules)
+        if error and errors is not None:
+            errors[self.getName()] = error
+        return error
+
+    def get(self, instance, **kwargs):
+        """Returns the list of rules, sorted by rule number
+        """
+        records = self.get_records(instance)
+        if records is None:
+            # Rules not migrated to records yet
+            return RecordsField.get(self, instance, **kwargs)
+        mother_service_uid = self.get_mother_service_uid(instance)
+        return map(lambda record: dict(
+            record.rule, mother_service_uid=mother_service_uid),
+            records.values())
+
+    def getRaw(self, instance, **kwargs):
+        return self.get(instance, **kwargs)
+
+    def get_records(self, instance, create=False):
+        """Returns the BTree of rule number -> ReflexRuleRecord where the rules
+        are stored. Returns None if the rules are still stored as a list and
+        create is False
+        """
+        records = getattr(aq_base(instance), RULES_STORAGE_KEY, None)
+        if records is None and create:
+            records = IOBTree()
+            setattr(instance, RULES_STORAGE_KEY, records)
+            # Remove the rules stored as a list
+            try:
+                self.getStorage(instance).unset(self.getName(), instance)
+            except AttributeError:
+                pass
+        return records
+
+    def get_rule(self, instance, rulenumber, default=None):
+        """Returns the rule with the rule number passed in. Only the record
+        of this rule is loaded
+        """
+        rulenumber = api.to_int(rulenumber, None)
+        records = self.get_records(instance)
+        if records is None:
+            rules = RecordsField.get(self, instance)
+            rules = filter(lambda rule: api.to_int(
+                rule.get('rulenumber'), None) == rulenumber, rules)
+            return rules and rules[0] or default
+        record = records.get(rulenumber)
+        if record is None:
+            return default
+        return dict(record.rule, mother_service_uid=self
+                    .get_mother_service_uid(instance))
+
+    def get_rules_count(self, instance):
+        """Returns the number of rules, without loading their records
+        """
+        records = self.get_records(instance)
+        if records is None:
+            return len(RecordsField.get(self, instance))
+        return len(records)
+
+    def get_mother_service_uid(self, instance):
+        """Returns the UID of the service the rules are bound to
+        """
+        uid = getattr(aq_base(instance), MOTHER_SERVICE_KEY, None)
+        if uid is not None:
+            return uid
+        # Rules stored with the service in each rule
+        records = self.get_records(instance)
+        if records is None:
+            rules = RecordsField.get(self, instance)
+            rule = rules and rules[0] or {}
+        else:
+            record = records.get(0)
+            rule = record is not None and record.rule or {}
+        return rule.get('mother_service_uid') or ''
+
+    def set_mother_service_uid(self, instance, uid):
+        """Stores the UID of the service the rules are bound to. The
+        scenario is only modified if the service changes
+        """
+        uid = uid or ''
+        if getattr(aq_base(instance), MOTHER_SERVICE_KEY, None) != uid:
+            setattr(instance, MOTHER_SERVICE_KEY, uid)
+
+    def get_local_ids_storage(self, instance, create=False):
+        """Returns the BTree of rule number -> tuple with the local ids of
+        the analyses created by the actions of the rule. Returns None if
+        the storage does not exist and create is False
+        """
+        storage = getattr(aq_base(instance), LOCAL_IDS_STORAGE_KEY, None)
+        if storage is None and create:
+            storage = IOBTree()
+            for rulenumber, record in self.get_records(instance).items():
+                storage[rulenumber] = get_rule_local_ids(record.rule)
+            setattr(instance, LOCAL_IDS_STORAGE_KEY, storage)
+        return storage
+
+    def get_local_ids(self, instance, start=0, end=None):
+        """Returns the local ids of the analyses created by the actions of
+        the rules with rule numbers from start to end (excluded). The
+        records of the rules are not loaded
+        """
+        storage = self.get_local_ids_storage(instance)
+        if storage is not None and end is None:
+            values = storage.values(start)
+        elif storage is not None:
+            values = storage.values(start, end, excludemax=True)
+        else:
+            # Rules stored before the local ids were stored apart
+            def in_range(rule):
+                num = api.to_int(rule.get('rulenumber'), -1)
+                return num >= start and (end is None or num < end)
+            values = map(get_rule_local_ids,
+                         filter(in_range, self.get(instance)))
+        return list(itertools.chain.from_iterable(values))
+
+    def get_changed_rulenumbers(self, instance):
+        """Returns the set of rule numbers of the rules changed in the
+        current transaction, and forgets them. Returns None if the changes
+        are not known
+        """
+        cache = get_transaction_cache(CHANGES_CACHE)
+        return cache.pop(api.get_uid(instance), None)
+
+    def set_rules(self, instance, rules_list):
+        """Stores the normalized rules passed in, each one in its own record.
+        Only the records of the rules that changed are rewritten. Raises a
+        ValueError if a rule has no valid rule number or the same rule number
+        is used by more than one rule
+        """
+        check_rulenumbers(rules_list)
+        rules = dict(map(lambda rule: (rule['rulenumber'], rule), rules_list))
+        records = self.get_records(instance, create=True)
+        for rulenumber in list(records.keys()):
+            if rulenumber not in rules:
+                self._remove_record(instance, rulenumber)
+        for rule in rules_list:
+            self._store_record(instance, rule)
+
+    def set_rule(self, instance, rule):
+        """Stores the rule passed in, in the record of its rule number. The
+        records of the rest of rules are not touched
+        """
+        # Invalid values are logged, but the rule is stored anyway
+        _check_set_values(instance, rule)
+        rule = normalize_rule(rule)
+        check_rulenumbers([rule])
+        if self.get_records(instance) is None:
+            # Migrate the rules stored as a list to records first
+            self.set_rules(instance, map(normalize_rule, self.get(instance)))
+        self._store_record(instance, rule)
+
+    def set_window(self, instance, rules_list, start, end):
+        """Stores the normalized rules passed in, the mother rule followed by
+        the derivative rules to store in place of the ones with rule numbers
+        from start to end (excluded). The records of the rest of rules are
+        only rewritten if rules were added or removed, because the rules
+        after the window are numbered again
+        """
+        if self.get_records(instance) is None:
+            # Migrate the rules stored as a list to records first
+            self.set_rules(instance, map(normalize_rule, self.get(instance)))
+        records = self.get_records(instance)
+        count = len(records)
+        start = max(start, 1)
+        end = max(min(end, count), start)
+        mother = rules_list[:1]
+        if not mother and 0 in records:
+            # The mother rule is kept as it is
+            mother = [records[0].rule]
+        derivatives = rules_list[1:]
+        tail = []
+        if len(derivatives) != end - start:
+            tail = map(lambda record: record.rule, records.values(end))
+        last = start + len(derivatives) + len(tail)
+        rules = map(lambda rule, num: dict(rule, rulenumber=num),
+                    mother + derivatives + tail,
+                    [0] * len(mother) + range(start, last))
+        check_rulenumbers(rules)
+        for rule in rules:
+            self._store_record(instance, rule)
+        if len(derivatives) < end - start:
+            # Less rules than before, remove the records left over
+            for rulenumber in list(records.keys(last)):
+                self._remove_record(instance, rulenumber)
+
+    def _store_record(self, instance, rule):
+        """Stores the normalized rule passed in, in the record of its rule
+        number, if the rule changed. The mother service is stored in the
+        scenario, only once for all the rules
+        """
+        rule = dict(rule)
+        mother_service_uid = rule.pop('mother_service_uid', None)
+        rulenumber = rule['rulenumber']
+        if rulenumber == 0 and mother_service_uid is not None:
+            self.set_mother_service_uid(instance, mother_service_uid)
+        records = self.get_records(instance, create=True)
+        storage = self.get_local_ids_storage(instance, create=True)
+        record = records.get(rulenumber)
+        if record is None:
+            records[rulenumber] = ReflexRuleRecord(rule)
+        elif record.rule != rule:
+            record.rule = rule
+        else:
+            return
+        local_ids = get_rule_local_ids(rule)
+        if storage.get(rulenumber) != local_ids:
+            storage[rulenumber] = local_ids
+        self._mark_changed(instance, rulenumber)
+
+    def _remove_record(self, instance, rulenumber):
+        """Removes the record of the rule with the rule number passed in
+        """
+        del self.get_records(instance)[rulenumber]
+        storage = self.get_local_ids_storage(instance, create=True)
+        if rulenumber in storage:
+            del storage[rulenumber]
+        self._mark_changed(instance, rulenumber)
+
+    def _mark_changed(self, instance, rulenumber=None):
+        """Keeps the rule number of the rule changed, so only the changed
+        rules are indexed again (see get_changed_rulenumbers)
+        """
+        cache = get_transaction_cache(CHANGES_CACHE)
+        changed = cache.setdefault(api.get_uid(instance), set())
+        if rulenumber is not None:
+            changed.add(rulenumber)
+
+
+def normalize_rule(rule):
+    """Returns a copy of the rule passed in with typed values, so consumers
+    do not need to parse them at runtime:
+        :rulenumber: integer, or None if missing or not a number
+        :schema_version: the version of the format of the rule
+        :conditions: list of normalized conditions, see normalize_condition
+        :actions: list of normalized actions, see normalize_action
+    Rules already in the current schema version are returned as they are
+    """
+    if rule.get('schema_version') == RULES_SCHEMA_VERSION:
+        return rule
+    normalized = dict(rule)
+    normalized['schema_version'] = RULES_SCHEMA_VERSION
+    normalized['rulenumber'] = api.to_int(rule.get('rulenumber'), None)
+    normalized['conditions'] = map(normalize_condition,
+                                   rule.get('conditions', []))
+    normalized['actions'] = map(normalize_action, rule.get('actions', []))
+    return normalized
+
+
+def normalize_condition(condition):
+    """Returns a copy of the condition passed in with typed values:
+        :cond_row_idx: integer
+        :range0/range1: float or None
+        :discrete: True if the condition expects a discrete result instead
+            of a range. Rules stored before the flag existed chose it from
+            the result options of the analysis, the upgrade to 1.1.0 sets the
+            flag of their conditions accordingly
+    """
+    normalized = dict(condition)
+    normalized['cond_row_idx'] = api.to_int(condition.get('cond_row_idx'), 0)
+    normalized['range0'] = to_float(condition.get('range0'))
+    normalized['range1'] = to_float(condition.get('range1'))
+    normalized['discreteresult'] = condition.get('discreteresult') or ''
+    normalized['discrete'] = bool(normalized['discreteresult'])
+    return normalized
+
+
+def normalize_action(action):
+    """Returns a copy of the action passed in with typed values:
+        :act_row_idx: integer
+    """
+    normalized = dict(action)
+    normalized['act_row_idx'] = api.to_int(action.get('act_row_idx'), 0)
+    return normalized
+
+
+def get_rule_local_ids(rule):
+    """Returns a tuple with the local ids of the analyses created by the
+    actions of the rule passed in
+    """
+    actions = rule.get('actions') or []
+    return tuple(filter(None, map(
+        lambda action: action.get('an_result_id'), actions)))
+
+
+def check_rulenumbers(rules_list):
+    """Raises a ValueError if any of the normalized rules passed in has no
+    rule number or if a rule number is used by more than one rule. Rules
+    submitted through forms are checked beforehand by validate_rulenumbers,
+    so this is only an assertion for rules stored programmatically
+    """
+    rulenumbers = map(lambda rule: rule.get('rulenumber'), rules_list)
+    invalid = filter(lambda num: not isinstance(num, int) or num < 0,
+                     rulenumbers)
+    if invalid:
+        raise ValueError("Invalid rule numbers: {}".format(invalid))
+    seen = set()
+    duplicates = set()
+    for num in rulenumbers:
+        if num in seen:
+            duplicates.add(num)
+        seen.add(num)
+    if duplicates:
+        raise ValueError("Duplicate rule numbers: {}".format(
+            sorted(duplicates)))
+
+
+def validate_rulenumbers(rules_list):
+    """Returns an error message if any of the rules passed in has no valid
+    rule number or if a rule number is used by more than one rule, or None
+    otherwise
+    """
+    rulenumbers = map(lambda rule: api.to_int(rule.get('rulenumber'), None),
+                      rules_list)
+    if any(map(lambda num: num is None or num < 0, rulenumbers)):
+        return _('The rule must have a rule number')
+    if len(set(rulenumbers)) != len(rulenumbers):
+        return _('The rule numbers must be unique')
+    return None
+
+
+def validate_rule(rule):
+    """Returns an error message if the rule passed in cannot be stored, or
+    None otherwise. Only the structure of the rule is checked
+    """
+    error = validate_rulenumbers([rule])
+    if error:
+        return error
+    if rule.get('trigger') not in ('submit', 'verify'):
+        return _('A trigger must be selected')
+    conditions = rule.get('conditions') or []
+    if not conditions:
+        return _('The rule must have at least one condition')
+    for condition in conditions:
+        if not condition.get('analysisservice'):
+            return _('An analysis service must be selected')
+        if condition.get('discreteresult'):
+            continue
+        ranges = [condition.get('range0'), condition.get('range1')]
+        if not all(map(api.is_floatable, ranges)):
+            return _('The range must be a number')
+    actions = rule.get('actions') or []
+    if not actions:
+        return _('The rule must have at least one action')
+    if not all(map(lambda action: action.get('action'), actions)):
+        return _('An action must be selected')
+    return None
 
 
 def _check_set_values(instance, dic):
@@ -220,8 +620,10 @@ def _check_conditions(instance, conditions):
         and_or = condition.get('and_or', 'no')
         cond_row_idx = condition.get('cond_row_idx', None)
         as_brain = uc(UID=analysisservice)
-        if (not discreteresult and (not range0 or not range1)) or \
-                (discreteresult and range0 and range1):
+        # Ranges might be already normalized to floats
+        has_range = range0 not in (None, '') and range1 not in (None, '')
+        if (not discreteresult and not has_range) or \
+                (discreteresult and has_range):
             logger.warn(_(
                 'If range values are empty, discreteresult must contain a '
                 'value, and if discreteresult has a value, ranges must be '
@@ -230,11 +632,11 @@ def _check_conditions(instance, conditions):
                 'discreteresult: %s, range0: %s, range1: %s'
                 % (discreteresult, range0, range1)))
             return False
-        if range1 and not(isnumber(range1)):
+        if range1 not in (None, '') and not(isnumber(range1)):
             logger.warn('The range must be a number. Now its value is: '
                         '%s' % (range1))
             return False
-        if range0 and not(isnumber(range0)):
+        if range0 not in (None, '') and not(isnumber(range0)):
             logger.warn('The range must be a number. Now its value is: '
                         '%s' % (range0))
             return False
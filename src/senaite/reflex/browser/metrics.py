@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import os
+from datetime import datetime
+
+from Products.Five.browser import BrowserView
+from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from senaite.reflex.metrics import get_summary
+from senaite.reflex.metrics import to_prometheus
+
+
+class ReflexMetricsView(BrowserView):
+    """Statistics of the reflex engine of the current process
+    """
+    template = ViewPageTemplateFile("templates/reflex_metrics.pt")
+
+    def __call__(self):
+        self.request.set("disable_border", 1)
+        self.summary = get_summary()
+        return self.template()
+
+    def get_pid(self):
+        return os.getpid()
+
+    def get_started(self):
+        started = datetime.fromtimestamp(self.summary["started"])
+        return started.strftime("%Y-%m-%d %H:%M:%S")
+
+    def format_seconds(self, value):
+        """Returns the value in milliseconds, as text
+        """
+        if value is None:
+            return "-"
+        if value == float("inf"):
+            return "> 10 s"
+        return "{:.1f} ms".format(value * 1000)
+
+    def format_rate(self, value):
+        return "{:.1f} %".format(value * 100)
+
+
+class ReflexMetricsText(BrowserView):
+    """Statistics of the reflex engine of the current process, in Prometheus
+    text exposition format
+    """
+
+    def __call__(self):
+        self.request.response.setHeader(
+            "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.request.response.setHeader("Cache-Control", "no-cache")
+        return to_prometheus()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import json
+
+from Products.Five.browser import BrowserView
+from bika.lims import api
+from plone.protect import CheckAuthenticator
+from plone.protect import PostOnly
+from senaite.reflex import senaiteMessageFactory as _
+from senaite.reflex.browser.fields import validate_rule
+from senaite.reflex.browser.widgets import RENDER_CACHE
+from senaite.reflex.index import reindex_rules
+from senaite.reflex.utils import get_transaction_cache
+from zope.i18n import translate
+
+
+class ReflexRuleSave(BrowserView):
+    """Validates and stores a single rule set of a Reflex Testing Scenario,
+    without rewriting the rest of rules. Expects the number of the rule and
+    the JSON document of the rule set posted by the widget. The values of
+    the rule set with the keys of the form are accepted as well
+    """
+
+    def __call__(self):
+        form = self.request.form
+        PostOnly(self.request)
+        CheckAuthenticator(self.request)
+        self.request.response.setHeader("Content-Type", "application/json")
+
+        scenario = self.context
+        field = scenario.getField("ReflexRules")
+        rulenumber = api.to_int(form.get("rulenumber"), -1)
+        if rulenumber < 0 or (rulenumber > 0 and field.get_rule(
+                scenario, rulenumber - 1) is None):
+            return self.error(_("Rule sets not saved yet have to be saved "
+                                "with the whole scenario"))
+        try:
+            raw_set = json.loads(form.get("rule", "{}"))
+        except ValueError:
+            return self.error(_("Not valid values"))
+
+        widget = field.widget
+        if "conditions" in raw_set:
+            rule = widget._format_json_set(raw_set)
+        else:
+            # Values with the keys of the form, e.g. 'range0-0'
+            rule = widget._format_conditions_and_actions(raw_set)
+        rule["rulenumber"] = str(rulenumber)
+        if rulenumber == 0:
+            # The service is stored once for all the rules of the scenario,
+            # so the derivative rules are bound to the new service as well
+            conditions = rule["conditions"]
+            mother_service_uid = conditions and \
+                conditions[0]["analysisservice"] or ""
+        else:
+            mother_service_uid = field.get_mother_service_uid(scenario)
+        rule["mother_service_uid"] = mother_service_uid
+
+        error = validate_rule(rule)
+        if error:
+            return self.error(error)
+
+        field.set_rule(scenario, rule)
+        # Keep the dispatch index and the widget up-to-date
+        reindex_rules(scenario, [rulenumber])
+        get_transaction_cache(RENDER_CACHE).clear()
+        return json.dumps({"success": True, "rulenumber": rulenumber})
+
+    def error(self, message):
+        self.request.response.setStatus(400)
+        return json.dumps({
+            "success": False,
+            "error": translate(message, context=self.request),
+        })
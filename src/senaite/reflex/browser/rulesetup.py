@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from Products.Five.browser import BrowserView
+from senaite.reflex.rulesetup import get_method_setup
+from senaite.reflex.rulesetup import get_rule_setup
+
+
+class ReflexRuleSetupJSON(BrowserView):
+    """Relations between methods and analysis services the rules widget
+    needs, as JSON. If a method is set in the request, only the data of that
+    method is returned, and no data at all if the method is empty. The
+    response has an ETag bound to the setup catalog, so the browser reuses
+    the data across edits of Reflex Testing Scenarios
+    """
+
+    def __call__(self):
+        if "method" in self.request.form:
+            # Only the services and worksheet templates of the method
+            method_uid = self.request.form.get("method")
+            etag, setup_json = get_method_setup(method_uid)
+        else:
+            etag, setup, setup_json = get_rule_setup()
+        response = self.request.response
+        response.setHeader("ETag", etag)
+        response.setHeader("Cache-Control", "private, max-age=0, "
+                                            "must-revalidate")
+        if_none_match = self.request.get_header("If-None-Match", "")
+        if etag in map(lambda tag: tag.strip(), if_none_match.split(",")):
+            response.setStatus(304)
+            return ""
+        response.setHeader("Content-Type", "application/json")
+        return setup_json
@@ -4,7 +4,6 @@
 #
 # Copyright 2018 by it's authors.
 
-import collections
 import json
 
 from AccessControl import ClassSecurityInfo
@@ -12,9 +11,15 @@ from Products.Archetypes.Registry import registerWidget
 from Products.Archetypes.public import DisplayList
 from bika.lims.browser.widgets import RecordsWidget
 from bika.lims.utils import getUsers
+from senaite.reflex import logger
 from senaite.reflex import senaiteMessageFactory as _
+from senaite.reflex.utils import get_registry_record
+from senaite.reflex.utils import get_transaction_cache
 from bika.lims import api
 
+# Name of the per-request cache used while rendering the widget
+RENDER_CACHE = "widget"
+
 
 class ReflexTestingRulesWidget(RecordsWidget):
     _properties = RecordsWidget._properties.copy()
@@ -80,24 +85,57 @@ class ReflexTestingRulesWidget(RecordsWidget):
         if field.getName() != 'ReflexRules':
             return RecordsWidget.process_form(
                 self, instance, field, form, empty_marker, emptyReturnsMarker)
-        raw_data = RecordsWidget.process_form(
-            self, instance, field, form, empty_marker, emptyReturnsMarker)
-        # 'value' is a list which will be saved
-        value = []
-        rulenum = 0
-        # Building the actions and conditions list
-        for raw_set in raw_data[0]:
-            d = self._format_conditions_and_actions(raw_set)
+        # The rules are about to change, discard the rendering model
+        get_transaction_cache(RENDER_CACHE).clear()
+        # The widget posts a JSON document per rule set. The keyed form
+        # values are only used if the documents are missing
+        value = self._get_json_sets(form, field)
+        if value is None:
+            raw_data = RecordsWidget.process_form(
+                self, instance, field, form, empty_marker,
+                emptyReturnsMarker)
+            value = map(self._format_conditions_and_actions, raw_data[0])
+        # The mother service is the one of the first condition
+        mother_service_uid = ''
+        if value and value[0]['conditions']:
+            mother_service_uid = value[0]['conditions'][0]['analysisservice']
+        for rulenum, d in enumerate(value):
             # Adding the rule number
             d['rulenumber'] = str(rulenum)
             # Filling the dict with the mother service UID
-            d['mother_service_uid'] = raw_data[0][0].get(
-                'analysisservice-0', '')
-            value.append(d)
-            rulenum += 1
+            d['mother_service_uid'] = mother_service_uid
+
+        # Only a page of the rules was rendered
+        window = form.get('%s_window' % field.getName(), '')
+        if window:
+            window = self._get_window(window)
+            value = self._number_window(value, window)
+            return value, {'window': window}
 
         return value, {}
 
+    def _get_window(self, window):
+        """
+        Returns a tuple (start, end) with the rule numbers of the derivative
+        rules rendered, from the string 'start:end' posted by the widget
+        """
+        start, end = map(lambda num: api.to_int(num, 1), window.split(':'))
+        return start, end
+
+    def _number_window(self, value, window):
+        """
+        Returns the rules submitted when only the mother rule and the
+        derivative rules from the window passed in were rendered, with the
+        derivative rules numbered from the start of the window. The field
+        only stores the rules from the window (see set_window)
+        :value: the list of rules submitted
+        :window: a tuple (start, end) with the rule numbers of the window
+        """
+        start = window[0]
+        for rulenum, rule in enumerate(value[1:], start):
+            rule['rulenumber'] = str(rulenum)
+        return value
+
     def _format_conditions_and_actions(self, raw_data):
         """
         This function gets a set of actions and conditionswith the following
@@ -153,275 +191,229 @@ class ReflexTestingRulesWidget(RecordsWidget):
         formatted_set = {}
         # Filling the dict with the values that aren't actions or conditions
         formatted_set['trigger'] = raw_data.get('trigger', '')
+        # Rows sorted by the index obtained in the template
+        rows = self._get_sorted_rows(raw_data)
         # Adding the conditions list to the final dictionary
-        formatted_set['conditions'] = self._get_sorted_conditions_list(
-            raw_data)
+        formatted_set['conditions'] = self._get_sorted_conditions_list(rows)
         # Adding the actions list to the final dictionary
-        formatted_set['actions'] = self._get_sorted_actions_list(raw_data)
+        formatted_set['actions'] = self._get_sorted_actions_list(rows)
         return formatted_set
 
-    def _get_sorted_conditions_list(self, raw_set):
+    def _get_sorted_rows(self, raw_set):
         """
-        This returns a list of dictionaries with the conditions got in the
-        raw_set.
+        Returns a list with the values of each row of the raw_set, as dicts
+        without the index appended to the names of the keys, e.g. 'range0'
+        instead of 'range0-3'. The list is sorted by the numeric index, so
+        the row 10 comes after the row 2.
         :raw_set: is the dict representing a set of rules and conditions.
         """
-        keys_list = raw_set.keys()
-        # cond_dicts_l is the final list which will contain the the
-        # dictionaries with the conditions.
-        # The dictionaries will be sorted by the index obtained in the
-        # template.
-        cond_dicts_l = []
-        # c_count is a counter which is incremented every time a new cond is
-        # added to the list, so we can give it a index.
-        c_count = 0
-        # cond_list will contain the keys starting with 'analysisservice-'
-        # but sorted by their index
-        cond_list = self._get_sorted_cond_keys(keys_list)
-        for key in cond_list:
-            range0_key = 'range0-'+str(c_count)
-            range0 = raw_set.get(range0_key, '')
-            range1_key = 'range1-'+str(c_count)
-            range1 = raw_set.get(range1_key, '')
-            discreteresult_key = 'discreteresult-'+str(c_count)
-            discreteresult = raw_set.get(discreteresult_key, '')
-            and_or_key = 'and_or-'+str(c_count)
-            and_or = raw_set.get(and_or_key, '')
-            # Building the conditions dict
-            cond_dict = {
-                'analysisservice': raw_set[key],
-                'cond_row_idx': c_count,
-                'range0': range0,
-                'range1': range1,
-                'discreteresult': discreteresult,
-                'and_or': and_or,
-                }
-            # Saves the conditions as a new dict inside the actions list
-            cond_dicts_l.append(cond_dict)
-            c_count += 1
-        return cond_dicts_l
-
-    def _get_sorted_cond_keys(self, keys_list):
-        """
-        This function returns only the elements starting with
-        'analysisservice-' in 'keys_list'. The returned list is sorted by the
-        index appended to the end of each element
-        """
-        # The names can be found in reflexrulewidget.pt inside the
-        # conditionscontainer div.
-        cond_list = []
-        for key in keys_list:
-            if key.startswith('analysisservice-'):
-                cond_list.append(key)
-        cond_list.sort()
-        return cond_list
-
-    def _get_sorted_actions_list(self, raw_set):
+        rows = {}
+        for key, value in raw_set.items():
+            name, sep, idx = key.rpartition('-')
+            if not sep or not idx.isdigit():
+                continue
+            rows.setdefault(int(idx), {})[name] = value
+        return [rows[idx] for idx in sorted(rows)]
+
+    def _get_sorted_conditions_list(self, rows):
         """
-        This returns a list of dictionaries with the actions got in the
-        raw_set.
-        :raw_set: is the dict representing a set of rules and conditions.
+        This returns a list of dictionaries with the conditions got in the
+        rows. The rows with an analysis service are the conditions.
+        :rows: sorted list of dicts with the values of each row.
         """
-        keys_list = raw_set.keys()
-        # actions_dicts_l is the final list which will contain the the
-        # dictionaries with the actions.
-        # The dictionaries will be sorted by the index obtained in the
-        # template.
-        actions_dicts_l = []
-        # a_count is a counter which is incremented every time a new action is
-        # added to the list, so we can give it a index.
-        a_count = 0
-        # actions_list will contain the keys starting with 'action-' but sorted
-        # by their index
-        actions_list = self._get_sorted_action_keys(keys_list)
-        for key in actions_list:
-            # Getting the key for otherWS element
-            otherWS_key = 'otherWS-'+str(a_count)
-            # Getting the value for otherWS selector
-            otherWS = raw_set.get(otherWS_key, '')
-            # Getting the key for analyst element
-            analyst_key = 'analyst-'+str(a_count)
-            # Getting the value for analyst
-            analyst = raw_set.get(analyst_key, '')
-            # Getting which analysis should has its result set
-            setresulton_key = 'setresulton-'+str(a_count)
-            setresulton = raw_set.get(setresulton_key, '')
-            # Getting the discrete result to set
-            setresultdiscrete_key = 'setresultdiscrete-'+str(a_count)
-            setresultdiscrete = raw_set.get(setresultdiscrete_key, '')
-            # Getting the numeric result to set
-            setresultvalue_key = 'setresultvalue-'+str(a_count)
-            setresultvalue = raw_set.get(setresultvalue_key, '')
-            # Getting the local analysis id
-            local_id_key = 'an_result_id-'+str(a_count)
-            local_id = raw_set.get(local_id_key, '')
-            # Getting the local analysis id
-            worksheettemplate_key = 'worksheettemplate-'+str(a_count)
-            worksheettemplate = raw_set.get(worksheettemplate_key, '')
-            # Getting the visibility in report
-            showinreport_key = 'showinreport-'+str(a_count)
-            showinreport = raw_set.get(showinreport_key, '')
-            # Getting the analysis to show or hide in report
-            setvisibilityof_key = 'setvisibilityof-'+str(a_count)
-            setvisibilityof = raw_set.get(setvisibilityof_key, '')
-            # Get the uid of the new analysis to be created
-            new_analysis_key = 'new_analysis-'+str(a_count)
-            new_analysis = raw_set.get(new_analysis_key, '')
-            # Building the action dict
-            action_dict = {
-                'action': raw_set[key],
-                'act_row_idx': a_count,
-                'otherWS': otherWS,
-                'worksheettemplate': worksheettemplate,
-                'analyst': analyst,
-                'setresulton': setresulton,
-                'setresultdiscrete': setresultdiscrete,
-                'setresultvalue': setresultvalue,
-                'an_result_id': local_id,
-                'showinreport': showinreport,
-                'setvisibilityof': setvisibilityof,
-                'new_analysis': new_analysis,
-                }
-            # Saves the action as a new dict inside the actions list
-            actions_dicts_l.append(action_dict)
-            a_count += 1
-        return actions_dicts_l
-
-    def _get_sorted_action_keys(self, keys_list):
-        """
-        This function returns only the elements starting with 'action-' in
-        'keys_list'. The returned list is sorted by the index appended to
-        the end of each element
-        """
-        # The names can be found in reflexrulewidget.pt inside the
-        # Reflex action rules list section.
-        action_list = []
-        for key in keys_list:
-            if key.startswith('action-'):
-                action_list.append(key)
-        action_list.sort()
-        return action_list
-
-    def getReflexRuleSetup(self):
-        """
-        Return a json dict with all the setup data necessary to build the
-        relations:
-        - Relations between methods and analysis services options.
-        - The current saved data
-        the functions returns:
-        {'<method_uid>': {
-            'analysisservices': {
-                '<as_uid>': {'as_id': '<as_id>',
-                            'as_title':'<as_title>',
-                            'resultoptions': [,,]}
-                '<as_uid>': {'as_id': '<as_id>',
-                            'as_title':'<as_title>',
-                            'resultoptions': [{
-                                'ResultText': 'Failed',
-                                'ResultValue': '1', 'value': ''},
-                                ...
-                            ]}
-            },
-          'as_keys': ['<as_uid>', '<as_uid>'],
-          'method_id': '<method_id>',
-          'method_tile': '<method_tile>'
-          },
-        '<method_uid>': {
-            'analysisservices': {
-                '<as_uid>': {'as_id': '<as_id>',
-                            'as_title':'<as_title>',
-                            'resultoptions': [,,]}
-               '<as_uid>': {'as_id': '<as_id>',
-                            'as_title':'<as_title>',
-                            'resultoptions': [,,]}
-            },
-          'as_keys': ['<as_uid>', '<as_uid>'],
-          'method_id': '<method_id>',
-          'method_tile': '<method_tile>'
-          },
-         'saved_actions': {'rules': [
-                    {'actions': [{'act_row_idx': 0,
-                                   'action': 'repeat',
-                                   'an_result_id': '',
-                                   'analyst': '',
-                                   'otherWS': current,
-                                   'setresultdiscrete': '',
-                                   'setresulton': 'original',
-                                   'setresultvalue': '',
-                                   'worksheettemplate': '70d48adfb34c4231a145f76a858e94cf',}],
-                      'conditions': [{'analysisservice': 'd802cdbf1f4742c094d45997b1038f9c',
-                                      'and_or': 'no',
-                                      'cond_row_idx': 0,
-                                      'discreteresult': '',
-                                      'range0': '12',
-                                      'range1': '12'}],
-                      'rulenumber': '1',
-                      'trigger': 'submit'},...],
-                   'method_id': '<method_uid>',
-                   'method_tile': '<method_tile>',
-                   'method_uid': '<method_uid>'
-                   }
+        rows = filter(lambda row: 'analysisservice' in row, rows)
+        return map(get_condition_row, rows, range(len(rows)))
+
+    def _get_sorted_actions_list(self, rows):
+        """
+        This returns a list of dictionaries with the actions got in the
+        rows. The rows with an action are the actions.
+        :rows: sorted list of dicts with the values of each row.
+        """
+        rows = filter(lambda row: 'action' in row, rows)
+        return map(get_action_row, rows, range(len(rows)))
+
+    def _format_json_set(self, document):
+        """
+        Returns a formatted set, like _format_conditions_and_actions does,
+        from a JSON document posted by the widget with the following format:
+        {'trigger': 'submit',
+         'conditions': [{'analysisservice': '<as_uid>', 'range0': '12',
+                         'range1': '12', 'discreteresult': '',
+                         'and_or': 'no'}, ...],
+         'actions': [{'action': 'repeat', 'otherWS': 'current', ...}, ...]}
+        The conditions and actions are kept in the order they come
+        """
+        # The rows with an analysis service field are the conditions and
+        # the ones with an action field are the actions, as in the form
+        conditions = filter(lambda row: 'analysisservice' in row,
+                            document.get('conditions') or [])
+        actions = filter(lambda row: 'action' in row,
+                         document.get('actions') or [])
+        return {
+            'trigger': document.get('trigger', ''),
+            'conditions': map(get_condition_row, conditions,
+                              range(len(conditions))),
+            'actions': map(get_action_row, actions, range(len(actions))),
         }
+
+    def _get_json_sets(self, form, field):
+        """
+        Returns the list of formatted sets from the JSON documents posted by
+        the widget, one per rule set, or None if there are no documents or
+        they are not valid
+        """
+        documents = form.get('%s_json' % field.getName())
+        if not documents:
+            return None
+        if isinstance(documents, basestring):
+            documents = [documents]
+        try:
+            documents = map(json.loads, documents)
+        except ValueError:
+            logger.warn('Not valid rule sets posted, using the form values')
+            return None
+        if not all(map(lambda doc: isinstance(doc, dict), documents)):
+            return None
+        # Rule sets without values are ignored, as the form does
+        documents = filter(is_filled_set, documents)
+        return map(self._format_json_set, documents)
+
+    def getSavedActions(self):
+        """
+        Returns a dict with the method and the rules saved in the object.
+        If the rules are paginated, only the rules rendered are returned,
+        together with the local ids of the rules before and after them
         """
-        relations = collections.OrderedDict()
-
-        # Get all worksheet templates
-        query = dict(portal_type="WorksheetTemplate", inactive_state="active",
-                     sort_on="sortable_title", sort_order="ascending")
-        ws_templates = api.search(query, "bika_setup_catalog")
-
-        # Get all services
-        query = dict(portal_type="AnalysisService",  inactive_state="active",
-                     sort_on="title", sort_order="ascending")
-        services = map(api.get_object, api.search(query, "bika_setup_catalog"))
-
-        # Getting all the methods from the system
-        query = dict(portal_type="Method", inactive_state="active",
-                     sort_on="sortable_title", sort_order="ascending")
-        for method in api.search(query, "bika_setup_catalog"):
-            method = api.get_object(method)
-            method_uid = api.get_uid(method)
-            method_services = filter(lambda s: method_uid in s.getMethodUIDs(),
-                                     services)
-            analysiservices = collections.OrderedDict()
-            for analysiservice in method_services:
-                # Getting the worksheet templates that could be used with the
-                # analysis, those worksheet templates are the ones without
-                # method and the ones with a method shared with the
-                # analysis service.
-                smuids = analysiservice.getMethodUIDs()
-                wst_brains = filter(lambda wst: api.get_uid(wst) in smuids,
-                                    ws_templates)
-                analysiservices[analysiservice.UID()] = {
-                    'as_id': analysiservice.getId(),
-                    'as_title': analysiservice.Title(),
-                    'resultoptions':
-                        analysiservice.getResultOptions()
-                        if analysiservice.getResultOptions()
-                        else [],
-                    'wstoptions': [
-                        (brain.UID, brain.Title) for brain in wst_brains]
-                }
-            # Make the json dict
-            relations[method.UID()] = {
-                'method_id': method.getId(),
-                'method_tile': method.Title(),
-                'analysisservices': analysiservices,
-                'as_keys': analysiservices.keys(),
-            }
-        # Get the data saved in the object
         reflex_rule = self.aq_parent.aq_inner
         saved_method = reflex_rule.getMethod()
-        relations['saved_actions'] = {
+        rules = self.getRenderingModel().rules
+        previous_ids = []
+        next_ids = []
+        window = self.getRulesWindow()
+        if window:
+            start, end = window
+            field = reflex_rule.getField('ReflexRules')
+            previous_ids = field.get_local_ids(reflex_rule, 1, start)
+            next_ids = field.get_local_ids(reflex_rule, end)
+        return {
             'method_uid': saved_method.UID() if
             saved_method else '',
             'method_id': saved_method.getId() if
             saved_method else '',
             'method_tile': saved_method.Title() if
             saved_method else '',
-            'rules': reflex_rule.getReflexRules(),
+            'rules': rules,
+            'previous_local_ids': previous_ids,
+            'next_local_ids': next_ids,
             }
-        return json.dumps(relations)
+
+    def getSavedActionsSetup(self):
+        """
+        Returns a json dict with the data saved in the object only. The
+        relations between methods and analysis services are fetched by the
+        widget from getReflexRuleSetupURL, so the browser can cache them
+        """
+        return json.dumps({'saved_actions': self.getSavedActions()})
+
+    def getReflexRuleSetupURL(self):
+        """
+        Returns the url of the JSON view with the relations between methods
+        and analysis services
+        """
+        folder = api.get_bika_setup().reflextesting_scenarios
+        return "{}/reflex_rule_setup.json".format(api.get_url(folder))
+
+    def getRuleSaveURL(self):
+        """
+        Returns the url of the view that saves a single rule set
+        """
+        instance = self.aq_parent.aq_inner
+        return "{}/reflex_rule_save".format(api.get_url(instance))
+
+    def getRulesCount(self):
+        """
+        Returns the number of rules saved in the object
+        """
+        instance = self.aq_parent.aq_inner
+        cache = get_transaction_cache(RENDER_CACHE)
+        key = "count:{}".format("/".join(instance.getPhysicalPath()))
+        if key not in cache:
+            field = instance.getField('ReflexRules')
+            cache[key] = field.get_rules_count(instance)
+        return cache[key]
+
+    def getRulesPageSize(self):
+        """
+        Returns the number of derivative rules rendered per page, or 0 if
+        all rules are rendered
+        """
+        size = get_registry_record('rules_page_size', 0)
+        return max(api.to_int(size, 0), 0)
+
+    def getRulesWindow(self):
+        """
+        Returns a tuple (start, end) with the rule numbers of the derivative
+        rules to render, taken from the 'rules_start' request parameter.
+        Returns None if all rules are rendered
+        """
+        size = self.getRulesPageSize()
+        if not size:
+            return None
+        count = self.getRulesCount()
+        start = api.to_int(api.get_request().get('rules_start'), 1)
+        start = min(max(start, 1), max(count - 1, 1))
+        return start, min(start + size, max(count, 1))
+
+    def getRenderedRuleNumbers(self):
+        """
+        Returns the list of rule numbers to render. The mother rule is always
+        rendered. The last rule number is for the extra rule set the widget
+        removes when loaded
+        """
+        window = self.getRulesWindow()
+        if window is None:
+            return range(self.getRulesCount() + 1)
+        start, end = window
+        return [0] + range(start, end) + [end]
+
+    def getViewRuleNumbers(self):
+        """
+        Returns the list of rule numbers to display in view mode, the ones
+        from the window only if the rules are paginated
+        """
+        window = self.getRulesWindow()
+        if window is None:
+            return range(self.getRulesCount())
+        start, end = window
+        return [0] + range(start, end)
+
+    def showAddRule(self):
+        """
+        Returns whether more rules can be added
+        """
+        field = self.aq_parent.aq_inner.getField('ReflexRules')
+        if field.fixedSize:
+            return False
+        return self.getRulesCount() < field.maximalSize
+
+    def getRulesPages(self):
+        """
+        Returns a list of dicts with the pages of derivative rules, or an
+        empty list if all rules are rendered
+        """
+        window = self.getRulesWindow()
+        if window is None:
+            return []
+        count = self.getRulesCount()
+        size = self.getRulesPageSize()
+        if count <= size + 1:
+            return []
+        return map(lambda start: {
+            'start': start,
+            'title': '#%s-%s' % (start, min(start + size, count) - 1),
+            'current': start == window[0],
+        }, range(1, count, size))
 
     def getActionVoc(self):
         """
@@ -463,11 +455,15 @@ class ReflexTestingRulesWidget(RecordsWidget):
     def getServicesDisplayList(self):
         """Returns the available analysis services
         """
-        query = dict(portal_type="AnalysisService", inactive_state="active",
-                     sort_on="title", sort_order="ascending")
-        items = api.search(query, "bika_setup_catalog")
-        items = map(lambda brain: (brain.UID, brain.Title), items)
-        return DisplayList(list(items))
+        cache = get_transaction_cache(RENDER_CACHE)
+        if "services" not in cache:
+            query = dict(portal_type="AnalysisService",
+                         inactive_state="active",
+                         sort_on="title", sort_order="ascending")
+            items = api.search(query, "bika_setup_catalog")
+            items = map(lambda brain: (brain.UID, brain.Title), items)
+            cache["services"] = DisplayList(list(items))
+        return cache["services"]
 
 
     def getTriggerVoc(self):
@@ -525,9 +521,9 @@ class ReflexTestingRulesWidget(RecordsWidget):
         - cond_row_idx: it is used to know the position numeber of the
         condition inside the list.
         """
-        rules_list = self.aq_parent.aq_inner.getReflexRules()
-        if len(rules_list) > idx:
-            value = rules_list[idx].get(element, '')
+        rule = self.getRenderingModel().get_rule(idx)
+        if rule is not None:
+            value = rule.get(element, '')
             if element == 'actions' and value == '':
                 return [{'action': '', 'act_row_idx': '0',
                          'otherWS': 'current', 'analyst': '',
@@ -568,8 +564,11 @@ class ReflexTestingRulesWidget(RecordsWidget):
             set_idx = int(set_idx)
         if isinstance(row_idx, str):
             row_idx = int(row_idx)
+        row = self.getRenderingModel().get_row(set_idx, 'actions', row_idx)
+        if row is not None:
+            return row.get(element, '')
         actions = self.getReflexRuleElement(idx=set_idx, element='actions')
-        return actions[row_idx].get(element, '')
+        return to_form_value(actions[row_idx].get(element, ''))
 
     def getReflexRuleConditionElement(self, set_idx=0, row_idx=0, element=''):
         """
@@ -585,15 +584,138 @@ class ReflexTestingRulesWidget(RecordsWidget):
             set_idx = int(set_idx)
         if isinstance(row_idx, str):
             row_idx = int(row_idx)
+        row = self.getRenderingModel().get_row(
+            set_idx, 'conditions', row_idx)
+        if row is not None:
+            return row.get(element, '')
         cond = self.getReflexRuleElement(idx=set_idx, element='conditions')
-        return cond[row_idx].get(element, '')
+        return to_form_value(cond[row_idx].get(element, ''))
 
     def getAnalysts(self):
         """
         This function returns a displaylist with the available analysts
         """
-        analysts = getUsers(self, ['Manager', 'LabManager', 'Analyst'])
-        return analysts.sortedByKey()
+        cache = get_transaction_cache(RENDER_CACHE)
+        if "analysts" not in cache:
+            analysts = getUsers(self, ['Manager', 'LabManager', 'Analyst'])
+            cache["analysts"] = analysts.sortedByKey()
+        return cache["analysts"]
+
+    def getRenderingModel(self):
+        """
+        Returns the RenderingModel with the rules saved in the object. The
+        rules are only read once per request. If the rules are paginated,
+        only the mother rule and the rules from the window are read
+        """
+        instance = self.aq_parent.aq_inner
+        cache = get_transaction_cache(RENDER_CACHE)
+        key = "/".join(instance.getPhysicalPath())
+        model = cache.get(key)
+        if model is None:
+            window = self.getRulesWindow()
+            if window is None:
+                rules = instance.getReflexRules()
+            else:
+                field = instance.getField('ReflexRules')
+                rulenumbers = [0] + range(*window)
+                rules = filter(None, map(
+                    lambda num: field.get_rule(instance, num), rulenumbers))
+            model = RenderingModel(rules)
+            cache[key] = model
+        return model
+
+
+def is_filled_set(document):
+    """Returns whether the JSON document of a rule set passed in has any
+    condition with an analysis service or any action selected
+    """
+    conditions = document.get('conditions') or []
+    actions = document.get('actions') or []
+    return any(map(lambda row: row.get('analysisservice'), conditions)) or \
+        any(map(lambda row: row.get('action'), actions))
+
+
+def get_condition_row(values, position):
+    """Returns the condition to be saved from the values of a condition row
+    :param values: dict with the values of the row
+    :param position: the position of the row in the rule set
+    """
+    return {
+        'analysisservice': values.get('analysisservice', ''),
+        'cond_row_idx': position,
+        'range0': values.get('range0', ''),
+        'range1': values.get('range1', ''),
+        'discreteresult': values.get('discreteresult', ''),
+        'and_or': values.get('and_or', ''),
+        }
+
+
+def get_action_row(values, position):
+    """Returns the action to be saved from the values of an action row
+    :param values: dict with the values of the row
+    :param position: the position of the row in the rule set
+    """
+    return {
+        'action': values.get('action', ''),
+        'act_row_idx': position,
+        'otherWS': values.get('otherWS', ''),
+        'worksheettemplate': values.get('worksheettemplate', ''),
+        'analyst': values.get('analyst', ''),
+        'setresulton': values.get('setresulton', ''),
+        'setresultdiscrete': values.get('setresultdiscrete', ''),
+        'setresultvalue': values.get('setresultvalue', ''),
+        'an_result_id': values.get('an_result_id', ''),
+        'showinreport': values.get('showinreport', ''),
+        'setvisibilityof': values.get('setvisibilityof', ''),
+        'new_analysis': values.get('new_analysis', ''),
+        }
+
+
+class RenderingModel(object):
+    """Rules of a scenario read once, with the values of the condition and
+    action rows indexed by (set, element, row), already converted to form
+    values, so the widget accessors answer in constant time
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        # rule number -> rule
+        self.by_number = {}
+        # (set_idx, element, row_idx) -> {name: form value}
+        self.rows = {}
+        for position, rule in enumerate(rules):
+            set_idx = api.to_int(rule.get('rulenumber'), position)
+            self.by_number[set_idx] = rule
+            for element in ('conditions', 'actions'):
+                for row_idx, row in enumerate(rule.get(element) or []):
+                    self.rows[(set_idx, element, row_idx)] = dict(map(
+                        lambda item: (item[0], to_form_value(item[1])),
+                        row.items()))
+
+    def get_rule(self, set_idx):
+        """Returns the rule with the rule number passed in, or None if the
+        rule is not saved or was not read
+        """
+        return self.by_number.get(set_idx)
+
+    def get_row(self, set_idx, element, row_idx):
+        """Returns a dict with the form values of the row passed in, or None
+        if the row is not saved
+        """
+        return self.rows.get((set_idx, element, row_idx))
+
+
+def to_form_value(value):
+    """Returns the stored value passed in as a string suitable for a form
+    input. Rules are stored with typed values, e.g. ranges as floats
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return value
 
 
 registerWidget(
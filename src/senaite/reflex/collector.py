@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from collections import OrderedDict
+
+import transaction
+from bika.lims import api
+from senaite.reflex.compiler import get_compiled_rules
+from senaite.reflex.monkeys.content.reflexrule import prefetch_derivatives
+from senaite.reflex.utils import get_transaction_cache
+
+
+class ReflexCollector(object):
+    """Request-scoped queue of the analyses for which the reflex rules have
+    to be evaluated, grouped by sample and method.
+
+    Evaluation is deferred until the transaction is about to be committed,
+    so bulk submits (e.g. a whole worksheet) evaluate each analysis once,
+    with the lookups of the same sample and method done together
+    """
+
+    def __init__(self):
+        # (sample_uid, method_uid) -> OrderedDict((uid, trigger) -> analysis)
+        self._groups = OrderedDict()
+        # Reflex Testing Scenarios resolved while processing, keyed by UID
+        self.scenarios = {}
+        # Whether the before-commit hook has been registered already
+        self.registered = False
+
+    def __len__(self):
+        return sum(map(len, self._groups.values()))
+
+    def add(self, analysis, wf_action):
+        """Enqueues the analysis passed in for the workflow action. Returns
+        False if the analysis is already waiting for the same action
+        """
+        key = (analysis.getRequestUID(), analysis.getRawMethod())
+        entries = self._groups.setdefault(key, OrderedDict())
+        entry = (api.get_uid(analysis), wf_action)
+        if entry in entries:
+            return False
+        entries[entry] = analysis
+        return True
+
+    def pop_group(self):
+        """Removes and returns the first group of enqueued analyses, as a
+        ReflexGroup. Returns None if empty
+        """
+        if not self._groups:
+            return None
+        key = self._groups.keys()[0]
+        entries = self._groups.pop(key)
+        return ReflexGroup(
+            map(lambda item: (item[1], item[0][1]), entries.items()))
+
+
+class ReflexGroup(object):
+    """Enqueued analyses of the same sample and method, evaluated together.
+
+    The lookups are shared by the whole group: the derivatives of all their
+    reflex chains are searched at once and the compiled rules of each Reflex
+    Testing Scenario are resolved once. Actions are not applied twice to the
+    same analysis, as recorded by set_applied when applied
+    """
+
+    def __init__(self, entries):
+        # list of tuples (analysis, wf_action)
+        self.entries = entries
+        # scenario uid -> {rulenumber: Rule or None}
+        self._rules = {}
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def prefetch(self):
+        """Searches the derivatives of the reflex chains of all the analyses
+        of the group with a single catalog search
+        """
+        original_uids = map(
+            lambda entry: entry[0].getRawOriginalReflexedAnalysis(),
+            self.entries)
+        prefetch_derivatives(filter(None, original_uids))
+
+    def get_rules(self, scenario, rulenumbers):
+        """Returns the compiled rules of the scenario with the rule numbers
+        passed in, sorted by rule number. Rules are only resolved the first
+        time they are requested by an analysis of the group
+        """
+        rules = self._rules.setdefault(api.get_uid(scenario), {})
+        missing = filter(lambda num: num not in rules, rulenumbers)
+        if missing:
+            rules.update(dict.fromkeys(missing))
+            for rule in get_compiled_rules(scenario, rulenumbers=missing):
+                rules[rule.rulenumber] = rule
+        rulenumbers = sorted(set(rulenumbers),
+                             key=lambda num: api.to_int(num, 0))
+        return tuple(filter(None, map(rules.get, rulenumbers)))
+
+
+def get_collector():
+    """Returns the collector of the current request and transaction, or None
+    if there is no request to bind the collector to
+    """
+    if api.get_request() is None:
+        return None
+    cache = get_transaction_cache("collector")
+    collector = cache.get("collector")
+    if collector is None:
+        collector = ReflexCollector()
+        cache["collector"] = collector
+    return collector
+
+
+def enqueue(analysis, wf_action, handler):
+    """Enqueues the analysis for the evaluation of its reflex rules before
+    the current transaction is committed. Returns False if the analysis
+    cannot be enqueued and has to be processed right away
+    :param handler: the function that processes the collector on commit
+    """
+    collector = get_collector()
+    if collector is None:
+        return False
+    collector.add(analysis, wf_action)
+    if not collector.registered:
+        transaction.get().addBeforeCommitHook(handler, (collector,))
+        collector.registered = True
+    return True
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from collections import Mapping
+from collections import namedtuple
+
+from bika.lims import api
+from senaite.reflex.metrics import inc
+
+# Process-wide cache of compiled rules, keyed by scenario UID. Each value is a
+# tuple (p_mtime, rules), so the entry is discarded as soon as the scenario is
+# committed again. Only used for rules not yet migrated to records
+_RULES_CACHE = {}
+
+# Process-wide cache of compiled rules, keyed by the oid of their record. Each
+# value is a tuple (p_mtime, mother service UID, rule)
+_RECORDS_CACHE = {}
+
+
+class Condition(namedtuple("Condition", ["target", "discrete", "expected",
+                                         "low", "high", "operator"])):
+    """Immutable and pre-parsed condition row of a reflex rule.
+
+    :target: the service UID or the local id (e.g 'dup-2') of the analysis
+        the condition applies to
+    :discrete: whether the result has to be compared against the expected
+        discrete result instead of the range
+    :expected: the expected discrete result, as stored
+    :low: the lower bound of the expected range as float or None
+    :high: the upper bound of the expected range as float or None
+    :operator: the operator ('and', 'or', 'no') that joins this condition
+        with the next one
+    """
+    __slots__ = ()
+
+    def matches(self, result):
+        """Returns whether the result passed in satisfies this condition
+        :param result: the result of the analysis, as stored
+        """
+        if not api.is_floatable(result):
+            return False
+        if self.discrete:
+            return self.expected == result
+        if self.low is None or self.high is None:
+            return False
+        return self.low <= float(result) <= self.high
+
+
+class Rule(namedtuple("Rule", ["rulenumber", "trigger", "mother_service_uid",
+                               "conditions", "groups", "targets",
+                               "actions"])):
+    """Immutable predicate tree of a set of conditions and actions.
+
+    :groups: tuple of tuples with the positions of the conditions. The rule
+        is met when all the conditions of any of the groups are met, what
+        mimics the precedence of 'and' over 'or' in Python
+    :targets: frozenset with the targets of all conditions
+    :actions: tuple with read-only views of the stored action rows
+    """
+    __slots__ = ()
+
+    def evaluate(self, resolutions):
+        """Returns whether the rule is met for the resolutions of its
+        conditions, sorted in the same order as the conditions
+        """
+        return any(all(resolutions[pos] for pos in group)
+                   for group in self.groups)
+
+    def get_action_results(self, rulename, scenario_uid=None):
+        """Returns a tuple of ActionResult, one for each action of the rule
+        :param rulename: the name of the rule, usually the title of the
+            Reflex Testing Scenario the rule belongs to
+        :param scenario_uid: the UID of the scenario the rule belongs to
+        """
+        # Actions from action sets without rule number are reported as
+        # coming from the rule number '0', the markers keep it empty though
+        rulenumber = self.rulenumber or "0"
+        return tuple(map(
+            lambda action: ActionResult(action, rulenumber, rulename,
+                                        scenario_uid=scenario_uid),
+            self.actions))
+
+
+class FrozenMapping(Mapping):
+    """Read-only view of a dict, e.g. an action row as stored in the
+    ReflexRules field. The dict is not copied, but cannot be modified through
+    the view
+    """
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__, self._data)
+
+
+class ActionResult(FrozenMapping):
+    """Read-only view of an action row of a rule that has been met, that
+    also provides the number ('rulenumber') and the name ('rulename') of the
+    rule the action belongs to and the UID of its scenario ('scenario_uid'),
+    without modifying the stored action
+    """
+    __slots__ = ("_extra",)
+
+    def __init__(self, action, rulenumber, rulename, scenario_uid=None):
+        super(ActionResult, self).__init__(action)
+        self._extra = {"rulenumber": rulenumber, "rulename": rulename}
+        if scenario_uid:
+            self._extra["scenario_uid"] = scenario_uid
+
+    def __getitem__(self, key):
+        if key in self._extra:
+            return self._extra[key]
+        return self._data[key]
+
+    def __iter__(self):
+        for key in self._data:
+            if key not in self._extra:
+                yield key
+        for key in self._extra:
+            yield key
+
+    def __len__(self):
+        return len(set(self._data).union(self._extra))
+
+
+def to_float(value):
+    """Returns the value as float or None if not floatable
+    """
+    if not api.is_floatable(value):
+        return None
+    return float(value)
+
+
+def compile_condition(condition):
+    """Returns a Condition from the condition dict passed in. Ranges and the
+    discrete flag are only worked out for conditions not stored in a
+    normalized format yet.
+
+    Unlike the former evaluation, that compared against the discrete result
+    if the analysis had result options and against the range otherwise, the
+    comparison is chosen from the stored 'discrete' flag only. The flag of
+    the conditions stored before is set on upgrade from the result options
+    of the service of their rules (see upgrade.v01_01_000)
+    """
+    low = condition.get("range0")
+    if not isinstance(low, float):
+        low = to_float(low)
+    high = condition.get("range1")
+    if not isinstance(high, float):
+        high = to_float(high)
+    expected = condition.get("discreteresult") or ""
+    discrete = condition.get("discrete")
+    if discrete is None:
+        discrete = bool(expected)
+    return Condition(
+        target=condition.get("analysisservice", ""),
+        discrete=discrete,
+        expected=expected,
+        low=low,
+        high=high,
+        operator=condition.get("and_or", ""))
+
+
+def compile_groups(conditions):
+    """Returns the positions of the conditions grouped by 'or' operators
+    """
+    groups = []
+    group = []
+    for pos, condition in enumerate(conditions):
+        group.append(pos)
+        if condition.operator == "or":
+            groups.append(tuple(group))
+            group = []
+    if group:
+        groups.append(tuple(group))
+    return tuple(groups)
+
+
+def compile_rule(action_set, mother_service_uid=None):
+    """Returns a Rule from the action set dict passed in, as stored in
+    ReflexTestingScenario's ReflexRules field
+    :param mother_service_uid: the UID of the service the rule is bound to,
+        if not stored in the action set
+    """
+    conditions = tuple(map(compile_condition,
+                           action_set.get("conditions", [])))
+    if mother_service_uid is None:
+        mother_service_uid = action_set.get("mother_service_uid", "")
+    return Rule(
+        rulenumber=str(action_set.get("rulenumber", "")),
+        trigger=action_set.get("trigger", ""),
+        mother_service_uid=mother_service_uid,
+        conditions=conditions,
+        groups=compile_groups(conditions),
+        targets=frozenset(map(lambda cond: cond.target, conditions)),
+        actions=tuple(map(FrozenMapping, action_set.get("actions", []))))
+
+
+def compile_rules(scenario):
+    """Returns a tuple with the compiled rules of the scenario passed in
+    """
+    return tuple(map(compile_rule, scenario.getReflexRules()))
+
+
+def get_compiled_rules(scenario, rulenumbers=None):
+    """Returns the compiled rules of the scenario passed in. Compiled rules
+    are cached until the rules get modified.
+    :param rulenumbers: if set, only the rules with these rule numbers are
+        returned, without loading the rest
+    """
+    field = scenario.getField("ReflexRules")
+    records = field.get_records(scenario)
+    if records is None:
+        # Rules not migrated to records yet
+        rules = get_compiled_scenario(scenario)
+        if rulenumbers is not None:
+            rules = filter(lambda rule: rule.rulenumber in rulenumbers, rules)
+        return rules
+
+    if rulenumbers is None:
+        selected = records.values()
+    else:
+        keys = sorted(set(map(lambda num: api.to_int(num, None),
+                              rulenumbers)))
+        selected = filter(None, map(records.get, keys))
+    mother_service_uid = field.get_mother_service_uid(scenario)
+    return tuple(map(lambda record: get_compiled_record(
+        record, mother_service_uid), selected))
+
+
+def get_compiled_record(record, mother_service_uid):
+    """Returns the compiled rule of the ReflexRuleRecord passed in, bound to
+    the service passed in. The result is cached until the record or the
+    service get modified
+    """
+    # Wake up the record, ghosts do not have a modification time
+    record._p_activate()
+    mtime = record._p_mtime
+    if mtime is None or record._p_changed:
+        # Not yet committed or with uncommitted changes
+        return compile_rule(record.rule, mother_service_uid)
+
+    oid = record._p_oid
+    cached = _RECORDS_CACHE.get(oid)
+    if cached and cached[:2] == (mtime, mother_service_uid):
+        inc("reflex_cache_requests_total", cache="rules", result="hit")
+        return cached[2]
+
+    inc("reflex_cache_requests_total", cache="rules", result="miss")
+    rule = compile_rule(record.rule, mother_service_uid)
+    _RECORDS_CACHE[oid] = (mtime, mother_service_uid, rule)
+    return rule
+
+
+def get_compiled_scenario(scenario):
+    """Returns the compiled rules of the scenario passed in, with the rules
+    stored in a single list. The result is cached until the scenario gets
+    modified
+    """
+    mtime = scenario._p_mtime
+    if mtime is None or scenario._p_changed:
+        # Not yet committed or with uncommitted changes
+        return compile_rules(scenario)
+
+    uid = api.get_uid(scenario)
+    cached = _RULES_CACHE.get(uid)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    rules = compile_rules(scenario)
+    _RULES_CACHE[uid] = (mtime, rules)
+    return rules
+
+
+def invalidate(scenario=None):
+    """Removes the compiled rules of the scenario passed in from the cache,
+    or flushes the whole cache if no scenario is passed in
+    """
+    if scenario is None:
+        _RULES_CACHE.clear()
+        _RECORDS_CACHE.clear()
+        return
+
+    _RULES_CACHE.pop(api.get_uid(scenario), None)
+    records = scenario.getField("ReflexRules").get_records(scenario)
+    for record in (records or {}).values():
+        _RECORDS_CACHE.pop(record._p_oid, None)
@@ -14,16 +14,24 @@ from Products.Archetypes.public import ReferenceField
 from Products.Archetypes.public import Schema
 from Products.Archetypes.public import SelectionWidget
 from Products.Archetypes.references import HoldingReference
-from Products.CMFCore.utils import getToolByName
 from bika.lims import api
-from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
 from bika.lims.content.bikaschema import BikaSchema
 from senaite.reflex import senaiteMessageFactory as _
 from senaite.reflex.browser.fields import ReflexTestingRulesField
+from senaite.reflex.compiler import Rule
+from senaite.reflex.compiler import compile_rule
+from senaite.reflex.compiler import get_compiled_rules
 from senaite.reflex.config import PRODUCT_NAME
 from senaite.reflex.interfaces import IReflexTestingScenario
+from senaite.reflex.markers import is_triggered
+from senaite.reflex.metrics import inc
+from senaite.reflex.metrics import timed
 from senaite.reflex.monkeys.content.reflexrule import \
     _fetch_analysis_for_local_id
+from senaite.reflex.monkeys.content.reflexrule import \
+    _fetch_brain_for_local_id
+from senaite.reflex.utils import get_metadata
+from senaite.reflex.utils import get_registry_record
 from zope.interface import implements
 
 schema = BikaSchema.copy() + Schema((
@@ -79,6 +87,14 @@ class ReflexTestingScenario(BaseContent):
         items.sort(lambda x, y: cmp(x[1], y[1]))
         return DisplayList(list(items))
 
+    @security.public
+    def getReflexRule(self, rulenumber, default=None):
+        """Returns the set of conditions and actions with the rule number
+        passed in, without loading the rest of rules
+        """
+        field = self.getField("ReflexRules")
+        return field.get_rule(self, rulenumber, default=default)
+
     @security.private
     def _areConditionsMet(self, action_set, analysis, forceuid=False):
         """
@@ -86,7 +102,8 @@ class ReflexTestingScenario(BaseContent):
         action_set are met, and returns False otherwise.
         :analysis: the analysis full object which we want to obtain the
             rules for.
-        :action_set: a set of rules and actions as a dictionary.
+        :action_set: a compiled Rule or a set of rules and actions as a
+            dictionary.
             {'actions': [{'act_row_idx': 0,
                 'action': 'setresult',
                 'an_result_id': 'set-4',
@@ -115,16 +132,13 @@ class ReflexTestingScenario(BaseContent):
         analysis even if the analysis has been reflected and has a local_id.
         :returns: a Boolean.
         """
-        conditions = action_set.get('conditions', [])
-        eval_str = ''
+        rule = action_set
+        if not isinstance(rule, Rule):
+            rule = compile_rule(action_set)
         # Getting the analysis local id or its uid instead
+        is_reflex = analysis.getIsReflexAnalysis()
         alocalid = analysis.getReflexRuleLocalID() if \
-            analysis.getIsReflexAnalysis() and not forceuid else analysis.getServiceUID()
-        # Getting the local ids (or analysis service uid) from the condition
-        # with the same local id (or analysis service uid) as the analysis
-        # attribute
-        localids = [cond.get('analysisservice') for cond in conditions
-                    if cond.get('analysisservice', '') == alocalid]
+            is_reflex and not forceuid else analysis.getServiceUID()
         # Now the alocalid could be the UID of the analysis service (if
         # this analysis has not been crated by a previous reflex rule) or it
         # could be a local_id if the analysis has been created by a reflex
@@ -133,104 +147,67 @@ class ReflexTestingScenario(BaseContent):
         # inside the action_set matching the analysis localid, lets look for
         # the analysis service UID.
         # forceuid is True when this second query has been done.
-        if not localids and not forceuid and analysis.getIsReflexAnalysis():
-            return self._areConditionsMet(action_set, analysis, forceuid=True)
-        # action_set will not have any action for this analysis
-        elif not localids:
+        if alocalid not in rule.targets:
+            if not forceuid and is_reflex:
+                return self._areConditionsMet(rule, analysis, forceuid=True)
+            # action_set will not have any action for this analysis
             return False
-        # Getting the action_set.rulenumber in order to check the
-        # analysis.ReflexRuleActionsTriggered
-        rulenumber = action_set.get('rulenumber', '')
-        # Getting the reflex rules uid in order to fill the
-        # analysis.ReflexRuleActionsTriggered attribute later
-        rr_uid = self.UID()
-        # Building the possible analysis.ReflexRuleActionsTriggered
-        rr_actions_triggered = '.'.join([rr_uid, rulenumber])
+        # Building the possible analysis.ReflexRuleActionsTriggered with the
+        # reflex rules uid and the action_set.rulenumber
+        rr_actions_triggered = '.'.join([self.UID(), rule.rulenumber])
         # If the follow condition is met, it means that the action_set for this
         # analysis has already been done by any other analysis from the
         # action_set. (e.g analsys.local_id =='dup-2', but this action has been
         # ran by the analysis with local_id=='dup-1', so we do not have to
-        # run it again)
-        if rr_actions_triggered in\
-                analysis.getReflexRuleActionsTriggered().split('|'):
-            return False
-        # Check that rules are not repited: lets supose that some conditions
-        # are met and an analysis with id analysis-1 is reflexed using a
-        # duplicate action. Now we have analysis-1 and analysis1-dup. If the
-        # same conditions are met while submitting/verifying analysis1-dup, the
-        # duplicated shouldn't trigger the reflex action again.
-        if forceuid and analysis.IsReflexAnalysis and rr_actions_triggered in\
-                analysis.getReflexRuleActionsTriggered().split('|'):
+        # run it again). This also prevents the duplicate of a reflexed
+        # analysis from triggering the same reflex action again.
+        if is_triggered(analysis, rr_actions_triggered):
             return False
+        # Whether the analyses related to the conditions can be resolved as
+        # catalog brains, so they are only woken up if the conditions are met
+        from_catalog = get_registry_record("catalog_evaluation", False)
         # To save the analysis related in the same action_set
         ans_related_to_set = []
-        for condition in conditions:
-            # analysisservice can be either a service uid (if it is the first
+        resolutions = []
+        for condition in rule.conditions:
+            # target can be either a service uid (if it is the first
             # condition in the reflex rule) or it could be a local id such
             # as 'dup-2' if the analysis_set belongs to a derivate rule.
-            ans_cond = condition.get('analysisservice', '')
-            ans_uid_cond = action_set.get('mother_service_uid', '')
-            # Be aware that we already know that the local_id for 'analysis'
-            # has been found inside the conditions for this action_set
-            if ans_cond != alocalid:
-                # If the 'analysisservice' item from the condition is not the
-                # same as the local_id from the analysis, the system
-                # should look for the possible analysis with this localid
-                # (e.g dup-2) and get its analysis object in order to compare
-                # the results of the 'analysis variable' with the analysis
-                # object obtained here
-                curranalysis = _fetch_analysis_for_local_id(
-                    analysis, ans_cond)
+            if condition.target != alocalid:
+                # If the target from the condition is not the same as the
+                # local_id from the analysis, the system should look for the
+                # possible analysis with this localid (e.g dup-2) in order to
+                # compare its results
+                if from_catalog:
+                    curranalysis = _fetch_brain_for_local_id(
+                        analysis, condition.target)
+                else:
+                    curranalysis = _fetch_analysis_for_local_id(
+                        analysis, condition.target)
                 if not curranalysis:
                     # Condition not met!. Analysis to compare with does not
                     # exist yet.
                     return False
             else:
-                # if the local_id of the 'analysis' is the same as the
-                # local_id in the condition, we will use it as the current
-                # analysis
                 curranalysis = analysis
-            if not curranalysis:
-                continue
             ans_related_to_set.append(curranalysis)
-            # the value of the analysis' result as string
-            result = curranalysis.getResult()
-            if len(analysis.getResultOptions()) > 0:
-                # Discrete result as expacted value
-                exp_val = condition.get('discreteresult', '')
-            else:
-                exp_val = (
-                    condition.get('range0', ''),
-                    condition.get('range1', '')
-                    )
-            and_or = condition.get('and_or', '')
-            service_uid = curranalysis.getServiceUID()
+            # Resolve the condition
+            service_uid = get_metadata(curranalysis, "getServiceUID")
+            result = get_metadata(curranalysis, "getResult")
+            resolutions.append(
+                rule.mother_service_uid == service_uid and
+                condition.matches(result))
 
-            # Resolve the conditions
-            resolution = \
-                ans_uid_cond == service_uid and\
-                ((api.is_floatable(result) and isinstance(exp_val, str) and
-                    exp_val == result) or
-                    (api.is_floatable(result) and
-                     len(exp_val) == 2 and
-                     api.is_floatable(exp_val[0]) and
-                     api.is_floatable(exp_val[1]) and
-                        float(exp_val[0]) <= float(result) and
-                        float(result) <= float(exp_val[1])))
-            # Build a string and then use eval()
-            if and_or == 'no':
-                eval_str += str(resolution)
-            else:
-                eval_str += str(resolution) + ' ' + and_or + ' '
-        if eval_str and eval(eval_str):
-            for an in ans_related_to_set:
-                an.addReflexRuleActionsTriggered(rr_actions_triggered)
-            return True
-        else:
+        if not rule.evaluate(resolutions):
             return False
+        for an in ans_related_to_set:
+            an = api.get_object(an)
+            an.addReflexRuleActionsTriggered(rr_actions_triggered)
+        return True
 
     @security.public
-    def getActionReflexRules(self, analysis, wf_action):
+    def getActionReflexRules(self, analysis, wf_action, rulenumbers=None,
+                             rules=None):
         """
         This function returns a list of dictionaries with the rules to be done
         for the analysis service.
@@ -238,29 +215,33 @@ class ReflexTestingScenario(BaseContent):
             rules for.
         :wf_action: it is the workflow action that the analysis is doing, we
             have to act in consideration of the action_set 'trigger' variable
-        :returns: [{'action': 'duplicate', ...}, {,}, ...]
+        :rulenumbers: if set, only the action sets with these rule numbers
+            are evaluated
+        :rules: if set, the compiled rules to evaluate, already resolved
+            from this scenario
+        :returns: [{'action': 'duplicate', ...}, {,}, ...], as read-only
+            ActionResult mappings that also provide the 'rulenumber' and
+            'rulename' of the action set they belong to and the
+            'scenario_uid' of this scenario
         """
-        # Setting up the analyses catalog
-        self.analyses_catalog = getToolByName(self, CATALOG_ANALYSIS_LISTING)
-        # Getting the action sets, those that contain action rows
-        action_sets = self.getReflexRules()
+        if rules is None:
+            rules = get_compiled_rules(self, rulenumbers=rulenumbers)
         rules_list = []
-        condition = False
-        for action_set in action_sets:
+        for rule in rules:
             # Validate the trigger
-            if action_set.get('trigger', '') == wf_action:
-                # Getting the conditions resolution
-                condition = self._areConditionsMet(action_set, analysis)
-                if condition:
-                    actions = action_set.get('actions', [])
-                    for act in actions:
-                        # Adding the rule number inside each action row because
-                        # need to get the rule number from a row action later.
-                        # we will need to get the rule number from a row
-                        # action later.
-                        act['rulenumber'] = action_set.get('rulenumber', '0')
-                        act['rulename'] = self.Title()
-                        rules_list.append(act)
+            if rule.trigger != wf_action:
+                continue
+            # Getting the conditions resolution
+            with timed("reflex_conditions_seconds"):
+                met = self._areConditionsMet(rule, analysis)
+            inc("reflex_evaluations_total")
+            if not met:
+                continue
+            inc("reflex_matches_total")
+            # The rule number is needed later to tell the action set an
+            # action row comes from. Stored actions are never modified
+            rules_list.extend(rule.get_action_results(
+                self.Title(), scenario_uid=self.UID()))
         return rules_list
 
 atapi.registerType(ReflexTestingScenario, PRODUCT_NAME)
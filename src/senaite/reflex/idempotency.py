@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from BTrees.OOBTree import OOTreeSet
+from bika.lims import api
+from zope.annotation.interfaces import IAnnotations
+
+# Annotation key of the keys of the actions applied to the analyses of a
+# sample
+APPLIED_ACTIONS_KEY = "senaite.reflex.applied_actions"
+
+
+def get_action_key(source_analysis, action):
+    """Returns the idempotency key of the action passed in when applied to
+    the source analysis, as a tuple (scenario UID, rule number, action row,
+    source analysis UID). Returns None if the action does not tell the
+    scenario and rule it comes from
+    """
+    scenario_uid = action.get("scenario_uid")
+    rulenumber = action.get("rulenumber")
+    if not scenario_uid or rulenumber in (None, ""):
+        return None
+    return (scenario_uid, str(rulenumber),
+            api.to_int(action.get("act_row_idx"), 0),
+            api.get_uid(source_analysis))
+
+
+def get_applied_actions(analysis, create=False):
+    """Returns the OOTreeSet with the keys of the actions applied to the
+    analyses of the sample the analysis passed in belongs to. Returns None if
+    the set does not exist and create is False
+    """
+    annotations = IAnnotations(api.get_parent(analysis))
+    applied = annotations.get(APPLIED_ACTIONS_KEY)
+    if applied is None and create:
+        applied = OOTreeSet()
+        annotations[APPLIED_ACTIONS_KEY] = applied
+    return applied
+
+
+def is_applied(source_analysis, action):
+    """Returns whether the action has been applied to the source analysis
+    already
+    """
+    key = get_action_key(source_analysis, action)
+    if key is None:
+        return False
+    applied = get_applied_actions(source_analysis)
+    return applied is not None and key in applied
+
+
+def set_applied(source_analysis, action):
+    """Records the action as applied to the source analysis. Returns False if
+    it was already recorded.
+
+    The key is recorded in the same transaction the action is applied, so
+    both are undone together if the transaction is aborted. Two concurrent
+    transactions recording the same key raise a ConflictError, so only one
+    of them succeeds and the other one sees the key when retried
+    """
+    key = get_action_key(source_analysis, action)
+    if key is None:
+        return True
+    applied = get_applied_actions(source_analysis, create=True)
+    return bool(applied.insert(key))
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from collections import OrderedDict
+
+from BTrees.OOBTree import OOBTree
+from bika.lims import api
+from persistent import Persistent
+from senaite.reflex import logger
+from zope.annotation.interfaces import IAnnotations
+
+# Annotation key of the dispatch index in Reflex Testing Scenarios folder
+DISPATCH_INDEX_KEY = "senaite.reflex.dispatch_index"
+
+# Process-wide copy of the service and method UIDs bound to active rules,
+# keyed by the oid of the dispatch index. Each value is a tuple
+# (generation, service_uids, method_uids)
+_BOUND_UIDS = {}
+
+
+class DispatchIndex(Persistent):
+    """Persistent lookup of the rules from active Reflex Testing Scenarios,
+    keyed by (method UID, service UID or local id, trigger).
+
+    Values are tuples of (scenario UID, rule number), so only the rules that
+    could apply to an analysis are evaluated on dispatch
+    """
+
+    # Incremented on every change, so processes can tell their in-memory
+    # copies of the index are outdated
+    _generation = 0
+
+    def __init__(self):
+        # (method_uid, target, trigger) -> ((scenario_uid, rulenumber), ...)
+        self._index = OOBTree()
+        # scenario_uid -> ((method_uid, target, trigger), ...)
+        self._keys = OOBTree()
+
+    def index_scenario(self, scenario):
+        """Indexes the rules of the scenario passed in. Rules from inactive
+        scenarios or without a method assigned are not indexed
+        """
+        self.unindex_scenario(scenario)
+        if not api.is_active(scenario):
+            return
+        method_uid = scenario.getRawMethod()
+        if not method_uid:
+            return
+
+        scenario_uid = api.get_uid(scenario)
+        keys = []
+        for rule in scenario.getReflexRules():
+            self._index_rule(scenario_uid, method_uid, rule, keys)
+        if keys:
+            self._keys[scenario_uid] = tuple(keys)
+            self._generation += 1
+
+    def index_rules(self, scenario, rulenumbers):
+        """Updates the entries of the rules with the rule numbers passed in
+        only, without loading the rest of rules of the scenario. Rules that
+        no longer exist are removed from the index. The whole scenario is
+        indexed again if it was not indexed yet or its method changed
+        """
+        scenario_uid = api.get_uid(scenario)
+        method_uid = scenario.getRawMethod()
+        keys = self._keys.get(scenario_uid)
+        if not keys or not api.is_active(scenario) or \
+                any(map(lambda key: key[0] != method_uid, keys)):
+            return self.index_scenario(scenario)
+        rulenumbers = set(map(str, rulenumbers))
+        if not rulenumbers:
+            return
+
+        # Remove the entries of the rules
+        for key in keys:
+            values = filter(lambda entry: entry[0] != scenario_uid or
+                            entry[1] not in rulenumbers,
+                            self._index.get(key, ()))
+            if values:
+                self._index[key] = tuple(values)
+            elif key in self._index:
+                del self._index[key]
+
+        # Add the entries of the rules as they are now
+        keys = list(keys)
+        field = scenario.getField("ReflexRules")
+        for rulenumber in sorted(rulenumbers, key=api.to_int):
+            rule = field.get_rule(scenario, rulenumber)
+            if rule is not None:
+                self._index_rule(scenario_uid, method_uid, rule, keys)
+
+        # Keep the keys that still have entries of the scenario
+        keys = filter(lambda key: any(map(
+            lambda entry: entry[0] == scenario_uid,
+            self._index.get(key, ()))), keys)
+        if keys:
+            self._keys[scenario_uid] = tuple(keys)
+        else:
+            del self._keys[scenario_uid]
+        self._generation += 1
+
+    def _index_rule(self, scenario_uid, method_uid, rule, keys):
+        """Adds the entries of the rule passed in to the index. The keys
+        the rule is indexed with are appended to the list of keys passed in
+        """
+        rulenumber = str(rule.get("rulenumber", ""))
+        trigger = rule.get("trigger", "")
+        for condition in rule.get("conditions", []):
+            target = condition.get("analysisservice", "")
+            if not target:
+                continue
+            key = (method_uid, target, trigger)
+            entry = (scenario_uid, rulenumber)
+            values = self._index.get(key, ())
+            if entry not in values:
+                self._index[key] = values + (entry,)
+            if key not in keys:
+                keys.append(key)
+
+    def unindex_scenario(self, scenario):
+        """Removes the rules of the scenario passed in from the index
+        """
+        scenario_uid = api.get_uid(scenario)
+        keys = self._keys.get(scenario_uid)
+        if not keys:
+            return
+        for key in keys:
+            values = filter(lambda entry: entry[0] != scenario_uid,
+                            self._index.get(key, ()))
+            if values:
+                self._index[key] = tuple(values)
+            elif key in self._index:
+                del self._index[key]
+        del self._keys[scenario_uid]
+        self._generation += 1
+
+    def clear(self):
+        """Removes all entries from the index
+        """
+        self._index.clear()
+        self._keys.clear()
+        self._generation += 1
+
+    @property
+    def generation(self):
+        """Returns the number of changes done to the index
+        """
+        return self._generation
+
+    def get_bound_uids(self):
+        """Returns a tuple of two frozensets, the first one with the UIDs of
+        the services and the second one with the UIDs of the methods bound to
+        any indexed rule
+        """
+        services = set()
+        methods = set()
+        for method_uid, target, trigger in self._index.keys():
+            methods.add(method_uid)
+            if api.is_uid(target):
+                services.add(target)
+        return frozenset(services), frozenset(methods)
+
+    def search(self, method_uid, targets, trigger):
+        """Returns an ordered dict of scenario UID -> set of rule numbers
+        that might apply to the method, targets and trigger passed in
+        :param method_uid: UID of the method of the analysis
+        :param targets: list of service UIDs and/or local ids
+        :param trigger: the workflow action that is being performed
+        """
+        candidates = OrderedDict()
+        for target in targets:
+            key = (method_uid, target, trigger)
+            for scenario_uid, rulenumber in self._index.get(key, ()):
+                candidates.setdefault(scenario_uid, set()).add(rulenumber)
+        return candidates
+
+
+def get_scenarios_folder():
+    """Returns the Reflex Testing Scenarios folder or None
+    """
+    setup = api.get_bika_setup()
+    return getattr(setup, "reflextesting_scenarios", None)
+
+
+def get_dispatch_index(create=False):
+    """Returns the dispatch index of the reflex rules. Returns None if the
+    index has not been created yet and create is False
+    """
+    folder = get_scenarios_folder()
+    if folder is None:
+        return None
+    annotations = IAnnotations(folder)
+    index = annotations.get(DISPATCH_INDEX_KEY)
+    if index is None and create:
+        index = DispatchIndex()
+        annotations[DISPATCH_INDEX_KEY] = index
+    return index
+
+
+def get_bound_uids():
+    """Returns a tuple of two frozensets, the first one with the UIDs of the
+    services and the second one with the UIDs of the methods bound to rules
+    from active scenarios. Returns None if the dispatch index does not exist.
+
+    The sets are kept in memory until the dispatch index changes
+    """
+    index = get_dispatch_index()
+    if index is None:
+        return None
+
+    oid = index._p_oid
+    if oid is None:
+        # Not committed yet
+        return index.get_bound_uids()
+
+    generation = index.generation
+    cached = _BOUND_UIDS.get(oid)
+    if cached and cached[0] == generation:
+        return cached[1:]
+
+    services, methods = index.get_bound_uids()
+    _BOUND_UIDS[oid] = (generation, services, methods)
+    return services, methods
+
+
+def has_rules(analysis):
+    """Returns whether the analysis passed in might be bound to rules from
+    active Reflex Testing Scenarios. Returns True if it cannot be told
+    """
+    bound_uids = get_bound_uids()
+    if bound_uids is None:
+        return True
+    services, methods = bound_uids
+    if analysis.getRawMethod() not in methods:
+        return False
+    if analysis.getIsReflexAnalysis():
+        # Analyses created by 'new_analysis' actions are bound to the rule
+        # through their local id, regardless of the service
+        return True
+    return analysis.getServiceUID() in services
+
+
+def reindex_scenario(scenario):
+    """Updates the entries of the scenario passed in in the dispatch index
+    """
+    index = get_dispatch_index(create=True)
+    if index is not None:
+        index.index_scenario(scenario)
+
+
+def reindex_rules(scenario, rulenumbers):
+    """Updates the entries of the rules of the scenario passed in with the
+    rule numbers passed in only
+    """
+    index = get_dispatch_index(create=True)
+    if index is not None:
+        index.index_rules(scenario, rulenumbers)
+
+
+def unindex_scenario(scenario):
+    """Removes the entries of the scenario passed in from the dispatch index
+    """
+    index = get_dispatch_index()
+    if index is not None:
+        index.unindex_scenario(scenario)
+
+
+def rebuild_dispatch_index():
+    """Rebuilds the dispatch index from scratch
+    """
+    folder = get_scenarios_folder()
+    if folder is None:
+        return None
+    index = get_dispatch_index(create=True)
+    index.clear()
+    for scenario in folder.objectValues("ReflexTestingScenario"):
+        logger.info("Indexing rules from '{}' ...".format(api.get_id(scenario)))
+        index.index_scenario(scenario)
+    return index
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import time
+import uuid
+from collections import OrderedDict
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from bika.lims import api
+from persistent import Persistent
+from senaite.reflex.index import get_scenarios_folder
+from zope.annotation.interfaces import IAnnotations
+
+# Annotation key of the job queue in Reflex Testing Scenarios folder
+JOBS_KEY = "senaite.reflex.jobs"
+
+
+class ReflexJob(Persistent):
+    """Deferred application of the actions of a reflex rule that has been
+    met for an analysis
+    """
+
+    def __init__(self, analysis, actions):
+        self.created = time.time()
+        self.analysis_uid = api.get_uid(analysis)
+        self.sample_uid = analysis.getRequestUID()
+        # Plain copies of the action rows, with 'rulenumber' and 'rulename'
+        self.actions = map(dict, actions)
+        self.attempts = 0
+        self.error = None
+
+
+class JobQueue(Persistent):
+    """Persistent FIFO queue of reflex jobs.
+
+    Jobs are keyed by (creation time, random id, sample UID), so concurrent
+    transactions add jobs with different keys and the BTree can resolve the
+    conflicts. The sample is part of the key, so the jobs can be grouped by
+    sample without loading them
+    """
+
+    def __init__(self):
+        # (created, id, sample_uid) -> ReflexJob
+        self._jobs = OOBTree()
+        # Jobs that could not be applied, with the same keys
+        self._failed = OOBTree()
+        # Number of pending jobs, conflict-free
+        self._length = Length()
+        # Number of jobs applied so far, conflict-free
+        self._processed = Length()
+        # sample_uid -> (worker id, expiration time)
+        self._leases = OOBTree()
+
+    def __len__(self):
+        return self._length()
+
+    def put(self, job):
+        """Adds the job passed in to the queue and returns its key
+        """
+        key = (job.created, uuid.uuid4().hex, job.sample_uid)
+        self._jobs[key] = job
+        self._length.change(1)
+        return key
+
+    def get(self, key, default=None):
+        """Returns the job with the key passed in
+        """
+        return self._jobs.get(key, default)
+
+    def keys(self, limit=None):
+        """Returns the keys of the pending jobs, the oldest first
+        """
+        keys = []
+        for key in self._jobs.keys():
+            if limit is not None and len(keys) >= limit:
+                break
+            keys.append(key)
+        return keys
+
+    def remove(self, key):
+        """Removes the job with the key passed in from the queue
+        """
+        if key in self._jobs:
+            del self._jobs[key]
+            self._length.change(-1)
+
+    def done(self, key):
+        """Removes the job with the key passed in from the queue once its
+        actions have been applied
+        """
+        if key in self._jobs:
+            self.remove(key)
+            self._processed.change(1)
+
+    @property
+    def processed(self):
+        """Returns the number of jobs applied so far
+        """
+        return self._processed()
+
+    def keys_by_sample(self, limit=None, worker=None):
+        """Returns an ordered dict of sample UID -> list of keys of the
+        pending jobs, the samples with the oldest jobs first
+        :param limit: the maximum number of keys to return
+        :param worker: if set, the jobs of the samples leased by other
+            workers are skipped
+        """
+        leases = {}
+        if worker:
+            leases = self.leases()
+        samples = OrderedDict()
+        count = 0
+        for key in self._jobs.keys():
+            if limit is not None and count >= limit:
+                break
+            sample_uid = self.get_sample_uid(key)
+            owner = leases.get(sample_uid)
+            if owner and owner != worker:
+                continue
+            samples.setdefault(sample_uid, []).append(key)
+            count += 1
+        return samples
+
+    def get_sample_uid(self, key):
+        """Returns the UID of the sample of the job with the key passed in,
+        without loading the job
+        """
+        if len(key) > 2:
+            return key[2]
+        # Jobs queued before the sample was part of the key
+        return self._jobs[key].sample_uid
+
+    def claim(self, sample_uid, worker, duration):
+        """Leases the jobs of the sample passed in to the worker for the
+        given number of seconds. Returns False if the sample is leased by
+        another worker already
+        """
+        now = time.time()
+        lease = self._leases.get(sample_uid)
+        if lease and lease[0] != worker and lease[1] > now:
+            return False
+        self._leases[sample_uid] = (worker, now + duration)
+        return True
+
+    def release(self, sample_uid, worker):
+        """Releases the lease of the sample passed in, if owned by the worker
+        """
+        lease = self._leases.get(sample_uid)
+        if lease and lease[0] == worker:
+            del self._leases[sample_uid]
+
+    def leases(self):
+        """Returns a dict of sample UID -> worker with the active leases
+        """
+        now = time.time()
+        return dict([(sample_uid, lease[0])
+                     for sample_uid, lease in self._leases.items()
+                     if lease[1] > now])
+
+    def fail(self, key, error):
+        """Moves the job with the key passed in to the failed jobs
+        """
+        job = self._jobs.get(key)
+        if job is None:
+            return
+        job.error = error
+        self._failed[key] = job
+        self.remove(key)
+
+    def failed(self):
+        """Returns a list of tuples (key, job) with the failed jobs
+        """
+        return list(self._failed.items())
+
+
+def get_job_queue(create=False):
+    """Returns the queue of reflex jobs. Returns None if the queue has not
+    been created yet and create is False
+    """
+    folder = get_scenarios_folder()
+    if folder is None:
+        return None
+    annotations = IAnnotations(folder)
+    queue = annotations.get(JOBS_KEY)
+    if queue is None and create:
+        queue = JobQueue()
+        annotations[JOBS_KEY] = queue
+    return queue
+
+
+def defer_actions(analysis, actions):
+    """Stores the actions to be applied to the analysis in the job queue,
+    so they are applied by a worker once the current transaction is
+    committed. Returns the key of the job or None if there is no queue
+    """
+    if not actions:
+        return None
+    queue = get_job_queue(create=True)
+    if queue is None:
+        return None
+    return queue.put(ReflexJob(analysis, actions))
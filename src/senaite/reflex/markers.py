@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from bika.lims import api
+from persistent import Persistent
+from zope.annotation.interfaces import IAnnotations
+
+# Annotation key of the triggered markers in samples
+MARKERS_KEY = "senaite.reflex.triggered_markers"
+
+# Separator of the markers in the legacy ReflexRuleActionsTriggered field
+LEGACY_SEPARATOR = "|"
+
+
+class TriggeredMarkers(Persistent):
+    """Markers '<scenario_uid>.<rulenumber>' of the reflex rules triggered
+    for the analyses of a sample, keyed by analysis uid.
+
+    Markers are immutable frozensets, so a new derivative inherits the
+    markers of its source by sharing the same frozenset instead of copying
+    the whole history. Shared frozensets are pickled only once
+    """
+
+    def __init__(self):
+        # uid of the analysis -> frozenset of markers
+        self._markers = {}
+
+    def get(self, uid):
+        """Returns a frozenset with the markers of the analysis passed in
+        """
+        return self._markers.get(uid, frozenset())
+
+    def add(self, uid, markers):
+        """Adds the markers passed in to the analysis
+        """
+        current = self.get(uid)
+        updated = current.union(markers)
+        if updated != current:
+            self._set(uid, updated)
+
+    def inherit(self, source_uid, uid):
+        """Makes the analysis with the uid passed in start with the markers of
+        the source analysis, as they are at the moment
+        """
+        markers = self._markers.get(source_uid)
+        if not markers:
+            return
+        current = self._markers.get(uid)
+        if current:
+            markers = markers.union(current)
+        if markers != current:
+            self._set(uid, markers)
+
+    def _set(self, uid, markers):
+        all_markers = self._markers.copy()
+        all_markers[uid] = markers
+        self._markers = all_markers
+
+    def _p_resolveConflict(self, old_state, saved_state, new_state):
+        """Merges the markers added by concurrent transactions, e.g. when the
+        analyses of the same sample are submitted at the same time. Markers
+        are never removed, so the union of both states is consistent.
+
+        Conflicts are resolved by the storage server, so with ZEO this
+        package has to be importable by the ZEO server too. Otherwise the
+        conflict is not resolved and the transaction is retried as usual
+        """
+        resolved = dict(saved_state)
+        markers = dict(saved_state.get("_markers", {}))
+        for uid, added in new_state.get("_markers", {}).items():
+            markers[uid] = markers.get(uid, frozenset()).union(added)
+        resolved["_markers"] = markers
+        return resolved
+
+
+def get_markers_storage(analysis, create=False):
+    """Returns the storage of triggered markers of the sample the analysis
+    belongs to. Returns None if the storage does not exist and create is False
+    """
+    return get_sample_markers_storage(api.get_parent(analysis), create=create)
+
+
+def get_sample_markers_storage(sample, create=False):
+    """Returns the storage of triggered markers of the sample passed in.
+    Returns None if the storage does not exist and create is False.
+
+    The storage is only created on the first write, so samples without
+    triggered rules get no annotation
+    """
+    annotations = IAnnotations(sample)
+    storage = annotations.get(MARKERS_KEY)
+    if storage is None and create:
+        # Known limitation: the creation is not covered by the conflict
+        # resolution of TriggeredMarkers. Two transactions that write the
+        # first markers of the same sample at the same time conflict on the
+        # annotations of the sample, and the one retried finds the storage
+        # in place
+        storage = TriggeredMarkers()
+        annotations[MARKERS_KEY] = storage
+    return storage
+
+
+def get_legacy_markers(analysis):
+    """Returns the markers stored in the legacy pipe-joined string field
+    """
+    field = analysis.getField("ReflexRuleActionsTriggered")
+    value = field.get(analysis) or ""
+    return filter(None, value.split(LEGACY_SEPARATOR))
+
+
+def migrate_legacy_markers(analysis):
+    """Moves the markers from the legacy ReflexRuleActionsTriggered field of
+    the analysis to the storage of its sample and empties the field
+    """
+    markers = get_legacy_markers(analysis)
+    if not markers:
+        return
+    storage = get_markers_storage(analysis, create=True)
+    storage.add(api.get_uid(analysis), markers)
+    analysis.getField("ReflexRuleActionsTriggered").set(analysis, "")
+
+
+def get_triggered_markers(analysis):
+    """Returns a frozenset with the markers of the reflex rules triggered for
+    the analysis passed in. Markers not migrated from the legacy field yet
+    are included, but nothing is written
+    """
+    storage = get_markers_storage(analysis)
+    markers = storage and storage.get(api.get_uid(analysis)) or frozenset()
+    legacy = get_legacy_markers(analysis)
+    if legacy:
+        return markers.union(legacy)
+    return markers
+
+
+def is_triggered(analysis, marker):
+    """Returns whether the reflex rule marker passed in has been triggered
+    for the analysis
+    """
+    return marker in get_triggered_markers(analysis)
+
+
+def add_triggered(analysis, marker):
+    """Flags the reflex rule marker passed in as triggered for the analysis
+    """
+    migrate_legacy_markers(analysis)
+    storage = get_markers_storage(analysis, create=True)
+    storage.add(api.get_uid(analysis), [marker])
+
+
+def inherit_triggered(source, analysis):
+    """Makes the analysis passed in, created by a reflex action, start with
+    the markers triggered for the source analysis. The markers are shared,
+    not copied
+    """
+    migrate_legacy_markers(source)
+    storage = get_markers_storage(source)
+    if storage is None:
+        return
+    storage.inherit(api.get_uid(source), api.get_uid(analysis))
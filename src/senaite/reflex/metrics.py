@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds in seconds of the buckets of the histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, float("inf"))
+
+
+class Histogram(object):
+    """Distribution of observed values in fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for pos, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[pos] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket the percentile passed in
+        falls into, or None if nothing has been observed yet
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        accumulated = 0
+        for bound, count in zip(self.buckets, self.counts):
+            accumulated += count
+            if accumulated >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+
+class MetricsRegistry(object):
+    """Process-wide registry of counters and histograms. Metrics are
+    identified by a name and an optional set of labels
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (name, labels) -> value
+            self._counters = {}
+            # (name, labels) -> Histogram
+            self._histograms = {}
+            self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """Increments the counter passed in
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Adds the value passed in to the histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def get_counters(self):
+        """Returns a dict of (name, labels) -> value with a copy of counters
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def get_histograms(self):
+        """Returns a dict of (name, labels) -> Histogram with a copy of the
+        histograms
+        """
+        with self._lock:
+            return dict([(key, histogram.copy())
+                         for key, histogram in self._histograms.items()])
+
+
+# Metrics of the current process
+REGISTRY = MetricsRegistry()
+
+
+def inc(name, value=1, **labels):
+    """Increments the counter passed in
+    """
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """Adds the value passed in to the histogram
+    """
+    REGISTRY.observe(name, value, **labels)
+
+
+@contextmanager
+def timed(name, **labels):
+    """Context manager that observes the seconds spent in the block in the
+    histogram passed in
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.time() - start, **labels)
+
+
+def timer(name, **labels):
+    """Decorator that observes the seconds spent in the function in the
+    histogram passed in
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_labels(labels, **extra):
+    """Returns the labels passed in in Prometheus text format
+    """
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join(map(
+        lambda item: '{}="{}"'.format(item[0], str(item[1]).replace(
+            "\\", "\\\\").replace('"', '\\"')), labels)))
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(bound)
+
+
+def to_prometheus(registry=REGISTRY):
+    """Returns the metrics of the registry in Prometheus text exposition
+    format, so they can be collected by a scraper
+    """
+    lines = [
+        "# TYPE reflex_process_start_time_seconds gauge",
+        "reflex_process_start_time_seconds {}".format(registry.started),
+    ]
+
+    counters = registry.get_counters()
+    for name in sorted(set(map(lambda key: key[0], counters))):
+        lines.append("# TYPE {} counter".format(name))
+        for (key, labels), value in sorted(counters.items()):
+            if key == name:
+                lines.append("{}{} {}".format(
+                    name, format_labels(labels), value))
+
+    histograms = registry.get_histograms()
+    for name in sorted(set(map(lambda key: key[0], histograms))):
+        lines.append("# TYPE {} histogram".format(name))
+        for (key, labels), histogram in sorted(histograms.items()):
+            if key != name:
+                continue
+            accumulated = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                accumulated += count
+                lines.append("{}_bucket{} {}".format(
+                    name, format_labels(labels, le=format_bound(bound)),
+                    accumulated))
+            lines.append("{}_sum{} {}".format(
+                name, format_labels(labels), histogram.sum))
+            lines.append("{}_count{} {}".format(
+                name, format_labels(labels), histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+def get_summary(registry=REGISTRY):
+    """Returns a dict with the counters, the latency percentiles and the hit
+    rates of the caches of the registry, to be displayed
+    """
+    counters = []
+    caches = {}
+    for (name, labels), value in sorted(registry.get_counters().items()):
+        labels = dict(labels)
+        counters.append({
+            "name": name,
+            "labels": format_labels(sorted(labels.items())),
+            "value": value,
+        })
+        if name == "reflex_cache_requests_total":
+            cache = caches.setdefault(labels.get("cache"), {
+                "cache": labels.get("cache"),
+                "hits": 0,
+                "misses": 0,
+            })
+            result = labels.get("result") == "hit" and "hits" or "misses"
+            cache[result] += value
+
+    latencies = []
+    for (name, labels), histogram in sorted(
+            registry.get_histograms().items()):
+        latencies.append({
+            "name": name,
+            "labels": format_labels(labels),
+            "count": histogram.count,
+            "mean": histogram.count and histogram.sum / histogram.count,
+            "p50": histogram.percentile(50),
+            "p90": histogram.percentile(90),
+            "p99": histogram.percentile(99),
+        })
+
+    hit_rates = []
+    for key, cache in sorted(caches.items()):
+        total = cache["hits"] + cache["misses"]
+        cache["rate"] = total and float(cache["hits"]) / total or 0.0
+        hit_rates.append(cache)
+
+    return {
+        "started": registry.started,
+        "counters": counters,
+        "latencies": latencies,
+        "caches": hit_rates,
+    }
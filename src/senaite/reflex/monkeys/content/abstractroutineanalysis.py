@@ -4,16 +4,35 @@
 #
 # Copyright 2018 by it's authors.
 
+import transaction
 from bika.lims import api
 from bika.lims.content.reflexrule import doReflexRuleAction
 from bika.lims.interfaces.analysis import IRequestAnalysis
 from senaite.reflex import logger
+from senaite.reflex.collector import enqueue
+from senaite.reflex.index import get_dispatch_index
+from senaite.reflex.index import has_rules
+from senaite.reflex.jobs import defer_actions
+from senaite.reflex.markers import LEGACY_SEPARATOR
+from senaite.reflex.markers import add_triggered
+from senaite.reflex.markers import get_triggered_markers
+from senaite.reflex.metrics import inc
+from senaite.reflex.metrics import timed
+from senaite.reflex.metrics import timer
+from senaite.reflex.utils import get_registry_record
+from senaite.reflex.utils import get_transaction_cache
 
 
+@timer("reflex_dispatch_seconds")
 def _reflex_rule_process(self, wf_action):
     """This function does all the reflex rule process.
     :param wf_action: is a string containing the workflow action triggered
     """
+    if not has_rules(self):
+        # Neither the service nor the method are bound to any active rule
+        inc("reflex_dispatch_total", result="skipped")
+        return
+
     if not IRequestAnalysis.providedBy(self):
         # Only routine analyses (assigned to a Request) are supported
         logger.warn("Only IRequestAnalysis are supported in reflex testing")
@@ -22,6 +41,118 @@ def _reflex_rule_process(self, wf_action):
     # Check out if the analysis has any reflex rule bound to it.
     # First we have get the analysis' method because the Reflex Rule
     # objects are related to a method.
+    if not self.getRawMethod():
+        return
+
+    # Count the request if retried after a ConflictError
+    count_request_retry()
+
+    if get_registry_record("batch_evaluation", False):
+        # Defer the evaluation until the end of the request
+        if enqueue(self, wf_action, process_collector):
+            inc("reflex_dispatch_total", result="enqueued")
+            return
+
+    inc("reflex_dispatch_total", result="processed")
+    process_reflex_rules(self, wf_action)
+
+
+def count_request_retry():
+    """Counts the current transaction in reflex_conflicts_total if the
+    request has been retried after a ConflictError. The transaction is
+    counted once, when it is about to be committed, no matter how many
+    analyses are processed
+    """
+    request = api.get_request()
+    if request is None or not getattr(request, "retry_count", 0):
+        return
+    cache = get_transaction_cache("conflicts")
+    if cache.get("registered"):
+        return
+    transaction.get().addBeforeCommitHook(
+        inc, ("reflex_conflicts_total",), dict(source="request"))
+    cache["registered"] = True
+
+
+def process_reflex_rules(analysis, wf_action, scenarios=None, group=None):
+    """Evaluates the reflex rules that might apply to the analysis for the
+    workflow action passed in and does the actions of the rules that are met
+    :param scenarios: dict of Reflex Testing Scenarios by UID, shared by
+        consecutive calls to not resolve the same scenarios again
+    :param group: the ReflexGroup the analysis is evaluated with, if any
+    """
+    method_uid = analysis.getRawMethod()
+
+    index = get_dispatch_index()
+    if index is None:
+        # Dispatch index not built yet, walk through the back references
+        return _reflex_rule_process_by_references(analysis, wf_action)
+
+    # Conditions refer either to the service of the analysis or to the local
+    # id given to the analysis by a previous reflex action
+    targets = [analysis.getServiceUID()]
+    if analysis.getIsReflexAnalysis():
+        targets.append(analysis.getReflexRuleLocalID())
+
+    # Get the rules bound to same method, service (or local id) and trigger
+    # from the active Reflex Testing Scenarios
+    if scenarios is None:
+        scenarios = {}
+    candidates = index.search(method_uid, targets, wf_action)
+    for scenario_uid, rulenumbers in candidates.items():
+        scenario = scenarios.get(scenario_uid)
+        if scenario is None:
+            inc("reflex_cache_requests_total", cache="scenarios",
+                result="miss")
+            with timed("reflex_scenario_resolution_seconds"):
+                scenario = api.get_object_by_uid(scenario_uid, None)
+            scenarios[scenario_uid] = scenario
+        else:
+            inc("reflex_cache_requests_total", cache="scenarios",
+                result="hit")
+        if scenario is None:
+            logger.warn("Reflex Testing Scenario {} not found".format(
+                scenario_uid))
+            continue
+        # Getting the rules to be done from the reflex rule taking
+        # in consideration the result and the state change
+        rules = None
+        if group is not None:
+            rules = group.get_rules(scenario, rulenumbers)
+        action_row = scenario.getActionReflexRules(
+            analysis, wf_action, rulenumbers=rulenumbers, rules=rules)
+        # Once we have the rules, the system has to execute its
+        # instructions if the result has the expected result.
+        apply_actions(analysis, action_row)
+
+
+@timer("reflex_batch_seconds")
+def process_collector(collector):
+    """Evaluates the reflex rules of the analyses enqueued in the collector,
+    grouped by sample and method. Called right before the transaction is
+    committed.
+
+    The analyses of a group share their lookups (see ReflexGroup). Analyses
+    enqueued while processing (e.g. analyses submitted by a reflex action)
+    are processed too. Rules are flagged as triggered for all the analyses
+    involved in their conditions, so actions are not duplicated when several
+    analyses of the same sample meet the same rule
+    """
+    while True:
+        group = collector.pop_group()
+        if group is None:
+            break
+        group.prefetch()
+        for analysis, wf_action in group:
+            process_reflex_rules(analysis, wf_action,
+                                 scenarios=collector.scenarios, group=group)
+
+
+def _reflex_rule_process_by_references(self, wf_action):
+    """Does the reflex rule process by looking up the Reflex Testing
+    Scenarios through the back references of the method of the analysis
+    :param wf_action: is a string containing the workflow action triggered
+    """
     a_method = self.getMethod()
     if not a_method:
         return
@@ -44,4 +175,35 @@ def _reflex_rule_process(self, wf_action):
         action_row = rule.getActionReflexRules(self, wf_action)
         # Once we have the rules, the system has to execute its
         # instructions if the result has the expected result.
-        doReflexRuleAction(self, action_row)
+        apply_actions(self, action_row)
+
+
+def apply_actions(analysis, action_row):
+    """Does the actions passed in against the analysis, or stores them in the
+    job queue to be done by the reflex worker after commit, if deferred
+    actions are enabled
+    """
+    if not action_row:
+        return
+    if get_registry_record("deferred_actions", False):
+        if defer_actions(analysis, action_row):
+            return
+    doReflexRuleAction(analysis, action_row)
+
+
+def getReflexRuleActionsTriggered(self):
+    """Returns the markers of the reflex rules triggered for the analysis,
+    joined by '|' as they used to be stored in the ReflexRuleActionsTriggered
+    string field
+    """
+    return LEGACY_SEPARATOR.join(sorted(get_triggered_markers(self)))
+
+
+def addReflexRuleActionsTriggered(self, text):
+    """Flags the reflex rule actions passed in as triggered for the analysis,
+    instead of appending them to the ReflexRuleActionsTriggered string field.
+    :param text: is a str object with the format '<UID>.<rulename>' ->
+        '123354.1'. Several markers can be passed in, separated by '|'
+    """
+    for marker in filter(None, text.split(LEGACY_SEPARATOR)):
+        add_triggered(self, marker)
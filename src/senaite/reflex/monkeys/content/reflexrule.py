@@ -15,6 +15,14 @@ from bika.lims.utils.analysis import duplicateAnalysis, create_analysis
 from bika.lims.workflow import doActionFor
 from senaite.reflex import logger
 from senaite.reflex import senaiteMessageFactory as _
+from senaite.reflex.idempotency import get_action_key
+from senaite.reflex.idempotency import set_applied
+from senaite.reflex.markers import inherit_triggered
+from senaite.reflex.metrics import inc
+from senaite.reflex.metrics import timed
+from senaite.reflex.metrics import timer
+from senaite.reflex.utils import get_metadata
+from senaite.reflex.utils import get_transaction_cache
 
 
 def doActionToAnalysis(source_analysis, action):
@@ -25,11 +33,29 @@ def doActionToAnalysis(source_analysis, action):
         [{'action': 'duplicate', ...}, {,}, ...]
     :returns: the new analysis
     """
+    action_id = action.get('action', '')
+    with timed("reflex_action_seconds", action=action_id):
+        analysis = _doActionToAnalysis(source_analysis, action)
+    inc("reflex_actions_total", action=action_id,
+        result=analysis and "done" or "skipped")
+    return analysis
+
+
+def _doActionToAnalysis(source_analysis, action):
+    """Executes the action against the analysis. See doActionToAnalysis
+    """
     if not IRequestAnalysis.providedBy(source_analysis):
         # Only routine analyses (assigned to a Request) are supported
         logger.warn("Only IRequestAnalysis are supported in reflex testing")
         return None
 
+    if not set_applied(source_analysis, action):
+        # Already applied, e.g. by a concurrent or a retried evaluation
+        logger.info("Reflex action {} already applied to {}".format(
+            get_action_key(source_analysis, action),
+            api.get_path(source_analysis)))
+        return None
+
     state = api.get_review_status(source_analysis)
     action_id  = action.get('action', '')
 
@@ -96,9 +122,9 @@ def doActionToAnalysis(source_analysis, action):
     analysis.setReflexRuleAction(action_id)
     analysis.setIsReflexAnalysis(True)
     analysis.setReflexAnalysisOf(source_analysis)
-    analysis.setReflexRuleActionsTriggered(
-        source_analysis.getReflexRuleActionsTriggered()
-    )
+    # The new analysis starts with the markers triggered for the source,
+    # that are shared instead of copied
+    inherit_triggered(source_analysis, analysis)
     if action.get('showinreport', '') == "invisible":
         analysis.setHidden(True)
     elif action.get('showinreport', '') == "visible":
@@ -110,6 +136,8 @@ def doActionToAnalysis(source_analysis, action):
     else:
         analysis.setOriginalReflexedAnalysis(source_analysis)
     analysis.setReflexRuleLocalID(action.get('an_result_id', ''))
+    # Make the new derivative available to further condition evaluations
+    cache_derivative(analysis)
 
     # Setting the remarks to base analysis
     remarks = get_remarks(action, analysis)
@@ -118,6 +146,7 @@ def doActionToAnalysis(source_analysis, action):
     return analysis
 
 
+@timer("reflex_remarks_seconds")
 def get_remarks(action, output_analysis):
     action_name = action.get('action', '')
     if not action_name:
@@ -160,6 +189,7 @@ def get_remarks(action, output_analysis):
     return '; '.join(remarks_output)
 
 
+@timer("reflex_derivative_lookup_seconds")
 def _fetch_analysis_for_local_id(analysis, ans_cond):
     """
     This function returns an analysis when the derivative IDs conditions
@@ -168,19 +198,120 @@ def _fetch_analysis_for_local_id(analysis, ans_cond):
         rules for.
     :ans_cond: the local id with the target derivative reflex rule id.
     """
+    original_uid = analysis.getRawOriginalReflexedAnalysis()
+    if not original_uid:
+        return None
+
+    if api.is_uid(ans_cond):
+        # The analysis is woken up anyway, so there is no need to search for
+        # the brain of the first reflexed analysis
+        first_reflexed = analysis.getOriginalReflexedAnalysis()
+        if first_reflexed and ans_cond == first_reflexed.getServiceUID():
+            return first_reflexed
+
+    derivative = get_derivatives(original_uid).get(ans_cond)
+    if derivative:
+        return api.get_object(derivative)
+    return None
+
+
+@timer("reflex_derivative_lookup_seconds")
+def _fetch_brain_for_local_id(analysis, ans_cond):
+    """
+    Returns the catalog brain (or the object, if created in the current
+    transaction) of the analysis from the same reflex chain as the analysis
+    passed in that matches with the local id or service uid 'ans_cond'.
+    :analysis: the analysis full object which we want to obtain the
+        rules for.
+    :ans_cond: the local id with the target derivative reflex rule id.
+    """
     # Getting the first reflexed analysis from the chain
-    first_reflexed = analysis.getOriginalReflexedAnalysis()
-    if first_reflexed:
-        if api.is_uid(ans_cond) and ans_cond == first_reflexed.getServiceUID():
+    original_uid = analysis.getRawOriginalReflexedAnalysis()
+    if not original_uid:
+        return None
+
+    if api.is_uid(ans_cond):
+        first_reflexed = get_analysis_brain(original_uid)
+        if first_reflexed and \
+                ans_cond == get_metadata(first_reflexed, "getServiceUID"):
             return first_reflexed
 
+    # From all the related reflexed analysis, return the one that matches
+    # with the local id 'ans_cond'
+    return get_derivatives(original_uid).get(ans_cond)
+
+
+def get_analysis_brain(uid):
+    """Returns the catalog brain of the analysis with the uid passed in, or
+    None. The result is cached for the current request and transaction
+    """
+    cache = get_transaction_cache("analyses")
+    inc("reflex_cache_requests_total", cache="analyses",
+        result=uid in cache and "hit" or "miss")
+    if uid not in cache:
+        brains = api.search(dict(UID=uid), CATALOG_ANALYSIS_LISTING)
+        cache[uid] = brains and brains[0] or None
+    return cache[uid]
+
+
+def get_derivatives(original_uid):
+    """Returns a dict of local id -> analysis (brain or object) with the
+    analyses created by reflex actions from the original analysis passed in.
+
+    The result is cached for the current request and transaction, so the
+    derivatives are only searched once. Local ids are read from the catalog
+    metadata, so no analysis is woken up
+    :original_uid: the uid of the first reflexed analysis of the chain
+    """
+    cache = get_transaction_cache("derivatives")
+    derivatives = cache.get(original_uid)
+    inc("reflex_cache_requests_total", cache="derivatives",
+        result=derivatives is None and "miss" or "hit")
+    if derivatives is None:
+        derivatives = {}
         # Getting all reflexed analysis created due to this first analysis
-        query = dict(getOriginalReflexedAnalysisUID=first_reflexed.UID())
-        # From all the related reflexed analysis, return the one that matches
-        # with the local id 'ans_cond'
+        query = dict(getOriginalReflexedAnalysisUID=original_uid)
         for derivative in api.search(query, CATALOG_ANALYSIS_LISTING):
-            derivative = api.get_object(derivative)
-            if derivative.getReflexRuleLocalID() == ans_cond:
-                return derivative
+            local_id = get_metadata(derivative, "getReflexRuleLocalID")
+            derivatives.setdefault(local_id, derivative)
+        cache[original_uid] = derivatives
+    return derivatives
 
-    return None
+
+def prefetch_derivatives(original_uids):
+    """Searches the derivatives of the reflex chains of the original analyses
+    passed in that are not cached yet, all of them with a single search
+    :original_uids: the uids of the first reflexed analyses of the chains
+    """
+    cache = get_transaction_cache("derivatives")
+    missing = filter(lambda uid: uid not in cache, set(original_uids))
+    if not missing:
+        return
+    for original_uid in missing:
+        cache[original_uid] = {}
+    query = dict(getOriginalReflexedAnalysisUID=missing)
+    for derivative in api.search(query, CATALOG_ANALYSIS_LISTING):
+        original_uid = get_metadata(derivative,
+                                    "getOriginalReflexedAnalysisUID")
+        local_id = get_metadata(derivative, "getReflexRuleLocalID")
+        cache.setdefault(original_uid, {}).setdefault(local_id, derivative)
+
+
+def cache_derivative(analysis):
+    """Adds the derivative analysis passed in to the cache of derivatives of
+    its original reflexed analysis, if the latter has been cached already
+    """
+    original_uid = analysis.getRawOriginalReflexedAnalysis()
+    if not original_uid:
+        return
+    cache = get_transaction_cache("derivatives")
+    derivatives = cache.get(original_uid)
+    if derivatives is None:
+        return
+    # Actions like 'setvisibility' might overwrite the local id of an
+    # existing derivative
+    uid = api.get_uid(analysis)
+    for local_id, derivative in derivatives.items():
+        if api.get_uid(derivative) == uid:
+            del derivatives[local_id]
+    derivatives.setdefault(analysis.getReflexRuleLocalID(), analysis)
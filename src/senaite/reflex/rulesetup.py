@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import collections
+import json
+
+from bika.lims import api
+from senaite.reflex.metrics import inc
+from senaite.reflex.utils import get_metadata
+
+# Process-wide cache of the setup data of the rules widget, keyed by the path
+# of the setup catalog. Each value is a tuple (counter, setup, json), so the
+# entry is discarded as soon as an object is (re)cataloged in bika_setup_catalog
+_SETUP_CACHE = {}
+
+SETUP_CATALOG = "bika_setup_catalog"
+
+
+def get_setup_counter(catalog=None):
+    """Returns the modification counter of the setup catalog, that is
+    increased every time an object is cataloged or uncataloged
+    """
+    catalog = catalog or api.get_tool(SETUP_CATALOG)
+    return catalog.getCounter()
+
+
+def get_etag(counter, method_uid=None):
+    """Returns the ETag of the setup data for the counter passed in
+    :param method_uid: the UID of the method the data is restricted to
+    """
+    if method_uid:
+        return '"reflex-setup-{}-{}"'.format(counter, method_uid)
+    return '"reflex-setup-{}"'.format(counter)
+
+
+def build_rule_setup(catalog):
+    """Returns an ordered dict with the relations between methods and
+    analysis services the rules widget needs, built from the metadata of the
+    catalog passed in only:
+
+    {'<method_uid>': {
+        'analysisservices': {
+            '<as_uid>': {'as_id': '<as_id>',
+                         'as_title':'<as_title>',
+                         'resultoptions': [,,],
+                         'wstoptions': [('<wst_uid>', '<wst_title>'),]},
+        },
+        'as_keys': ['<as_uid>', '<as_uid>'],
+        'method_id': '<method_id>',
+        'method_tile': '<method_tile>'
+    }, ...}
+    """
+    # Get all worksheet templates
+    query = dict(portal_type="WorksheetTemplate", inactive_state="active",
+                 sort_on="sortable_title", sort_order="ascending")
+    ws_templates = catalog(query)
+
+    # Group the services by method, in a single pass
+    services_by_method = collections.defaultdict(list)
+    query = dict(portal_type="AnalysisService", inactive_state="active",
+                 sort_on="title", sort_order="ascending")
+    for service in catalog(query):
+        method_uids = get_metadata(service, "getMethodUIDs") or []
+        for method_uid in method_uids:
+            services_by_method[method_uid].append((service, method_uids))
+
+    relations = collections.OrderedDict()
+    query = dict(portal_type="Method", inactive_state="active",
+                 sort_on="sortable_title", sort_order="ascending")
+    for method in catalog(query):
+        method_uid = api.get_uid(method)
+        analysiservices = collections.OrderedDict()
+        for service, smuids in services_by_method.get(method_uid, []):
+            # Getting the worksheet templates that could be used with the
+            # analysis, those worksheet templates are the ones without
+            # method and the ones with a method shared with the
+            # analysis service.
+            wst_brains = filter(lambda wst: api.get_uid(wst) in smuids,
+                                ws_templates)
+            resultoptions = get_metadata(service, "getResultOptions")
+            analysiservices[api.get_uid(service)] = {
+                'as_id': api.get_id(service),
+                'as_title': api.get_title(service),
+                'resultoptions': resultoptions and list(resultoptions) or [],
+                'wstoptions': [
+                    (brain.UID, brain.Title) for brain in wst_brains]
+            }
+        relations[method_uid] = {
+            'method_id': api.get_id(method),
+            'method_tile': api.get_title(method),
+            'analysisservices': analysiservices,
+            'as_keys': analysiservices.keys(),
+        }
+    return relations
+
+
+def get_cached_setup():
+    """Returns a tuple (counter, setup, json) with the setup data of the rules
+    widget. The data is only built again when the setup catalog changes
+    """
+    catalog = api.get_tool(SETUP_CATALOG)
+    counter = get_setup_counter(catalog)
+    key = "/".join(catalog.getPhysicalPath())
+    cached = _SETUP_CACHE.get(key)
+    if cached is not None and cached[0] == counter:
+        inc("reflex_cache_requests_total", cache="setup", result="hit")
+        return cached
+    inc("reflex_cache_requests_total", cache="setup", result="miss")
+    setup = build_rule_setup(catalog)
+    cached = (counter, setup, json.dumps(setup))
+    _SETUP_CACHE[key] = cached
+    return cached
+
+
+def get_rule_setup():
+    """Returns a tuple (etag, setup, json) with the setup data of the rules
+    widget
+    """
+    counter, setup, setup_json = get_cached_setup()
+    return get_etag(counter), setup, setup_json
+
+
+def get_method_setup(method_uid):
+    """Returns a tuple (etag, json) with the setup data of the method passed
+    in only, or an empty dict if no method is passed in or the method is not
+    active
+    """
+    counter, setup, setup_json = get_cached_setup()
+    method_setup = {}
+    if method_uid in setup:
+        method_setup[method_uid] = setup[method_uid]
+    return get_etag(counter, method_uid), json.dumps(method_setup)
+
+
+def invalidate():
+    """Clears the cache of the setup data
+    """
+    _SETUP_CACHE.clear()
@@ -4,11 +4,13 @@
 #
 # Copyright 2018 by it's authors.
 
+import transaction
 from Products.CMFPlone.utils import _createObjectByType
 from bika.lims import api
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.utils import tmpID
 from senaite.reflex import logger
+from senaite.reflex.index import rebuild_dispatch_index
 
 CONTROL_PANELS = [
     {
@@ -31,8 +33,19 @@ INDEXES = [
 
 COLUMNS = [
     # Tuples of (catalog, column name)
+    ("bika_analysis_catalog", "getReflexRuleLocalID"),
+    ("bika_analysis_catalog", "getIsReflexAnalysis"),
+    ("bika_analysis_catalog", "getReflexRuleActionsTriggered"),
+    ("bika_analysis_catalog", "getOriginalReflexedAnalysisUID"),
+    ("bika_analysis_catalog", "getResult"),
+    ("bika_analysis_catalog", "getServiceUID"),
+    ("bika_setup_catalog", "getMethodUIDs"),
+    ("bika_setup_catalog", "getResultOptions"),
 ]
 
+# Number of objects to reindex before a savepoint is done
+REINDEX_BATCH_SIZE = 1000
+
 
 def post_install(portal_setup):
     """Runs after the last import step of the *default* profile
@@ -60,6 +73,9 @@ def post_install(portal_setup):
     # Disable core's reflex rules folder
     disable_core_reflex_rules_folder(portal)
 
+    # Build the lookup of rules for the dispatch of reflex actions
+    setup_dispatch_index(portal)
+
     logger.info("SENAITE REFLEX install handler [DONE]")
 
 
@@ -90,6 +106,7 @@ def setup_catalogs(portal):
 
     # Setup catalog indexes
     to_index = []
+    to_update = {}
     for catalog, name, attribute, meta_type in INDEXES:
         c = api.get_tool(catalog)
         indexes = c.indexes()
@@ -116,6 +133,7 @@ def setup_catalogs(portal):
             logger.info("*** Adding Column '%s' to catalog '%s' ..."
                         % (name, catalog))
             c.addColumn(name)
+            to_update.setdefault(catalog, []).append(name)
             logger.info("*** Added Column '%s' to catalog '%s' [DONE]"
                         % (name, catalog))
         else:
@@ -123,6 +141,32 @@ def setup_catalogs(portal):
                         % (name, catalog))
             continue
 
+    # Populate the new metadata columns
+    for catalog, names in to_update.items():
+        update_metadata(api.get_tool(catalog), names)
+
+
+def update_metadata(catalog, columns):
+    """Updates the metadata of all objects from the catalog passed in, in
+    batches, without reindexing any index
+    :param catalog: the catalog to update
+    :param columns: the new metadata columns, for logging purposes
+    """
+    brains = catalog.unrestrictedSearchResults()
+    total = len(brains)
+    logger.info("*** Updating metadata {} of {} objects from '{}' ..."
+                .format(", ".join(columns), total, catalog.id))
+    for num, brain in enumerate(brains, start=1):
+        obj = api.get_object(brain)
+        catalog._catalog.updateMetadata(obj, brain.getPath(), brain.getRID())
+        obj._p_deactivate()
+        if num % REINDEX_BATCH_SIZE == 0:
+            logger.info("*** Updating metadata of objects from '{}': {}/{}"
+                        .format(catalog.id, num, total))
+            transaction.savepoint(optimistic=True)
+    logger.info("*** Updating metadata of {} objects from '{}' [DONE]"
+                .format(total, catalog.id))
+
 
 def setup_control_panels(portal):
     """Setup Plone control and Senaite management panels
@@ -222,3 +266,11 @@ def disable_core_reflex_rules_folder(portal):
         del actions[action_index]
         cp._actions = tuple(actions)
         cp._p_changed = 1
+
+
+def setup_dispatch_index(portal):
+    """Builds the (method, service, trigger) -> scenario lookup used to
+    dispatch the reflex rules on analysis transitions
+    """
+    logger.info("*** Setup dispatch index ***")
+    rebuild_dispatch_index()
@@ -1,12 +1,69 @@
 jQuery(function($){
+    // The setup data, to be used everywhere. The data of each method is
+    // only added once the method is selected
+    var setupdata = null;
+
     $(document).ready(function(){
-        // This will be a variable to be used everywhere
-        var setupdata = $.parseJSON($('#rules-setup-data').html());
+        var div = $('#rules-setup-data');
+        setupdata = $.parseJSON(div.html());
+        load_method(get_selected_method(), setup_widget);
+    });
+
+    function get_selected_method(){
+        return $('select[id="Method"]').find(":selected").attr('value') || '';
+    }
+
+    /**
+     * Fetches the analysis services and worksheet templates of the method
+     * from the setup url, unless they were already fetched, and adds them
+     * to the setup data. The browser revalidates the data with its ETag, so
+     * it is only transferred when the setup changes.
+     * @param {string} method the UID of the method.
+     * @param {function} callback called once the method is available.
+     */
+    function load_method(method, callback){
+        if (setupdata[method] !== undefined){
+            callback();
+            return;
+        }
+        if (!method){
+            // No method selected yet, so there are no services to fetch
+            setupdata[method] = {'analysisservices': {}, 'as_keys': []};
+            callback();
+            return;
+        }
+        $.ajax({
+            url: $('#rules-setup-data').attr('data-setup-url'),
+            data: {method: method},
+            dataType: 'json',
+            cache: true
+        }).done(function(setup){
+            setupdata[method] = setup[method] || {
+                'analysisservices': {}, 'as_keys': []};
+            callback();
+        }).fail(function(xhr, status, error){
+            if (window.console){
+                window.console.warn('Cannot load the setup of method ' +
+                                    method + ': ' + (error || status));
+            }
+            // Go on without services, so the widget is still usable
+            setupdata[method] = {'analysisservices': {}, 'as_keys': []};
+            callback();
+        });
+    }
+
+    function get_setupdata(){
+        return setupdata;
+    }
+
+    function setup_widget(){
         description_controller();
         method_controller(setupdata);
         remove_last_rule_set();
         setup_as_and_discrete_results(setupdata);
         setup_addnew_buttons();
+        setup_save_rule_buttons();
+        setup_json_submission();
         // Hide the del_button in the fist td.rulescontainer
         $('table#ReflexRules_table').find('.rw_deletebtn').first().hide();
         setup_del_action_button();
@@ -20,8 +77,9 @@ jQuery(function($){
             for (var i=0; del_buts.length > i; i++) {
                 $(del_buts[i]).trigger( "click" );
             }
-            setupdata = $.parseJSON($('#rules-setup-data').html());
-            method_controller(setupdata);
+            load_method(get_selected_method(), function(){
+                method_controller(setupdata);
+            });
         });
         $('input[id^="ReflexRules-range"]').bind("change", function () {
             range_controller(this);
@@ -65,7 +123,7 @@ jQuery(function($){
         setup_svof(setupdata);
         // Setting up the worksheet templates select options
         setup_worksheettemplate(setupdata);
-    });
+    }
     /**
      * The controller to hide/show the description.
      */
@@ -259,7 +317,7 @@ jQuery(function($){
                 $(sel_options).prop("selected", false);
             }
             $(container_clone).insertAfter(element);
-            var setupdata = $.parseJSON($('#rules-setup-data').html());
+            var setupdata = get_setupdata();
             $(sel).attr('already_sel', 'yes');
             // Binding the and_or controller
             $(container_clone).find('select[id^="ReflexRules-and_or-"]')
@@ -400,6 +458,8 @@ jQuery(function($){
         $(input).val('');
         var sel_options = $(td).find(":selected");
         $(sel_options).prop("selected", false);
+        // Rule sets not saved yet can only be saved with the whole form
+        $(set).find('.rule_savebtn, .rule_savestatus').remove();
         // Adding the new set to the table
         $(set).appendTo($(table));
         // Binding the controllers
@@ -456,6 +516,129 @@ jQuery(function($){
         update_analysis_selectors();
     }
 
+    /**
+     * Returns the local ids of the analyses created by the rules that are
+     * not rendered, because they belong to other pages.
+     * @param {boolean} previous whether to return the local ids of the rules
+     *                           before the page or the ones after it.
+     * @return {Array} the local ids
+     */
+    function get_hidden_local_ids(previous) {
+        if (setupdata === null || setupdata.saved_actions === undefined) {
+            return [];
+        }
+        var saved = setupdata.saved_actions;
+        var local_ids = previous ? saved.previous_local_ids : saved.next_local_ids;
+        return local_ids || [];
+    }
+
+    function setup_save_rule_buttons(){
+        /**
+        Bind the process trigged after clicking on the 'save' button of a
+        rule set, that only saves the values of that rule set
+        */
+        $('table#ReflexRules_table').delegate('.rule_savebtn', 'click', function(){
+            save_rule_set($(this).closest('tr'));
+        });
+    }
+
+    function get_row_values(row){
+        /**
+        Returns a dict with the values of the inputs and selects of a
+        condition or action row, without the index of the row, e.g.
+        {'range0': '12', 'range1': '14', 'analysisservice': '<as_uid>'}
+        */
+        var values = {};
+        $(row).find('input[name^="ReflexRules."], select[name^="ReflexRules."]')
+            .each(function(index, element){
+                var name = $(element).attr('name').split(':')[0];
+                name = name.split('.')[1].replace(/-\d+$/, '');
+                values[name] = $(element).val() || '';
+            });
+        return values;
+    }
+
+    function get_rule_set(tr){
+        /**
+        Returns the JSON document of the rule set, with the conditions and
+        actions in the order they are displayed:
+        {'trigger': 'submit', 'conditions': [{...}, ...],
+         'actions': [{...}, ...]}
+        */
+        var conditions = $.map($(tr).find('div.conditionscontainer'),
+            function(row){ return get_row_values(row); });
+        var actions = $.map($(tr).find('div.action'),
+            function(row){ return get_row_values(row); });
+        return {
+            trigger: $(tr).find('select[name^="ReflexRules.trigger:"]').val() || '',
+            conditions: conditions,
+            actions: actions
+        };
+    }
+
+    function is_filled_set(rule_set){
+        /**
+        Returns whether the rule set has any condition with an analysis
+        service or any action selected
+        */
+        var filled = function(rows, name){
+            return $.grep(rows, function(row){ return row[name]; }).length > 0;
+        };
+        return filled(rule_set.conditions, 'analysisservice') ||
+            filled(rule_set.actions, 'action');
+    }
+
+    function setup_json_submission(){
+        /**
+        Adds a JSON document per rule set to the form right before it is
+        submitted, so the rule sets are built on the server in a single pass
+        and in the order they are displayed
+        */
+        var table = $('table#ReflexRules_table');
+        $(table).closest('form').bind('submit', function(){
+            $(this).find('input.rules-json').remove();
+            var form = this;
+            $.each($(table).find('tr.records_row_ReflexRules'), function(index, tr){
+                var rule_set = get_rule_set(tr);
+                if (!is_filled_set(rule_set)) {
+                    // Rule sets without values are not saved
+                    return;
+                }
+                $('<input type="hidden" class="rules-json" name="ReflexRules_json:list"/>')
+                    .val(JSON.stringify(rule_set))
+                    .appendTo(form);
+            });
+        });
+    }
+
+    function save_rule_set(tr){
+        /**
+        Posts the values of the rule set to the server, where only this rule
+        set is validated and stored
+        */
+        var _ = window.jarn.i18n.MessageFactory("senaite.core");
+        var status = $(tr).find('.rule_savestatus');
+        $(status).text('');
+        $.ajax({
+            url: $('#rules-setup-data').attr('data-save-url'),
+            type: 'POST',
+            dataType: 'json',
+            data: {
+                rulenumber: $(tr).find('input.rulenumber').val(),
+                rule: JSON.stringify(get_rule_set(tr)),
+                _authenticator: $('input[name="_authenticator"]').val()
+            }
+        }).done(function(result){
+            $(status).text(_('Saved'));
+        }).fail(function(xhr){
+            var error = _('Not saved');
+            try {
+                error = $.parseJSON(xhr.responseText).error || error;
+            } catch (e) {}
+            $(status).text(error);
+        });
+    }
+
     function setup_del_action_button(){
         /**
         This function defines the process to do after clicking on the
@@ -477,8 +660,7 @@ jQuery(function($){
         is discrete
         */
         // Select the option
-        var rules = $.parseJSON($('#rules-setup-data')
-            .html()).saved_actions.rules;
+        var rules = setupdata.saved_actions.rules;
         var ass = $('select[id^="ReflexRules-analysisservice-"]').first();
         var action_sets = $('div.actions-set');
         var discrete;
@@ -775,7 +957,7 @@ jQuery(function($){
         //Check if the selected analysis service has discrete values
         var method = $('select[id="Method"]').find(":selected").attr('value');
         var as_uid = $(as).find(":selected").attr('value');
-        var setupdata = $.parseJSON($('#rules-setup-data').html());
+        var setupdata = get_setupdata();
         var as_info = setupdata[method].analysisservices[as_uid];
         if (as_info === undefined){
             var _ = window.jarn.i18n.MessageFactory("senaite.core");
@@ -839,8 +1021,13 @@ jQuery(function($){
         rawprefix = rawprefix == 'setresult' ? 'set' : rawprefix;
         rawprefix = rawprefix == 'new_analysis' ? 'new' : rawprefix;
         var maxnum = 0;
-        $('.derivative-id').each(function(index, element) {
-            var valid = $(this).val();
+        var local_ids = $.map($('.derivative-id'), function(element) {
+            return $(element).val();
+        });
+        // Local ids of the rules from other pages
+        local_ids = local_ids.concat(get_hidden_local_ids(true),
+                                     get_hidden_local_ids(false));
+        $.each(local_ids, function(index, valid) {
             if (valid.match("^"+rawprefix+"-")) {
                 var num = valid.split(/-/);
                 num = parseInt(num[1]);
@@ -880,6 +1067,13 @@ jQuery(function($){
                 });
                 prevtr = $(prevtr).prev();
             }
+            // Local ids from the rules of previous pages
+            if (!$(element).closest('tr').hasClass('rulenumber-0')) {
+                $.each(get_hidden_local_ids(true), function(index, did) {
+                    var optd = did == selected ? " selected" : "";
+                    options.push('<option value="'+did+'"'+optd+'>'+did+'</option>');
+                });
+            }
             // Sort the options and add them to the selection list
             options = options.sort();
             // Add the original analysis at the end
@@ -918,6 +1112,13 @@ jQuery(function($){
                 });
                 prevtr = $(prevtr).prev();
             }
+            // Local ids from the rules of previous pages
+            if (!$(element).closest('tr').hasClass('rulenumber-0')) {
+                $.each(get_hidden_local_ids(true), function(index, did) {
+                    var optd = did == selected ? " selected" : "";
+                    options.push('<option value="'+did+'"'+optd+'>'+did+'</option>');
+                });
+            }
             // Add Original analysis to the list,
             // sort the options and add them to the selection list
             options.push('<option value="original">Original Analysis</option>');
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from persistent import Persistent
+
+
+class ReflexRuleRecord(Persistent):
+    """Persistent record of a single set of conditions and actions, so rules
+    can be loaded and written one by one
+    """
+
+    def __init__(self, rule):
+        self.rule = rule
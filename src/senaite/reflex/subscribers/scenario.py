@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from senaite.reflex.index import reindex_rules
+from senaite.reflex.index import reindex_scenario
+from senaite.reflex.index import unindex_scenario
+
+
+def ObjectModifiedEventHandler(scenario, event):
+    """Actions to be done when a Reflex Testing Scenario is created or edited
+    """
+    # Only the rules changed are indexed again, if known
+    field = scenario.getField("ReflexRules")
+    rulenumbers = field.get_changed_rulenumbers(scenario)
+    if rulenumbers is None:
+        reindex_scenario(scenario)
+    else:
+        reindex_rules(scenario, rulenumbers)
+
+
+def ObjectTransitionedEventHandler(scenario, event):
+    """Actions to be done when a Reflex Testing Scenario is transitioned, so
+    deactivated scenarios are no longer dispatched
+    """
+    reindex_scenario(scenario)
+
+
+def ObjectRemovedEventHandler(scenario, event):
+    """Actions to be done when a Reflex Testing Scenario is removed
+    """
+    unindex_scenario(scenario)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+"""Helpers to count the catalog searches and ZODB loads done by a block of
+code, so tests can assert a budget instead of measuring times:
+
+    with QueryCounter(portal) as counter:
+        analysis._reflex_rule_process("submit")
+    self.assertLessEqual(counter.searches, 1)
+"""
+
+from collections import defaultdict
+
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from Products.ZCatalog.Catalog import Catalog
+
+# Counters currently active
+_ACTIVE = []
+
+# Original Catalog.searchResults
+_search_results = Catalog.searchResults
+
+
+def _counting_search_results(self, *args, **kwargs):
+    """Catalog.searchResults, that counts the search in the active counters
+    """
+    if _ACTIVE:
+        catalog = aq_parent(aq_inner(self))
+        catalog_id = catalog is not None and catalog.getId() or ""
+        for counter in _ACTIVE:
+            counter.count_search(catalog_id)
+    return _search_results(self, *args, **kwargs)
+
+
+class QueryCounter(object):
+    """Context manager that counts the searches done against any catalog
+    (including reference_catalog and uid_catalog) and the objects loaded
+    from the ZODB by the connection of the portal within the block
+    """
+
+    def __init__(self, portal):
+        self.connection = portal._p_jar
+        self.catalogs = defaultdict(int)
+        self.loads = 0
+
+    def __enter__(self):
+        if not _ACTIVE:
+            Catalog.searchResults = _counting_search_results
+        _ACTIVE.append(self)
+        # Reset the load counter of the connection
+        self.connection.getTransferCounts(True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.loads, stores = self.connection.getTransferCounts(True)
+        _ACTIVE.remove(self)
+        if not _ACTIVE:
+            Catalog.searchResults = _search_results
+
+    def count_search(self, catalog_id):
+        self.catalogs[catalog_id] += 1
+
+    @property
+    def searches(self):
+        """Returns the number of searches done against any catalog
+        """
+        return sum(self.catalogs.values())
+
+    @property
+    def reference_lookups(self):
+        """Returns the number of searches done against the reference catalog
+        """
+        return self.catalogs.get("reference_catalog", 0)
+
+    def __repr__(self):
+        return "<QueryCounter searches={} ({}) loads={}>".format(
+            self.searches, dict(self.catalogs), self.loads)
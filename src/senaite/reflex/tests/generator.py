@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+"""Generator of synthetic reflex testing data.
+
+It is used by the tests to build large fixtures, and can be run with the
+Zope instance script to reproduce production-sized loads, e.g. on top of a
+DemoStorage:
+
+    bin/instance run src/senaite/reflex/tests/generator.py --portal senaite \\
+        --services 50 --scenarios 5 --rules 20 --samples 100 --chain 5
+
+Nothing is committed unless --commit is passed.
+"""
+
+import argparse
+import sys
+from datetime import datetime
+
+import transaction
+from Testing.makerequest import makerequest
+from bika.lims import api
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from bika.lims.workflow import doActionFor
+from senaite.reflex import logger
+from senaite.reflex.monkeys.content.reflexrule import doActionToAnalysis
+from zope.globalrequest import setRequest
+from zope.lifecycleevent import modified
+
+# Number of objects created between savepoints
+SAVEPOINT_SIZE = 100
+
+
+def get_rule(rulenumber, services, num_conditions, action="duplicate"):
+    """Returns a valid rule set, with conditions that expect results between
+    rulenumber*10 and rulenumber*10 + 5. The rules of a scenario share the
+    service they are bound to, the first service passed in, and all the
+    conditions are set on that service, so the rule is met when the result
+    of the analysis is in range
+    """
+    mother_service_uid = api.get_uid(services[0])
+    low = rulenumber * 10
+    conditions = map(lambda num: {
+        "analysisservice": mother_service_uid,
+        "and_or": num < num_conditions - 1 and "and" or "no",
+        "cond_row_idx": num,
+        "discreteresult": "",
+        "range0": str(low),
+        "range1": str(low + 5),
+    }, range(num_conditions))
+    actions = [{
+        "act_row_idx": 0,
+        "action": action,
+        "an_result_id": "{}-{}".format(action[:3], rulenumber),
+        "analyst": "",
+        "otherWS": "no_ws",
+        "setresultdiscrete": "",
+        "setresulton": "original",
+        "setresultvalue": "",
+        "showinreport": "",
+        "worksheettemplate": "",
+    }]
+    return {
+        "rulenumber": str(rulenumber),
+        "trigger": "submit",
+        "mother_service_uid": mother_service_uid,
+        "conditions": conditions,
+        "actions": actions,
+    }
+
+
+class Generator(object):
+    """Creates methods, services, Reflex Testing Scenarios, samples and
+    chains of derivatives. A savepoint is done every savepoint_size objects,
+    so large amounts of objects can be created within a single transaction
+    """
+
+    def __init__(self, portal, savepoint_size=SAVEPOINT_SIZE):
+        self.portal = portal
+        self.setup = api.get_bika_setup()
+        self.savepoint_size = savepoint_size
+        self.created = 0
+        self._client = None
+
+    def savepoint(self, count=1):
+        """Adds count to the number of objects created and does a savepoint
+        when the savepoint size is exceeded
+        """
+        self.created += count
+        if self.created >= self.savepoint_size:
+            transaction.savepoint(optimistic=True)
+            self.created = 0
+
+    def create_method(self, title):
+        method = api.create(self.portal.methods, "Method", title=title,
+                            ManualEntryOfResults=True)
+        self.savepoint()
+        return method
+
+    def create_service(self, title, keyword, method):
+        method_uid = api.get_uid(method)
+        service = api.create(self.setup.bika_analysisservices,
+                             "AnalysisService", title=title, Keyword=keyword,
+                             Methods=[method_uid], Method=method_uid)
+        self.savepoint()
+        return service
+
+    def create_services(self, count, method, prefix="S"):
+        return map(lambda num: self.create_service(
+            "Service {}{}".format(prefix, num), "{}{}".format(prefix, num),
+            method), range(count))
+
+    def create_scenario(self, title, method, services, num_rules,
+                        num_conditions, action="duplicate"):
+        """Creates a Reflex Testing Scenario with num_rules rule sets of
+        num_conditions conditions each, bound to the first service passed in
+        """
+        rules = map(lambda num: get_rule(num, services, num_conditions,
+                                         action=action),
+                    range(num_rules))
+        return self.create_scenario_with_rules(title, method, rules)
+
+    def create_scenario_with_rules(self, title, method, rules):
+        """Creates a Reflex Testing Scenario with the rule sets passed in
+        """
+        folder = self.setup.reflextesting_scenarios
+        scenario = api.create(folder, "ReflexTestingScenario", title=title,
+                              Method=api.get_uid(method))
+        scenario.setReflexRules(rules)
+        # Update the dispatch index
+        modified(scenario)
+        self.savepoint()
+        return scenario
+
+    def get_client(self):
+        """Returns a tuple (client, contact, sample type) to create samples
+        """
+        if self._client is None:
+            client = api.create(self.portal.clients, "Client",
+                                Name="Reflex Generator", ClientID="RGEN")
+            contact = api.create(client, "Contact", Firstname="Rita",
+                                 Surname="Mohale")
+            sampletype = api.create(self.setup.bika_sampletypes,
+                                    "SampleType", title="Water", Prefix="W")
+            self._client = (client, contact, sampletype)
+            self.savepoint(3)
+        return self._client
+
+    def create_sample(self, services, method):
+        """Creates and receives a sample with the services passed in, with
+        the method assigned to its analyses
+        """
+        client, contact, sampletype = self.get_client()
+        values = {
+            "Client": api.get_uid(client),
+            "Contact": api.get_uid(contact),
+            "DateSampled": datetime.now().strftime("%Y-%m-%d"),
+            "SampleType": api.get_uid(sampletype),
+        }
+        service_uids = map(api.get_uid, services)
+        sample = create_analysisrequest(client, api.get_request(), values,
+                                        service_uids)
+        doActionFor(sample, "receive")
+        analyses = sample.getAnalyses(full_objects=True)
+        for analysis in analyses:
+            analysis.setMethod(method)
+        self.savepoint(len(analyses) + 1)
+        return sample
+
+    def create_samples(self, count, services, method):
+        return map(lambda num: self.create_sample(services, method),
+                   range(count))
+
+    def build_chain(self, analysis, length, prefix="chain"):
+        """Creates a chain of derivatives from the analysis passed in, with
+        local ids '<prefix>-1' to '<prefix>-<length>'. Returns the last one
+        """
+        derivative = analysis
+        for num in range(length):
+            action = {
+                "action": "duplicate",
+                "otherWS": "no_ws",
+                "an_result_id": "{}-{}".format(prefix, num + 1),
+            }
+            derivative = doActionToAnalysis(derivative, action)
+            self.savepoint()
+        return derivative
+
+    def build_chains(self, analyses, length, prefix="chain"):
+        """Creates a chain of derivatives for each analysis passed in
+        """
+        return map(lambda an: self.build_chain(an, length, prefix=prefix),
+                   analyses)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Creates synthetic reflex testing data")
+    parser.add_argument("--portal", default="senaite",
+                        help="Id of the SENAITE site")
+    parser.add_argument("--user", default="admin",
+                        help="User from the Zope root objects are created as")
+    parser.add_argument("--services", type=int, default=10,
+                        help="Number of services, analyses per sample")
+    parser.add_argument("--scenarios", type=int, default=1,
+                        help="Number of Reflex Testing Scenarios")
+    parser.add_argument("--rules", type=int, default=10,
+                        help="Number of rule sets per scenario")
+    parser.add_argument("--conditions", type=int, default=2,
+                        help="Number of conditions per rule set")
+    parser.add_argument("--samples", type=int, default=10,
+                        help="Number of samples")
+    parser.add_argument("--chain", type=int, default=0,
+                        help="Length of the chain of derivatives built for "
+                             "each analysis")
+    parser.add_argument("--savepoint", type=int, default=SAVEPOINT_SIZE,
+                        help="Number of objects created between savepoints")
+    parser.add_argument("--commit", action="store_true",
+                        help="Commit the transaction")
+    return parser
+
+
+def main(app, argv):
+    from senaite.reflex.worker import setup
+    args = get_parser().parse_args(argv)
+    # Samples are created through a request
+    app = makerequest(app)
+    setRequest(app.REQUEST)
+    portal = setup(app, args.portal, args.user)
+    generator = Generator(portal, savepoint_size=args.savepoint)
+
+    method = generator.create_method("Reflex Generator method")
+    services = generator.create_services(args.services, method)
+    logger.info("{} services created".format(len(services)))
+    for num in range(args.scenarios):
+        # Scenarios are bound to the services in turns
+        service = services[num % len(services)]
+        generator.create_scenario("Reflex Generator scenario {}".format(num),
+                                  method, [service], args.rules,
+                                  args.conditions)
+    logger.info("{} scenarios created".format(args.scenarios))
+    for num in range(args.samples):
+        sample = generator.create_sample(services, method)
+        if args.chain:
+            generator.build_chains(sample.getAnalyses(full_objects=True),
+                                   args.chain)
+        logger.info("Sample {} created ({}/{})".format(
+            api.get_id(sample), num + 1, args.samples))
+
+    if args.commit:
+        transaction.commit()
+        logger.info("Reflex data committed")
+    else:
+        transaction.abort()
+        logger.info("Reflex data discarded, pass --commit to keep it")
+
+
+if __name__ == "__main__":
+    # 'app' is available when run through 'bin/instance run'
+    main(app, sys.argv[1:])  # noqa
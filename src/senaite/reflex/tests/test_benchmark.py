@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+"""Benchmarks of the reflex engine.
+
+Benchmarks only run on level 3, e.g.:
+
+    bin/test -s senaite.reflex -t test_benchmark -a 3
+
+The scale of the fixtures is set with the following environment variables:
+
+    REFLEX_BENCH_SCENARIOS: number of Reflex Testing Scenarios (1)
+    REFLEX_BENCH_RULES: number of rule sets per scenario (10)
+    REFLEX_BENCH_CONDITIONS: number of condition rows per rule set (2)
+    REFLEX_BENCH_CHAIN: length of the chain of derivatives (10)
+    REFLEX_BENCH_ANALYSES: number of analyses of the submitted sample (20)
+    REFLEX_BENCH_REPEAT: number of times each operation is timed (20)
+
+Results are written as JSON to the file set in REFLEX_BENCH_OUTPUT, so runs
+can be compared.
+"""
+
+import json
+import os
+import platform
+import time
+from datetime import datetime
+
+from bika.lims import api
+from bika.lims.workflow import doActionFor
+from senaite.reflex.compiler import get_compiled_rules
+from senaite.reflex.monkeys.content.reflexrule import \
+    _fetch_analysis_for_local_id
+from senaite.reflex.monkeys.content.reflexrule import doActionToAnalysis
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+
+# Name of the environment variables -> default value
+SCALE = {
+    "scenarios": ("REFLEX_BENCH_SCENARIOS", 1),
+    "rules": ("REFLEX_BENCH_RULES", 10),
+    "conditions": ("REFLEX_BENCH_CONDITIONS", 2),
+    "chain": ("REFLEX_BENCH_CHAIN", 10),
+    "analyses": ("REFLEX_BENCH_ANALYSES", 20),
+    "repeat": ("REFLEX_BENCH_REPEAT", 20),
+}
+
+# Results of the benchmarks run so far
+RESULTS = []
+
+
+def get_scale():
+    """Returns a dict with the scale of the fixtures
+    """
+    return dict([(name, api.to_int(os.environ.get(var), default))
+                 for name, (var, default) in SCALE.items()])
+
+
+def write_results(scale):
+    """Writes the results of the benchmarks run so far to the file set in
+    REFLEX_BENCH_OUTPUT, if any
+    """
+    path = os.environ.get("REFLEX_BENCH_OUTPUT")
+    if not path:
+        return
+    output = {
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "scale": scale,
+        "results": RESULTS,
+    }
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+
+def summarize(timings):
+    """Returns a dict with the stats of the timings passed in
+    """
+    return {
+        "repeat": len(timings),
+        "total": sum(timings),
+        "mean": sum(timings) / len(timings),
+        "min": min(timings),
+        "max": max(timings),
+    }
+
+
+def measure(func, repeat):
+    """Calls the function passed in repeat times, with the number of the
+    iteration as the argument, and returns a dict with the timings
+    """
+    timings = []
+    for num in range(repeat):
+        start = time.time()
+        func(num)
+        timings.append(time.time() - start)
+    return summarize(timings)
+
+
+class TestBenchmark(SimpleTestCase):
+    """Benchmarks of the reflex engine
+    """
+    level = 3
+
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        self.scale = get_scale()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Benchmark method")
+        self.services = self.generator.create_services(
+            self.scale["analyses"], self.method)
+        self.service = self.services[0]
+        self.scenarios = map(
+            lambda num: self.generator.create_scenario(
+                "Scenario {}".format(num), self.method, [self.service],
+                self.scale["rules"], self.scale["conditions"]),
+            range(self.scale["scenarios"]))
+        self.sample = self.create_sample()
+        self.analysis = self.get_analysis(self.service)
+        # Results out of the ranges of all rules, so rules are evaluated
+        # but never met
+        self.analysis.setResult("-1")
+
+    def create_sample(self):
+        return self.generator.create_sample(self.services, self.method)
+
+    def get_analysis(self, service):
+        analyses = self.sample.getAnalyses(full_objects=True)
+        service_uid = api.get_uid(service)
+        return filter(lambda an: an.getServiceUID() == service_uid,
+                      analyses)[0]
+
+    def record(self, name, timings):
+        timings["name"] = name
+        RESULTS.append(timings)
+        write_results(self.scale)
+
+    def test_get_action_reflex_rules(self):
+        scenarios = self.scenarios
+
+        def run(num):
+            for scenario in scenarios:
+                scenario.getActionReflexRules(self.analysis, "submit")
+
+        self.record("getActionReflexRules",
+                    measure(run, self.scale["repeat"]))
+
+    def test_are_conditions_met(self):
+        scenario = self.scenarios[0]
+        rules = get_compiled_rules(scenario)
+
+        def run(num):
+            for rule in rules:
+                scenario._areConditionsMet(rule, self.analysis)
+
+        self.record("_areConditionsMet", measure(run, self.scale["repeat"]))
+
+    def test_fetch_analysis_for_local_id(self):
+        last = self.generator.build_chain(self.analysis, self.scale["chain"])
+        local_id = "chain-{}".format(self.scale["chain"])
+
+        def run(num):
+            _fetch_analysis_for_local_id(self.analysis, local_id)
+
+        self.record("_fetch_analysis_for_local_id",
+                    measure(run, self.scale["repeat"]))
+        self.assertEqual(
+            _fetch_analysis_for_local_id(self.analysis, local_id), last)
+
+    def test_do_action_to_analysis(self):
+        def run(num):
+            action = {
+                "action": "duplicate",
+                "otherWS": "no_ws",
+                "an_result_id": "dup-{}".format(num),
+            }
+            doActionToAnalysis(self.analysis, action)
+
+        self.record("doActionToAnalysis", measure(run, self.scale["repeat"]))
+
+    def test_submit(self):
+        timings = []
+        for num in range(self.scale["repeat"]):
+            sample = self.create_sample()
+            analyses = sample.getAnalyses(full_objects=True)
+            for analysis in analyses:
+                analysis.setResult("-1")
+            start = time.time()
+            for analysis in analyses:
+                doActionFor(analysis, "submit")
+            timings.append(time.time() - start)
+
+        timings = summarize(timings)
+        timings["analyses"] = len(self.services)
+        self.record("submit", timings)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestBenchmark))
+    return suite
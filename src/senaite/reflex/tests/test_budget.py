@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import transaction
+from bika.lims import api
+from senaite.reflex.collector import ReflexCollector
+from senaite.reflex.monkeys.content.reflexrule import \
+    _fetch_brain_for_local_id
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.budget import QueryCounter
+from senaite.reflex.tests.generator import Generator
+
+# Maximum number of objects loaded from the ZODB by the submission of an
+# analysis not bound to any rule, with a cold cache
+MAX_LOADS_UNBOUND = 20
+
+
+class TestBudget(SimpleTestCase):
+    """Budgets of catalog searches and ZODB loads of the reflex process
+    """
+
+    def setUp(self):
+        super(TestBudget, self).setUp()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Budget method")
+        self.bound, self.unbound = self.generator.create_services(
+            2, self.method)
+        self.scenario = self.generator.create_scenario(
+            "Budget scenario", self.method, [self.bound], 5, 1)
+        self.sample = self.generator.create_sample(
+            [self.bound, self.unbound], self.method)
+        # Results out of the ranges of all rules
+        for analysis in self.sample.getAnalyses(full_objects=True):
+            analysis.setResult("-1")
+
+    def get_analysis(self, service):
+        analyses = self.sample.getAnalyses(full_objects=True)
+        service_uid = api.get_uid(service)
+        return filter(lambda an: an.getServiceUID() == service_uid,
+                      analyses)[0]
+
+    def process(self, analysis, cold=False):
+        """Runs the reflex process for the analysis in a new transaction and
+        returns the QueryCounter. If cold, the cache of the connection is
+        emptied beforehand
+        """
+        transaction.commit()
+        if cold:
+            self.portal._p_jar.cacheMinimize()
+        with QueryCounter(self.portal) as counter:
+            analysis._reflex_rule_process("submit")
+        return counter
+
+    def test_unbound_analysis(self):
+        counter = self.process(self.get_analysis(self.unbound))
+        self.assertLessEqual(counter.searches, 1, counter)
+        self.assertEqual(counter.reference_lookups, 0, counter)
+
+    def test_unbound_analysis_loads(self):
+        counter = self.process(self.get_analysis(self.unbound), cold=True)
+        self.assertLessEqual(counter.loads, MAX_LOADS_UNBOUND, counter)
+
+    def test_non_matching_analysis(self):
+        # Only the scenario is looked up
+        counter = self.process(self.get_analysis(self.bound))
+        self.assertLessEqual(counter.searches, 1, counter)
+        self.assertEqual(counter.reference_lookups, 0, counter)
+
+    def test_non_matching_derivative(self):
+        analysis = self.get_analysis(self.bound)
+        derivative = self.generator.build_chain(analysis, 3)
+        # Rule with conditions on the derivatives of the chain
+        condition = {
+            "discreteresult": "",
+            "range0": "0",
+            "range1": "5",
+        }
+        rule = {
+            "rulenumber": "0",
+            "trigger": "submit",
+            "mother_service_uid": api.get_uid(self.bound),
+            "conditions": [
+                dict(condition, analysisservice="chain-2", and_or="and",
+                     cond_row_idx=0),
+                dict(condition, analysisservice="chain-3", and_or="no",
+                     cond_row_idx=1),
+            ],
+            "actions": [{
+                "act_row_idx": 0,
+                "action": "duplicate",
+                "an_result_id": "chain-4",
+                "otherWS": "no_ws",
+                "setresulton": "original",
+            }],
+        }
+        self.generator.create_scenario_with_rules(
+            "Chain scenario", self.method, [rule])
+
+        # Both scenarios are looked up, derivatives are searched once
+        counter = self.process(derivative)
+        self.assertLessEqual(counter.searches, 3, counter)
+        self.assertEqual(counter.reference_lookups, 0, counter)
+
+    def test_batch_group(self):
+        analyses = self.sample.getAnalyses(full_objects=True)
+        derivatives = self.generator.build_chains(analyses, 2)
+        transaction.commit()
+        collector = ReflexCollector()
+        for derivative in derivatives:
+            collector.add(derivative, "submit")
+
+        # The derivatives of all the chains of the group are searched at once
+        group = collector.pop_group()
+        self.assertEqual(len(group), len(derivatives))
+        with QueryCounter(self.portal) as counter:
+            group.prefetch()
+            for derivative in derivatives:
+                _fetch_brain_for_local_id(derivative, "chain-1")
+        self.assertEqual(counter.searches, 1, counter)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestBudget))
+    return suite
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import itertools
+
+from bika.lims import api
+from senaite.reflex.compiler import compile_condition
+from senaite.reflex.compiler import compile_rule
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+
+
+def old_resolution(result, condition, has_options):
+    """Resolution of a condition as done by the former _areConditionsMet
+    """
+    if has_options:
+        exp_val = condition.get('discreteresult', '')
+    else:
+        exp_val = (condition.get('range0', ''), condition.get('range1', ''))
+    return ((api.is_floatable(result) and isinstance(exp_val, str) and
+             exp_val == result) or
+            (api.is_floatable(result) and
+             len(exp_val) == 2 and
+             api.is_floatable(exp_val[0]) and
+             api.is_floatable(exp_val[1]) and
+             float(exp_val[0]) <= float(result) and
+             float(result) <= float(exp_val[1])))
+
+
+def old_evaluate(resolutions, operators):
+    """Evaluation of the resolutions of the conditions as done by the former
+    _areConditionsMet, with eval()
+    """
+    eval_str = ''
+    for resolution, and_or in zip(resolutions, operators):
+        if and_or == 'no':
+            eval_str += str(resolution)
+        else:
+            eval_str += str(resolution) + ' ' + and_or + ' '
+    return bool(eval_str and eval(eval_str))
+
+
+def get_rule(operators):
+    conditions = map(lambda and_or: {'analysisservice': 'uid',
+                                     'and_or': and_or}, operators)
+    return compile_rule({'conditions': conditions})
+
+
+class TestCompiler(SimpleTestCase):
+    """Compiled rules evaluate conditions as the former eval() did
+    """
+
+    def test_precedence(self):
+        for size in range(1, 5):
+            for middle in itertools.product(('and', 'or'), repeat=size - 1):
+                operators = list(middle) + ['no']
+                rule = get_rule(operators)
+                for resolutions in itertools.product((True, False),
+                                                     repeat=size):
+                    self.assertEqual(
+                        rule.evaluate(resolutions),
+                        old_evaluate(resolutions, operators),
+                        (operators, resolutions))
+
+    def test_trailing_and(self):
+        # eval() failed with a trailing operator, the compiled rule takes
+        # the last condition as the end of the group instead
+        operators = ['or', 'and']
+        self.assertRaises(SyntaxError, old_evaluate, (True, True), operators)
+        rule = get_rule(operators)
+        for resolutions in itertools.product((True, False), repeat=2):
+            self.assertEqual(rule.evaluate(resolutions),
+                             old_evaluate(resolutions, ['or', 'no']))
+
+    def test_empty(self):
+        rule = get_rule([])
+        self.assertFalse(rule.evaluate(()))
+        self.assertFalse(old_evaluate((), []))
+
+    def test_discrete_and_range(self):
+        conditions = [
+            {'discreteresult': '1', 'range0': '', 'range1': ''},
+            {'discreteresult': '', 'range0': '1', 'range1': '3'},
+            # Stale discrete result with ranges
+            {'discreteresult': '2', 'range0': '5', 'range1': '7'},
+            {'discreteresult': '', 'range0': '', 'range1': ''},
+        ]
+        results = ['', 'abc', '1', '2', '3', '6', '8']
+        for condition in conditions:
+            for has_options in (True, False):
+                # The upgrade flags the conditions from the result options
+                compiled = compile_condition(
+                    dict(condition, discrete=has_options))
+                for result in results:
+                    self.assertEqual(
+                        compiled.matches(result),
+                        bool(old_resolution(result, condition, has_options)),
+                        (condition, has_options, result))
+
+    def test_read_only_results(self):
+        generator = Generator(self.portal)
+        method = generator.create_method("Compiler method")
+        services = generator.create_services(1, method)
+        scenario = generator.create_scenario(
+            "Compiler scenario", method, services, 2, 1)
+        sample = generator.create_sample(services, method)
+        analysis = sample.getAnalyses(full_objects=True)[0]
+        # Within the range of the rule number 1
+        analysis.setResult("12")
+        results = scenario.getActionReflexRules(analysis, "submit")
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(str(result["rulenumber"]), "1")
+        self.assertEqual(result["rulename"], scenario.Title())
+        self.assertEqual(result["scenario_uid"], api.get_uid(scenario))
+        self.assertEqual(result["action"], "duplicate")
+        # Results cannot be modified
+        with self.assertRaises(TypeError):
+            result["rulenumber"] = "0"
+        with self.assertRaises(TypeError):
+            result["action"] = "repeat"
+        # And the stored action rows are left as they were
+        field = scenario.getField("ReflexRules")
+        for rule in field.get(scenario):
+            for action in rule["actions"]:
+                self.assertNotIn("rulenumber", action)
+                self.assertNotIn("rulename", action)
+                self.assertNotIn("scenario_uid", action)
+        self.assertEqual(map(dict, scenario.getActionReflexRules(
+            analysis, "submit")), map(dict, results))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCompiler))
+    return suite
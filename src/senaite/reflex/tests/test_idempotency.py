@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from senaite.reflex.idempotency import is_applied
+from senaite.reflex.monkeys.content.reflexrule import doActionToAnalysis
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+
+
+class TestIdempotency(SimpleTestCase):
+    """Actions are applied only once to the same source analysis
+    """
+
+    def setUp(self):
+        super(TestIdempotency, self).setUp()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Idempotency method")
+        self.services = self.generator.create_services(1, self.method)
+        self.sample = self.generator.create_sample(self.services, self.method)
+        self.analysis = self.sample.getAnalyses(full_objects=True)[0]
+
+    def get_action(self, **kwargs):
+        action = {
+            "action": "duplicate",
+            "otherWS": "no_ws",
+            "an_result_id": "dup-1",
+            "scenario_uid": "scenario-uid",
+            "rulenumber": "0",
+            "act_row_idx": 0,
+        }
+        action.update(kwargs)
+        return action
+
+    def get_analyses_count(self):
+        return len(self.sample.getAnalyses())
+
+    def test_applied_once(self):
+        action = self.get_action()
+        count = self.get_analyses_count()
+        self.assertFalse(is_applied(self.analysis, action))
+        self.assertIsNotNone(doActionToAnalysis(self.analysis, action))
+        self.assertTrue(is_applied(self.analysis, action))
+        # Applying the same action again does not create another derivative
+        self.assertIsNone(doActionToAnalysis(self.analysis, dict(action)))
+        self.assertEqual(self.get_analyses_count(), count + 1)
+
+    def test_different_actions(self):
+        count = self.get_analyses_count()
+        actions = [
+            self.get_action(),
+            self.get_action(act_row_idx=1),
+            self.get_action(rulenumber="1"),
+            self.get_action(scenario_uid="other-scenario-uid"),
+        ]
+        for action in actions:
+            self.assertIsNotNone(doActionToAnalysis(self.analysis, action))
+        self.assertEqual(self.get_analyses_count(), count + len(actions))
+
+    def test_different_sources(self):
+        action = self.get_action()
+        derivative = doActionToAnalysis(self.analysis, action)
+        # The same action applied to the derivative is not deduplicated
+        self.assertFalse(is_applied(derivative, action))
+        self.assertIsNotNone(doActionToAnalysis(derivative, action))
+
+    def test_without_key(self):
+        # Actions that do not tell the scenario and rule are always applied
+        action = self.get_action(scenario_uid=None)
+        count = self.get_analyses_count()
+        self.assertIsNotNone(doActionToAnalysis(self.analysis, action))
+        self.assertIsNotNone(doActionToAnalysis(self.analysis, action))
+        self.assertFalse(is_applied(self.analysis, action))
+        self.assertEqual(self.get_analyses_count(), count + 2)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestIdempotency))
+    return suite
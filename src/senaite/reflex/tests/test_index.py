@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from bika.lims import api
+from bika.lims.workflow import doActionFor
+from senaite.reflex import index
+from senaite.reflex.index import get_dispatch_index
+from senaite.reflex.index import has_rules
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+from zope.lifecycleevent import modified
+
+
+class TestIndex(SimpleTestCase):
+    """Dispatch index of the rules from active Reflex Testing Scenarios
+    """
+
+    def setUp(self):
+        super(TestIndex, self).setUp()
+        # Oids are reused by the isolated storages of the tests
+        index._BOUND_UIDS.clear()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Index method")
+        self.bound, self.unbound = self.generator.create_services(
+            2, self.method)
+        self.scenario = self.generator.create_scenario(
+            "Index scenario", self.method, [self.bound], 2, 1)
+
+    def search(self, service):
+        """Returns the rule numbers of the scenario indexed for the service
+        passed in
+        """
+        candidates = get_dispatch_index().search(
+            api.get_uid(self.method), [api.get_uid(service)], "submit")
+        return candidates.get(api.get_uid(self.scenario), set())
+
+    def test_created(self):
+        self.assertEqual(self.search(self.bound), set(["0", "1"]))
+        self.assertEqual(self.search(self.unbound), set())
+
+    def test_modified(self):
+        rules = self.scenario.getReflexRules()
+        for condition in rules[1]["conditions"]:
+            condition["analysisservice"] = api.get_uid(self.unbound)
+        self.scenario.setReflexRules(rules)
+        modified(self.scenario)
+        self.assertEqual(self.search(self.bound), set(["0"]))
+        self.assertEqual(self.search(self.unbound), set(["1"]))
+
+    def test_modified_window(self):
+        field = self.scenario.getField("ReflexRules")
+        rule = field.get_rule(self.scenario, 1)
+        for condition in rule["conditions"]:
+            condition["analysisservice"] = api.get_uid(self.unbound)
+        # The mother rule followed by the rules of the window, that are the
+        # only ones indexed again
+        mother = field.get_rule(self.scenario, 0)
+        field.set(self.scenario, [mother, rule], window=(1, 2))
+        modified(self.scenario)
+        self.assertEqual(self.search(self.bound), set(["0"]))
+        self.assertEqual(self.search(self.unbound), set(["1"]))
+
+    def test_transitioned(self):
+        doActionFor(self.scenario, "deactivate")
+        self.assertEqual(self.search(self.bound), set())
+        doActionFor(self.scenario, "activate")
+        self.assertEqual(self.search(self.bound), set(["0", "1"]))
+
+    def test_removed(self):
+        folder = api.get_parent(self.scenario)
+        folder.manage_delObjects([api.get_id(self.scenario)])
+        self.assertEqual(self.search(self.bound), set())
+        self.assertEqual(get_dispatch_index().get_bound_uids(),
+                         (frozenset(), frozenset()))
+
+    def test_has_rules(self):
+        sample = self.generator.create_sample([self.bound, self.unbound],
+                                              self.method)
+        analyses = dict(map(lambda an: (an.getServiceUID(), an),
+                            sample.getAnalyses(full_objects=True)))
+        bound = analyses[api.get_uid(self.bound)]
+        unbound = analyses[api.get_uid(self.unbound)]
+        self.assertTrue(has_rules(bound))
+        # Analyses from services not bound to any rule are skipped
+        self.assertFalse(has_rules(unbound))
+        # So are analyses with a method not bound to any rule
+        other_method = self.generator.create_method("Other method")
+        bound.setMethod(other_method)
+        self.assertFalse(has_rules(bound))
+
+    def test_has_rules_inactive(self):
+        sample = self.generator.create_sample([self.bound], self.method)
+        analysis = sample.getAnalyses(full_objects=True)[0]
+        self.assertTrue(has_rules(analysis))
+        doActionFor(self.scenario, "deactivate")
+        self.assertFalse(has_rules(analysis))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestIndex))
+    return suite
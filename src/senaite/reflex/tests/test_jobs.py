@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import transaction
+from bika.lims import api
+from senaite.reflex.jobs import JobQueue
+from senaite.reflex.jobs import ReflexJob
+from senaite.reflex.jobs import get_job_queue
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+from senaite.reflex.worker import LeaseLost
+from senaite.reflex.worker import apply_job
+from senaite.reflex.worker import get_worker_samples
+
+# Seconds of the leases that do not expire during the tests
+LEASE = 300
+
+
+class TestJobs(SimpleTestCase):
+    """Leases of the samples of the reflex jobs to the workers
+    """
+
+    def setUp(self):
+        super(TestJobs, self).setUp()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Jobs method")
+        self.services = self.generator.create_services(1, self.method)
+        self.samples = self.generator.create_samples(
+            3, self.services, self.method)
+        self.sample_uids = map(api.get_uid, self.samples)
+        self.queue = JobQueue()
+        self.keys = map(self.put, self.samples)
+
+    def put(self, sample):
+        """Adds a job for the analysis of the sample passed in to the queue
+        """
+        analysis = sample.getAnalyses(full_objects=True)[0]
+        return self.queue.put(ReflexJob(analysis, [{"action": "duplicate"}]))
+
+    def test_claim(self):
+        sample_uid = self.sample_uids[0]
+        self.assertTrue(self.queue.claim(sample_uid, "w1", LEASE))
+        # Leases are exclusive
+        self.assertFalse(self.queue.claim(sample_uid, "w2", LEASE))
+        # But can be renewed by their owner
+        self.assertTrue(self.queue.claim(sample_uid, "w1", LEASE))
+        self.assertEqual(self.queue.leases(), {sample_uid: "w1"})
+
+    def test_release(self):
+        sample_uid = self.sample_uids[0]
+        self.queue.claim(sample_uid, "w1", LEASE)
+        # Only the owner releases the lease
+        self.queue.release(sample_uid, "w2")
+        self.assertEqual(self.queue.leases(), {sample_uid: "w1"})
+        self.queue.release(sample_uid, "w1")
+        self.assertEqual(self.queue.leases(), {})
+        self.assertTrue(self.queue.claim(sample_uid, "w2", LEASE))
+
+    def test_expired(self):
+        sample_uid = self.sample_uids[0]
+        self.queue.claim(sample_uid, "w1", -1)
+        # Expired leases are not active and are taken over by other workers
+        self.assertEqual(self.queue.leases(), {})
+        self.assertTrue(self.queue.claim(sample_uid, "w2", LEASE))
+        self.assertEqual(self.queue.leases(), {sample_uid: "w2"})
+        self.assertFalse(self.queue.claim(sample_uid, "w1", LEASE))
+
+    def test_keys_by_sample(self):
+        self.queue.claim(self.sample_uids[0], "w1", LEASE)
+        self.queue.claim(self.sample_uids[1], "w2", -1)
+        samples = self.queue.keys_by_sample(worker="w2")
+        # Samples leased by other workers are skipped
+        self.assertEqual(samples, dict(zip(self.sample_uids[1:],
+                                           map(lambda key: [key],
+                                               self.keys[1:]))))
+        # All samples are returned if no worker is given
+        self.assertEqual(sorted(self.queue.keys_by_sample().keys()),
+                         sorted(self.sample_uids))
+
+    def test_worker_samples(self):
+        self.queue.claim(self.sample_uids[0], "w1", LEASE)
+        samples = dict(get_worker_samples(self.queue, "w1"))
+        self.assertEqual(sorted(samples.keys()), sorted(self.sample_uids))
+        samples = dict(get_worker_samples(self.queue, "w2"))
+        self.assertEqual(sorted(samples.keys()),
+                         sorted(self.sample_uids[1:]))
+        self.assertEqual(get_worker_samples(JobQueue(), "w1"), [])
+
+    def test_lease_lost(self):
+        queue = get_job_queue(create=True)
+        key = queue.put(ReflexJob(
+            self.samples[0].getAnalyses(full_objects=True)[0],
+            [{"action": "duplicate"}]))
+        queue.claim(self.sample_uids[0], "w1", LEASE)
+        transaction.commit()
+        # The job is not applied by a worker not owning the lease
+        self.assertRaises(LeaseLost, apply_job, key, worker="w2")
+        self.assertEqual(get_job_queue().get(key).attempts, 0)
+        self.assertEqual(get_job_queue().leases(),
+                         {self.sample_uids[0]: "w1"})
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestJobs))
+    return suite
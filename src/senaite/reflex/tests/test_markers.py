@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from bika.lims import api
+from senaite.reflex.markers import TriggeredMarkers
+from senaite.reflex.markers import add_triggered
+from senaite.reflex.markers import get_markers_storage
+from senaite.reflex.markers import get_triggered_markers
+from senaite.reflex.markers import is_triggered
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+
+
+class TestMarkers(SimpleTestCase):
+    """Markers of the reflex rules triggered for analyses
+    """
+
+    def setUp(self):
+        super(TestMarkers, self).setUp()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Markers method")
+        self.services = self.generator.create_services(2, self.method)
+        self.sample = self.generator.create_sample(self.services, self.method)
+        self.analysis, self.sibling = self.sample.getAnalyses(
+            full_objects=True)
+
+    def test_per_analysis(self):
+        self.analysis.addReflexRuleActionsTriggered("uid.1|uid.2")
+        self.assertTrue(is_triggered(self.analysis, "uid.1"))
+        self.assertFalse(is_triggered(self.sibling, "uid.1"))
+        self.assertEqual(self.analysis.getReflexRuleActionsTriggered(),
+                         "uid.1|uid.2")
+        self.assertEqual(self.sibling.getReflexRuleActionsTriggered(), "")
+
+    def test_derivatives(self):
+        self.analysis.addReflexRuleActionsTriggered("uid.1")
+        derivative = self.generator.build_chain(self.analysis, 1)
+        # Derivatives start with the markers of their source
+        self.assertTrue(is_triggered(derivative, "uid.1"))
+        # But markers added afterwards are not shared
+        self.analysis.addReflexRuleActionsTriggered("uid.2")
+        derivative.addReflexRuleActionsTriggered("uid.3")
+        self.assertFalse(is_triggered(derivative, "uid.2"))
+        self.assertFalse(is_triggered(self.analysis, "uid.3"))
+
+    def test_legacy(self):
+        field = self.analysis.getField("ReflexRuleActionsTriggered")
+        field.set(self.analysis, "uid.1|uid.2")
+        # Legacy markers are read, but not migrated
+        self.assertEqual(get_triggered_markers(self.analysis),
+                         frozenset(["uid.1", "uid.2"]))
+        self.assertEqual(field.get(self.analysis), "uid.1|uid.2")
+        # Legacy markers are migrated when a marker is added
+        self.analysis.addReflexRuleActionsTriggered("uid.3")
+        self.assertEqual(field.get(self.analysis), "")
+        self.assertEqual(self.analysis.getReflexRuleActionsTriggered(),
+                         "uid.1|uid.2|uid.3")
+
+    def get_state(self, state, *markers):
+        """Returns the state of a copy of the storage with the state passed
+        in, after adding the (uid, marker) tuples passed in
+        """
+        storage = TriggeredMarkers()
+        storage.__setstate__(state)
+        for uid, marker in markers:
+            storage.add(uid, [marker])
+        return storage.__getstate__()
+
+    def test_resolve_conflict(self):
+        uid = api.get_uid(self.analysis)
+        sibling_uid = api.get_uid(self.sibling)
+        storage = TriggeredMarkers()
+        storage.add(uid, ["uid.1"])
+        old = storage.__getstate__()
+        saved = self.get_state(old, (uid, "uid.2"), (sibling_uid, "uid.3"))
+        new = self.get_state(old, (uid, "uid.4"))
+        resolved = storage._p_resolveConflict(old, saved, new)
+        self.assertEqual(resolved["_markers"], {
+            uid: frozenset(["uid.1", "uid.2", "uid.4"]),
+            sibling_uid: frozenset(["uid.3"]),
+        })
+
+    def test_resolve_legacy_conflict(self):
+        uid = api.get_uid(self.analysis)
+        sibling_uid = api.get_uid(self.sibling)
+        self.sibling.addReflexRuleActionsTriggered("uid.1")
+        storage = get_markers_storage(self.sibling)
+        old = storage.__getstate__()
+        # A transaction migrates the legacy markers of the analysis
+        field = self.analysis.getField("ReflexRuleActionsTriggered")
+        field.set(self.analysis, "uid.2|uid.3")
+        add_triggered(self.analysis, "uid.4")
+        saved = storage.__getstate__()
+        # While another one adds a marker to the sibling
+        new = self.get_state(old, (sibling_uid, "uid.5"))
+        resolved = storage._p_resolveConflict(old, saved, new)
+        self.assertEqual(resolved["_markers"], {
+            uid: frozenset(["uid.2", "uid.3", "uid.4"]),
+            sibling_uid: frozenset(["uid.1", "uid.5"]),
+        })
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestMarkers))
+    return suite
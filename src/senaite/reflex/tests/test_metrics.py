@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+from bika.lims import api
+from senaite.reflex.interfaces import ILayer
+from senaite.reflex.metrics import REGISTRY
+from senaite.reflex.metrics import inc
+from senaite.reflex.metrics import timed
+from senaite.reflex.tests.base import SimpleTestCase
+from zope.interface import alsoProvides
+
+
+class TestMetrics(SimpleTestCase):
+    """Statistics views of the reflex engine
+    """
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        alsoProvides(self.request, ILayer)
+        REGISTRY.reset()
+        inc("reflex_actions_total", action="duplicate", result="done")
+        inc("reflex_actions_total", action="duplicate", result="done")
+        inc("reflex_cache_requests_total", cache="rules", result="hit")
+        inc("reflex_cache_requests_total", cache="rules", result="hit")
+        inc("reflex_cache_requests_total", cache="rules", result="hit")
+        inc("reflex_cache_requests_total", cache="rules", result="miss")
+        with timed("reflex_action_seconds", action="duplicate"):
+            pass
+
+    def tearDown(self):
+        REGISTRY.reset()
+        super(TestMetrics, self).tearDown()
+
+    def get_view(self, name):
+        folder = api.get_bika_setup().reflextesting_scenarios
+        return api.get_view(name, context=folder, request=self.request)
+
+    def test_text(self):
+        text = self.get_view("reflex_metrics.txt")()
+        lines = text.splitlines()
+        self.assertIn("# TYPE reflex_actions_total counter", lines)
+        self.assertIn('reflex_actions_total{action="duplicate",'
+                      'result="done"} 2', lines)
+        self.assertIn('reflex_cache_requests_total{cache="rules",'
+                      'result="miss"} 1', lines)
+        self.assertIn("# TYPE reflex_action_seconds histogram", lines)
+        self.assertIn('reflex_action_seconds_bucket{action="duplicate",'
+                      'le="+Inf"} 1', lines)
+        self.assertIn('reflex_action_seconds_count{action="duplicate"} 1',
+                      lines)
+        self.assertTrue(self.request.response.getHeader(
+            "Content-Type").startswith("text/plain"))
+
+    def test_html(self):
+        html = self.get_view("reflex_metrics")()
+        self.assertIn("reflex_actions_total", html)
+        self.assertIn("reflex_action_seconds", html)
+        # Hit rate of the rules cache
+        self.assertIn("75.0 %", html)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestMetrics))
+    return suite
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import json
+
+from bika.lims import api
+from senaite.reflex.rulesetup import get_rule_setup
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+
+
+class TestRuleSetup(SimpleTestCase):
+    """Setup data of the rules widget
+    """
+
+    def setUp(self):
+        super(TestRuleSetup, self).setUp()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Setup method")
+        self.service = self.generator.create_service(
+            "Setup service", "SETUP", self.method)
+
+    def get_view(self, etag=None, method=None):
+        request = self.request
+        request.response.setStatus(200)
+        request.form.pop("method", None)
+        if method is not None:
+            request.form["method"] = method and api.get_uid(method) or ""
+        request.environ.pop("HTTP_IF_NONE_MATCH", None)
+        if etag:
+            request.environ["HTTP_IF_NONE_MATCH"] = etag
+        folder = api.get_bika_setup().reflextesting_scenarios
+        return api.get_view("reflex_rule_setup.json", context=folder,
+                            request=request)
+
+    def test_setup(self):
+        etag, setup, setup_json = get_rule_setup()
+        method = setup[api.get_uid(self.method)]
+        self.assertIn(api.get_uid(self.service), method["as_keys"])
+        self.assertEqual(json.loads(setup_json)[api.get_uid(self.method)],
+                         json.loads(json.dumps(method)))
+
+    def test_cache(self):
+        etag, setup, setup_json = get_rule_setup()
+        self.assertIs(get_rule_setup()[1], setup)
+
+        # The setup is built again when the setup catalog changes
+        service = self.generator.create_service(
+            "Setup service 2", "SETUP2", self.method)
+        new_etag, new_setup, new_json = get_rule_setup()
+        self.assertNotEqual(new_etag, etag)
+        self.assertIn(api.get_uid(service),
+                      new_setup[api.get_uid(self.method)]["as_keys"])
+
+    def test_etag(self):
+        etag = get_rule_setup()[0]
+        self.assertTrue(self.get_view()())
+        self.assertEqual(self.request.response.getHeader("ETag"), etag)
+        self.assertEqual(self.get_view(etag)(), "")
+        self.assertEqual(self.request.response.getStatus(), 304)
+
+    def test_method(self):
+        other = self.generator.create_method("Other method")
+        method_uid = api.get_uid(self.method)
+        setup = json.loads(self.get_view(method=self.method)())
+        self.assertEqual(setup.keys(), [method_uid])
+        self.assertEqual(setup[method_uid]["as_keys"],
+                         [api.get_uid(self.service)])
+        # ETags differ per method
+        etag = self.request.response.getHeader("ETag")
+        self.assertEqual(json.loads(self.get_view(method=other)()), {})
+        self.assertNotEqual(self.request.response.getHeader("ETag"), etag)
+        # No setup is returned for an empty method
+        self.assertEqual(json.loads(self.get_view(method="")()), {})
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestRuleSetup))
+    return suite
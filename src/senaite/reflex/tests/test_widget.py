@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import json
+import re
+
+import transaction
+from bika.lims import api
+from plone.registry.interfaces import IRegistry
+from senaite.reflex.browser.fields import RULES_STORAGE_KEY
+from senaite.reflex.tests.base import SimpleTestCase
+from senaite.reflex.tests.generator import Generator
+from zope.component import getUtility
+
+
+class TestWidget(SimpleTestCase):
+    """Rendering of the rules widget
+    """
+
+    def setUp(self):
+        super(TestWidget, self).setUp()
+        self.generator = Generator(self.portal)
+        self.method = self.generator.create_method("Widget method")
+        self.services = self.generator.create_services(2, self.method)
+        self.scenario = self.generator.create_scenario(
+            "Widget scenario", self.method, self.services, 3, 2)
+
+    def get_widget(self):
+        field = self.scenario.getField("ReflexRules")
+        return field.widget.__of__(self.scenario)
+
+    def test_rendering_model(self):
+        widget = self.get_widget()
+        model = widget.getRenderingModel()
+        self.assertIs(widget.getRenderingModel(), model)
+        self.assertEqual(len(model.rules), 3)
+
+    def test_accessors(self):
+        widget = self.get_widget()
+        self.assertEqual(widget.getReflexRuleElement(2, "trigger"), "submit")
+        self.assertEqual(
+            widget.getReflexRuleConditionElement(2, 1, "range0"), "20")
+        self.assertEqual(
+            widget.getReflexRuleActionElement(1, 0, "an_result_id"), "dup-1")
+        # Rows not saved return the defaults
+        self.assertEqual(
+            widget.getReflexRuleConditionElement(5, 0, "and_or"), "no")
+        self.assertEqual(
+            widget.getReflexRuleActionElement(5, 0, "otherWS"), "current")
+
+    def test_keyed_rows_order(self):
+        widget = self.get_widget()
+        raw_set = {"trigger": "submit"}
+        for num in range(12):
+            raw_set["action-{}".format(num)] = "duplicate"
+            raw_set["an_result_id-{}".format(num)] = "dup-{}".format(num)
+        actions = widget._format_conditions_and_actions(raw_set)["actions"]
+        self.assertEqual(map(lambda action: action["an_result_id"], actions),
+                         map(lambda num: "dup-{}".format(num), range(12)))
+        self.assertEqual(actions[10]["act_row_idx"], 10)
+
+    def test_json_sets(self):
+        widget = self.get_widget()
+        service_uid = api.get_uid(self.services[0])
+        document = {
+            "trigger": "verify",
+            "conditions": [
+                {"analysisservice": service_uid, "range0": "1",
+                 "range1": "2", "and_or": "no"},
+                {"analysisservice": "", "and_or": "no"},
+            ],
+            "actions": map(lambda num: {
+                "action": "repeat", "an_result_id": "rep-{}".format(num)},
+                range(12)),
+        }
+        field = self.scenario.getField("ReflexRules")
+        empty = {
+            "trigger": "submit",
+            "conditions": [{"analysisservice": "", "and_or": "no"}],
+            "actions": [{"action": "", "an_result_id": ""}],
+        }
+        form = {"ReflexRules_json": map(json.dumps, [document, empty])}
+        value, kwargs = widget.process_form(self.scenario, field, form)
+        # Rule sets without values are ignored
+        self.assertEqual(len(value), 1)
+        rule = value[0]
+        self.assertEqual(rule["trigger"], "verify")
+        self.assertEqual(rule["rulenumber"], "0")
+        self.assertEqual(rule["mother_service_uid"], service_uid)
+        # Conditions without service are kept, as with the form values, so
+        # they are reported on validation
+        self.assertEqual(len(rule["conditions"]), 2)
+        self.assertTrue(field.validate(value, self.scenario))
+        self.assertEqual(map(lambda action: action["an_result_id"],
+                             rule["actions"]),
+                         map(lambda num: "rep-{}".format(num), range(12)))
+
+    def test_pagination(self):
+        registry = getUtility(IRegistry)
+        registry["senaite.reflex.rules_page_size"] = 1
+        self.request.form["rules_start"] = "2"
+        widget = self.get_widget()
+        self.assertEqual(widget.getRulesWindow(), (2, 3))
+        self.assertEqual(widget.getRenderedRuleNumbers(), [0, 2, 3])
+        self.assertEqual(len(widget.getRulesPages()), 2)
+        saved = widget.getSavedActions()
+        self.assertEqual(map(lambda rule: rule["rulenumber"],
+                             saved["rules"]), [0, 2])
+        self.assertEqual(saved["previous_local_ids"], ["dup-1"])
+        # Only the rules from the window are read
+        self.assertEqual(len(widget.getRenderingModel().rules), 2)
+
+        # Only the rules from the window are stored when the form is saved
+        transaction.commit()
+        records = getattr(self.scenario, RULES_STORAGE_KEY)
+        rules = self.scenario.getReflexRules()
+        documents = [rules[0], dict(rules[2], trigger="verify")]
+        form = {
+            "ReflexRules_json": map(json.dumps, documents),
+            "ReflexRules_window": "2:3",
+        }
+        field = self.scenario.getField("ReflexRules")
+        value, kwargs = widget.process_form(self.scenario, field, form)
+        self.assertEqual(kwargs, {"window": (2, 3)})
+        self.assertEqual(map(lambda rule: rule["rulenumber"], value),
+                         ["0", "2"])
+        self.scenario.setReflexRules(value, **kwargs)
+        self.assertEqual(map(lambda rule: rule["trigger"],
+                             self.scenario.getReflexRules()),
+                         ["submit", "submit", "verify"])
+        self.assertFalse(records[1]._p_changed)
+
+        # Rules after the window are numbered again if rules are removed
+        self.scenario.setReflexRules(value[:1], window=(1, 2))
+        rules = self.scenario.getReflexRules()
+        self.assertEqual(map(lambda rule: rule["rulenumber"], rules), [0, 1])
+        self.assertEqual(rules[1]["trigger"], "verify")
+        self.assertEqual(field.get_local_ids(self.scenario, 1), ["dup-2"])
+
+    def test_render_loads(self):
+        scenario = self.generator.create_scenario(
+            "Large scenario", self.method, self.services, 20, 1)
+        registry = getUtility(IRegistry)
+        registry["senaite.reflex.rules_page_size"] = 2
+        self.request.form["rules_start"] = "2"
+        transaction.commit()
+        records = getattr(scenario, RULES_STORAGE_KEY)
+        self.portal._p_jar.cacheMinimize()
+        scenario.widget("ReflexRules", mode="edit")
+        # Only the records of the mother rule and the page are loaded
+        loaded = filter(lambda num: records[num]._p_changed is not None,
+                        records.keys())
+        self.assertEqual(loaded, [0, 2, 3])
+
+    def test_save_rule(self):
+        transaction.commit()
+        records = getattr(self.scenario, RULES_STORAGE_KEY)
+        raw_set = {
+            "trigger": "verify",
+            "analysisservice-0": api.get_uid(self.services[0]),
+            "and_or-0": "no",
+            "range0-0": "1",
+            "range1-0": "2",
+            "action-0": "repeat",
+            "an_result_id-0": "rep-1",
+            "otherWS-0": "current",
+            "setresulton-0": "original",
+        }
+        self.request["REQUEST_METHOD"] = "POST"
+        self.request.form.update({
+            "rulenumber": "1",
+            "rule": json.dumps(raw_set),
+            "_authenticator": self.get_authenticator(),
+        })
+        view = api.get_view("reflex_rule_save", context=self.scenario,
+                            request=self.request)
+        result = json.loads(view())
+        self.assertTrue(result["success"])
+        self.assertEqual(self.scenario.getReflexRule(1)["trigger"],
+                         "verify")
+        # Only the record of the rule saved is rewritten
+        self.assertTrue(records[1]._p_changed)
+        self.assertFalse(records[0]._p_changed)
+        self.assertFalse(records[2]._p_changed)
+
+    def test_save_mother_rule(self):
+        service_uid = api.get_uid(self.services[1])
+        raw_set = {
+            "trigger": "submit",
+            "conditions": [{"analysisservice": service_uid, "range0": "1",
+                            "range1": "2", "and_or": "no"}],
+            "actions": [{"action": "repeat", "an_result_id": "rep-1",
+                         "otherWS": "current"}],
+        }
+        self.request["REQUEST_METHOD"] = "POST"
+        self.request.form.update({
+            "rulenumber": "0",
+            "rule": json.dumps(raw_set),
+            "_authenticator": self.get_authenticator(),
+        })
+        view = api.get_view("reflex_rule_save", context=self.scenario,
+                            request=self.request)
+        result = json.loads(view())
+        self.assertTrue(result["success"])
+        # The derivative rules are bound to the new service as well
+        self.assertEqual(map(lambda rule: rule["mother_service_uid"],
+                             self.scenario.getReflexRules()),
+                         [service_uid] * 3)
+
+    def test_validate(self):
+        field = self.scenario.getField("ReflexRules")
+        rules = self.scenario.getReflexRules()
+        self.assertTrue(field.validate([dict(rules[0], trigger="")],
+                                       self.scenario))
+
+    def test_rulenumbers(self):
+        rules = self.scenario.getReflexRules()
+        field = self.scenario.getField("ReflexRules")
+        # Forms with rules sharing a rule number or without rule number are
+        # reported as field errors
+        duplicated = [rules[0], dict(rules[1], rulenumber="0")]
+        errors = {}
+        self.assertTrue(field.validate(duplicated, self.scenario, errors))
+        self.assertIn("ReflexRules", errors)
+        missing = [rules[0], dict(rules[1], rulenumber="")]
+        self.assertTrue(field.validate(missing, self.scenario))
+        # Rules stored programmatically are not silently dropped either
+        duplicated = [rules[0], dict(rules[1], rulenumber=0)]
+        self.assertRaises(ValueError, self.scenario.setReflexRules,
+                          duplicated)
+        missing = [rules[0], dict(rules[1], rulenumber="")]
+        self.assertRaises(ValueError, self.scenario.setReflexRules, missing)
+        self.assertEqual(len(self.scenario.getReflexRules()), 3)
+
+    def get_authenticator(self):
+        view = api.get_view("authenticator", context=self.portal,
+                            request=self.request)
+        return re.search('value="([^"]+)"', view.authenticator()).group(1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestWidget))
+    return suite
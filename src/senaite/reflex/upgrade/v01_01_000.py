@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import transaction
+from bika.lims import api
+from bika.lims.catalog.analysis_catalog import CATALOG_ANALYSIS_LISTING
+from bika.lims.upgrade import upgradestep
+from bika.lims.upgrade.utils import UpgradeUtils
+from senaite.reflex import logger
+from senaite.reflex.config import PRODUCT_NAME
+from senaite.reflex.browser.fields import RULES_SCHEMA_VERSION
+from senaite.reflex.browser.fields import normalize_rule
+from senaite.reflex.index import get_scenarios_folder
+from senaite.reflex.index import rebuild_dispatch_index
+from senaite.reflex.markers import migrate_legacy_markers
+from senaite.reflex.setuphandlers import setup_catalogs
+
+version = "1.1.0"
+profile = "profile-{0}:default".format(PRODUCT_NAME)
+
+
+@upgradestep(PRODUCT_NAME, version)
+def upgrade(tool):
+    portal = tool.aq_inner.aq_parent
+    ut = UpgradeUtils(portal)
+    ver_from = ut.getInstalledVersion(PRODUCT_NAME)
+
+    if ut.isOlderVersion(PRODUCT_NAME, version):
+        logger.info("Skipping upgrade of {0}: {1} > {2}".format(
+            PRODUCT_NAME, ver_from, version))
+        return True
+
+    logger.info("Upgrading {0}: {1} -> {2}".format(PRODUCT_NAME, ver_from,
+                                                   version))
+
+    # -------- ADD YOUR STUFF BELOW --------
+
+    # Add the reflex metadata to analyses and setup catalogs
+    setup_catalogs(portal)
+
+    # Add the settings of the reflex engine
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile(profile, "plone.app.registry")
+
+    # Store the rules of scenarios with typed values and in records
+    migrate_scenario_rules(portal)
+
+    # Build the (method, service, trigger) -> scenario lookup
+    rebuild_dispatch_index()
+
+    # Move the triggered markers of analyses to the sample-level storage
+    migrate_triggered_markers(portal)
+
+    logger.info("{0} upgraded to version {1}".format(PRODUCT_NAME, version))
+    return True
+
+
+def migrate_scenario_rules(portal):
+    """Converts the rules of existing Reflex Testing Scenarios to the current
+    schema version, with typed values, and moves them from the list stored in
+    the scenario to one persistent record per rule. The mother service and
+    the local ids of the rules are stored apart from the records
+    """
+    logger.info("Migrating rules of Reflex Testing Scenarios ...")
+    folder = get_scenarios_folder()
+    for scenario in folder.objectValues("ReflexTestingScenario"):
+        field = scenario.getField("ReflexRules")
+        rules = field.get(scenario)
+        outdated = filter(
+            lambda rule: rule.get("schema_version") != RULES_SCHEMA_VERSION,
+            rules)
+        migrated = field.get_records(scenario) is not None and \
+            field.get_local_ids_storage(scenario) is not None
+        if not outdated and migrated:
+            continue
+        logger.info("Migrating rules of '{}'".format(api.get_id(scenario)))
+        # Conditions were compared against the discrete result if the
+        # analysis had result options, regardless of the values stored
+        service_uid = field.get_mother_service_uid(scenario)
+        discrete = has_result_options(service_uid)
+        rules = map(lambda rule: migrate_rule(rule, discrete), rules)
+        try:
+            field.set_rules(scenario, rules)
+        except ValueError as e:
+            # Rules are kept as they are, so they can be fixed by hand
+            logger.error("Cannot migrate rules of '{}': {}".format(
+                api.get_id(scenario), e))
+    logger.info("Migrating rules of Reflex Testing Scenarios [DONE]")
+
+
+def has_result_options(service_uid):
+    """Returns whether the service with the UID passed in has result options
+    """
+    service = api.get_object_by_uid(service_uid, None)
+    if service is None:
+        return False
+    return len(service.getResultOptions() or []) > 0
+
+
+def migrate_rule(rule, discrete):
+    """Returns the rule passed in in the current schema version. Conditions
+    of rules not normalized yet are flagged as discrete or not depending on
+    the value passed in, so they are evaluated as they were before
+    """
+    if rule.get("schema_version") == RULES_SCHEMA_VERSION:
+        return rule
+    rule = normalize_rule(rule)
+    rule["conditions"] = map(lambda condition: dict(
+        condition, discrete=discrete), rule["conditions"])
+    return rule
+
+
+def migrate_triggered_markers(portal):
+    """Moves the pipe-joined markers from the ReflexRuleActionsTriggered field
+    of analyses to the set-based storage of their samples
+    """
+    logger.info("Migrating reflex triggered markers ...")
+    query = dict(portal_type="Analysis")
+    brains = api.search(query, CATALOG_ANALYSIS_LISTING)
+    total = len(brains)
+    migrated = 0
+    for num, brain in enumerate(brains, start=1):
+        if num % 1000 == 0:
+            logger.info("Migrating reflex triggered markers: {}/{}".format(
+                num, total))
+            transaction.savepoint(optimistic=True)
+        if not brain.getReflexRuleActionsTriggered:
+            continue
+        # The patched accessor returns the same markers once migrated, so
+        # there is no need to reindex the analysis
+        obj = api.get_object(brain)
+        migrate_legacy_markers(obj)
+        migrated += 1
+    logger.info("Migrating reflex triggered markers of {} analyses [DONE]"
+                .format(migrated))
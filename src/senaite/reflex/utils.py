@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+import Missing
+import transaction
+from bika.lims import api
+from plone.registry.interfaces import IRegistry
+from senaite.reflex.config import PRODUCT_NAME
+from zope.annotation.interfaces import IAnnotations
+from zope.component import queryUtility
+
+# Prefix of the keys of the caches stored in the request
+CACHE_KEY_PREFIX = "senaite.reflex.cache"
+
+
+def get_transaction_cache(name):
+    """Returns a dict that lives as long as the current request and
+    transaction. Returns a new (and not stored) dict if there is no request.
+
+    The cache is discarded when the transaction changes, e.g. when the
+    request is retried after a ConflictError or after an intermediate commit
+    :param name: the name of the cache
+    """
+    request = api.get_request()
+    if request is None:
+        return {}
+    annotations = IAnnotations(request)
+    key = "{}.{}".format(CACHE_KEY_PREFIX, name)
+    txn = transaction.get()
+    cached = annotations.get(key)
+    if cached is None or cached[0] is not txn:
+        cached = (txn, {})
+        annotations[key] = cached
+    return cached[1]
+
+
+def get_registry_record(name, default=None):
+    """Returns the value of the senaite.reflex registry record passed in
+    :param name: the name of the record, without the 'senaite.reflex' prefix
+    :param default: value to return if the record does not exist
+    """
+    registry = queryUtility(IRegistry)
+    if registry is None:
+        return default
+    return registry.get("{}.{}".format(PRODUCT_NAME, name), default)
+
+
+def get_metadata(analysis, name):
+    """Returns the value of the accessor passed in for the analysis, that can
+    be either a catalog brain or an object. The object is only woken up if
+    the metadata column is not available in the brain
+    :param analysis: analysis brain or object
+    :param name: the name of the accessor, e.g. 'getResult'
+    """
+    if api.is_brain(analysis):
+        value = getattr(analysis, name, None)
+        if value is not None and value is not Missing.Value:
+            return value
+        analysis = api.get_object(analysis)
+    return getattr(analysis, name)()
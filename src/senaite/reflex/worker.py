@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.REFLEX
+#
+# Copyright 2018 by it's authors.
+
+"""Worker that applies the reflex actions deferred to the job queue.
+
+Run it with the Zope instance script, e.g.:
+
+    bin/instance run src/senaite/reflex/worker.py --portal senaite
+
+Pass --interval to keep polling the queue instead of exiting once the queue
+is empty, or once a few passes in a row could not apply any pending job.
+
+Jobs are partitioned by sample: a worker leases all the jobs of a sample
+before applying them, so several workers (e.g. one per ZEO client) can run
+at the same time without touching the same sample. Leases are renewed with
+every job applied and expire after --lease seconds without renewal, so the
+jobs of a worker that dies are taken over by others.
+Pass --processes to start several workers from the same command, e.g.:
+
+    bin/instance run src/senaite/reflex/worker.py --processes 4 \
+        --interval 5 --instance bin/instance
+"""
+
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+import senaite.reflex
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from ZODB.POSException import ConflictError
+from bika.lims import api
+from bika.lims.content.reflexrule import doReflexRuleAction
+from senaite.reflex import logger
+from senaite.reflex.jobs import get_job_queue
+from senaite.reflex.metrics import inc
+from zope.component.hooks import setSite
+
+# Number of times a job is retried after a ConflictError
+MAX_RETRIES = 5
+
+# Number of jobs fetched from the queue at once
+BATCH_SIZE = 100
+
+# Seconds a worker owns the jobs of a sample
+LEASE_DURATION = 300
+
+# Seconds between reports of throughput and queue depth
+REPORT_INTERVAL = 60
+
+# Seconds to wait when no pending job could be applied, e.g. because they
+# are leased by other workers
+IDLE_WAIT = 1
+
+# Number of passes in a row without any job applied after which a worker
+# started without --interval exits, even if jobs are pending
+MAX_IDLE_PASSES = 5
+
+
+class LeaseLost(Exception):
+    """The lease of a sample expired and was taken over by another worker
+    """
+
+
+def apply_job(key, max_retries=MAX_RETRIES, worker=None,
+              lease=LEASE_DURATION):
+    """Applies the actions of the job with the key passed in and removes the
+    job from the queue, all within its own transaction. Conflicting
+    transactions are retried. Jobs that fail for any other reason are moved
+    to the failed jobs. Returns whether the job has been applied
+    :param worker: if set, the lease of the sample of the job is renewed for
+        this worker in the same transaction. LeaseLost is raised if the
+        sample is leased by another worker
+    :param lease: seconds the lease is renewed for
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            queue = get_job_queue()
+            job = queue and queue.get(key)
+            if job is None:
+                # Processed meanwhile
+                transaction.abort()
+                return False
+
+            if worker and not queue.claim(job.sample_uid, worker, lease):
+                transaction.abort()
+                raise LeaseLost(job.sample_uid)
+
+            analysis = api.get_object_by_uid(job.analysis_uid, None)
+            if analysis is None:
+                queue.fail(key, "Analysis {} not found".format(
+                    job.analysis_uid))
+                transaction.commit()
+                return False
+
+            job.attempts += 1
+            doReflexRuleAction(analysis, job.actions)
+            queue.done(key)
+            transaction.commit()
+            return True
+
+        except ConflictError:
+            transaction.abort()
+            inc("reflex_conflicts_total", source="worker")
+            logger.info("Conflict while applying reflex job {}, retrying "
+                        "({}/{})".format(key, attempt + 1, max_retries))
+            # Randomized backoff, so competing transactions do not retry at
+            # the same time again
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+        except LeaseLost:
+            raise
+
+        except Exception as e:
+            transaction.abort()
+            logger.exception("Cannot apply reflex job {}".format(key))
+            fail_job(key, repr(e), max_retries=max_retries)
+            return False
+
+    logger.warn("Reflex job {} skipped after {} conflicts, will be retried "
+                "on next run".format(key, max_retries))
+    return False
+
+
+def fail_job(key, error, max_retries=MAX_RETRIES):
+    """Moves the job with the key passed in to the failed jobs in its own
+    transaction. Conflicting transactions are retried. The job is left in
+    the queue, to be retried on next run, if it cannot be moved
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            get_job_queue().fail(key, error)
+            transaction.commit()
+            return True
+        except ConflictError:
+            transaction.abort()
+            inc("reflex_conflicts_total", source="worker")
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    logger.warn("Reflex job {} could not be moved to the failed jobs after "
+                "{} conflicts".format(key, max_retries))
+    return False
+
+
+def get_worker_id():
+    """Returns the id of the current worker process
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def claim_sample(sample_uid, worker, duration=LEASE_DURATION,
+                 max_retries=MAX_RETRIES):
+    """Leases the jobs of the sample passed in to the worker in its own
+    transaction. Returns False if the sample is leased by another worker.
+    Conflicting transactions are retried, so the lease is checked again
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            queue = get_job_queue()
+            if not queue.claim(sample_uid, worker, duration):
+                transaction.abort()
+                return False
+            transaction.commit()
+            return True
+        except ConflictError:
+            # Either another worker claimed this sample at the same time or
+            # a lease of another sample was written meanwhile
+            transaction.abort()
+            inc("reflex_conflicts_total", source="worker")
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    return False
+
+
+def release_sample(sample_uid, worker, max_retries=MAX_RETRIES):
+    """Releases the lease of the sample passed in in its own transaction. The
+    lease expires anyway if it cannot be released
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            get_job_queue().release(sample_uid, worker)
+            transaction.commit()
+            return True
+        except ConflictError:
+            transaction.abort()
+    return False
+
+
+class WorkerStats(object):
+    """Counters of a worker, reported to the log from time to time
+    """
+
+    def __init__(self, worker, interval=REPORT_INTERVAL):
+        self.worker = worker
+        self.interval = interval
+        self.started = time.time()
+        self.reported = self.started
+        self.applied = 0
+        self.skipped = 0
+
+    def add(self, applied):
+        if applied:
+            self.applied += 1
+        else:
+            self.skipped += 1
+
+    def report(self, force=False):
+        """Logs the throughput of the worker and the depth of the queue, if
+        the report interval has been exceeded or force is True
+        """
+        now = time.time()
+        if not force and now - self.reported < self.interval:
+            return
+        self.reported = now
+        queue = get_job_queue()
+        elapsed = max(now - self.started, 1)
+        logger.info(
+            "Reflex worker {}: {} jobs applied ({:.2f} jobs/s), {} skipped, "
+            "{} pending in queue, {} samples leased".format(
+                self.worker, self.applied, self.applied / elapsed,
+                self.skipped, queue and len(queue) or 0,
+                queue and len(queue.leases()) or 0))
+
+
+def get_worker_samples(queue, worker, batch_size=BATCH_SIZE):
+    """Returns a list of tuples (sample UID, keys) with the pending jobs of
+    the samples not leased by other workers, from the oldest jobs. Each
+    worker starts from a different sample of the batch, so workers do not
+    compete for the same samples
+    """
+    samples = queue.keys_by_sample(limit=batch_size, worker=worker).items()
+    if not samples:
+        return samples
+    offset = zlib.crc32(worker) % len(samples)
+    return samples[offset:] + samples[:offset]
+
+
+def process_jobs(batch_size=BATCH_SIZE, max_retries=MAX_RETRIES,
+                 lease=LEASE_DURATION, worker=None, stats=None):
+    """Applies the pending jobs from the queue, sample by sample. Samples
+    leased by other workers are skipped. The lease of a sample is renewed
+    with every job applied. Returns the number of jobs applied
+    """
+    worker = worker or get_worker_id()
+    transaction.begin()
+    queue = get_job_queue()
+    if queue is None:
+        return 0
+    applied = 0
+    for sample_uid, keys in get_worker_samples(queue, worker, batch_size):
+        if not claim_sample(sample_uid, worker, duration=lease,
+                            max_retries=max_retries):
+            continue
+        try:
+            for key in keys:
+                success = apply_job(key, max_retries=max_retries,
+                                    worker=worker, lease=lease)
+                applied += success and 1 or 0
+                if stats:
+                    stats.add(success)
+                    stats.report()
+        except LeaseLost:
+            logger.warn("Lease of sample {} lost by reflex worker {}".format(
+                sample_uid, worker))
+        finally:
+            release_sample(sample_uid, worker, max_retries=max_retries)
+    return applied
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Applies the reflex actions deferred to the job queue")
+    parser.add_argument("--portal", default="senaite",
+                        help="Id of the SENAITE site")
+    parser.add_argument("--user", default="admin",
+                        help="User from the Zope root the actions are run as")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="Seconds to wait before polling the queue "
+                             "again. Exits when the queue is empty if 0")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Number of jobs fetched from the queue at once")
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES,
+                        help="Number of retries on ConflictError")
+    parser.add_argument("--lease", type=float, default=LEASE_DURATION,
+                        help="Seconds a worker owns the jobs of a sample")
+    parser.add_argument("--report", type=float, default=REPORT_INTERVAL,
+                        help="Seconds between reports of throughput and "
+                             "queue depth")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of worker processes to start")
+    parser.add_argument("--instance", default="bin/instance",
+                        help="Instance script used to start the worker "
+                             "processes, if more than one")
+    return parser
+
+
+def spawn_workers(args, argv):
+    """Starts the number of worker processes passed in through the instance
+    script and waits for them, while reporting the depth of the queue and
+    the overall throughput
+    """
+    argv = list(argv)
+    if "--processes" in argv:
+        pos = argv.index("--processes")
+        del argv[pos:pos + 2]
+    argv = filter(lambda arg: not arg.startswith("--processes="), argv)
+    script = os.path.join(os.path.dirname(senaite.reflex.__file__),
+                          "worker.py")
+    command = [args.instance, "run", script] + argv
+    processes = map(lambda num: subprocess.Popen(command),
+                    range(args.processes))
+    logger.info("Reflex workers started: {}".format(
+        ", ".join(map(lambda proc: str(proc.pid), processes))))
+
+    transaction.begin()
+    queue = get_job_queue()
+    started = time.time()
+    processed = queue and queue.processed or 0
+    while filter(lambda proc: proc.poll() is None, processes):
+        time.sleep(args.report or REPORT_INTERVAL)
+        transaction.begin()
+        queue = get_job_queue()
+        if queue is None:
+            continue
+        elapsed = max(time.time() - started, 1)
+        logger.info(
+            "Reflex workers: {} jobs applied ({:.2f} jobs/s), {} pending in "
+            "queue, {} samples leased".format(
+                queue.processed - processed,
+                (queue.processed - processed) / elapsed,
+                len(queue), len(queue.leases())))
+    return map(lambda proc: proc.returncode, processes)
+
+
+def setup(app, portal_id, username):
+    """Sets the site and the security manager, as done by the publisher
+    """
+    portal = app[portal_id]
+    setSite(portal)
+    user = app.acl_users.getUser(username)
+    if user is None:
+        raise ValueError("User '{}' not found".format(username))
+    newSecurityManager(None, user.__of__(app.acl_users))
+    return portal
+
+
+def get_pending():
+    """Returns the number of jobs pending in the queue, as seen by a new
+    transaction
+    """
+    transaction.begin()
+    queue = get_job_queue()
+    return queue and len(queue) or 0
+
+
+def main(app, argv):
+    args = get_parser().parse_args(argv)
+    setup(app, args.portal, args.user)
+    if args.processes > 1:
+        return spawn_workers(args, argv)
+
+    worker = get_worker_id()
+    stats = WorkerStats(worker, interval=args.report)
+    logger.info("Reflex worker {} started".format(worker))
+    idle_passes = 0
+    while True:
+        applied = process_jobs(batch_size=args.batch_size,
+                               max_retries=args.retries, lease=args.lease,
+                               worker=worker, stats=stats)
+        if applied:
+            idle_passes = 0
+            continue
+        stats.report()
+        idle_passes += 1
+        pending = get_pending()
+        if not args.interval:
+            if not pending:
+                break
+            if idle_passes >= MAX_IDLE_PASSES:
+                # Jobs leased by other (or dead) workers or that keep
+                # conflicting are left for the next run
+                logger.warn("Reflex worker {} stopped with {} jobs pending"
+                            .format(worker, pending))
+                break
+        # Jobs are leased by other workers or skipped after conflicts, wait
+        # a bit before trying again
+        time.sleep(args.interval or IDLE_WAIT)
+    stats.report(force=True)
+    logger.info("Reflex worker {} stopped".format(worker))
+
+
+if __name__ == "__main__":
+    # 'app' is available when run through 'bin/instance run'
+    main(app, sys.argv[1:])  # noqa